@@ -0,0 +1,102 @@
+# coding=utf-8
+"""
+Admission control of issuance work
+"""
+from contextlib import contextmanager
+from math import ceil
+from threading import Lock
+from typing import Any, Dict, Iterator
+
+from errors import ServerBusyError, JobQueueFullError
+
+
+class AdmissionController(object):
+    """
+    Rejects synchronous issuance requests beyond max_active running
+    ones and asynchronous jobs beyond max_queued unfinished ones.
+    Rejections carry the time the backlog takes to drain, estimated
+    from the moving average of successful certbot runs. A synchronous
+    batch holds one slot, it runs on a single server thread
+    """
+
+    def __init__(
+        self,
+        max_active: int,
+        max_queued: int,
+        initial_duration: float,
+        smoothing: float = 0.2,
+    ) -> None:
+        self.max_active = max_active
+        self.max_queued = max_queued
+        self._initial_duration = initial_duration
+        self._smoothing = smoothing
+        self._lock = Lock()
+        self.active = 0
+        self.duration = initial_duration
+        self.completed = 0
+        self.rejected_busy = 0
+        self.rejected_queue_full = 0
+
+    @contextmanager
+    def admit(self) -> Iterator[None]:
+        """
+        Holds a slot of synchronous issuance while the request is
+        processed. Raises an error if there are no free slots
+        """
+        with self._lock:
+            if self.active >= self.max_active:
+                self.rejected_busy += 1
+                raise ServerBusyError(
+                    self._retry_after(self.active, self.max_active))
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.active -= 1
+
+    def admit_job(self, depth: int, workers: int) -> None:
+        """
+        Raises an error if the number of unfinished jobs reached the
+        limit
+        """
+        with self._lock:
+            if depth >= self.max_queued:
+                self.rejected_queue_full += 1
+                raise JobQueueFullError(self._retry_after(depth, workers))
+
+    def record(self, seconds: float) -> None:
+        """
+        Adds duration of a successful issuance to the moving average
+        """
+        with self._lock:
+            self.duration += self._smoothing * (seconds - self.duration)
+            self.completed += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Returns admission counters
+        """
+        with self._lock:
+            return {
+                "active": self.active,
+                "max_active": self.max_active,
+                "max_queued": self.max_queued,
+                "rejected_busy": self.rejected_busy,
+                "rejected_queue_full": self.rejected_queue_full,
+                "completed": self.completed,
+                "duration_average": round(self.duration, 3),
+            }
+
+    def clear(self) -> None:
+        """
+        Drops counters and duration average
+        """
+        with self._lock:
+            self.duration = self._initial_duration
+            self.completed = 0
+            self.rejected_busy = 0
+            self.rejected_queue_full = 0
+
+    def _retry_after(self, depth: int, parallelism: int) -> int:
+        return max(ceil(self.duration * depth / max(parallelism, 1)), 1)
@@ -0,0 +1,131 @@
+# coding=utf-8
+"""
+Execution of many issuance requests with bounded concurrency
+"""
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextvars import copy_context
+from logging import info, exception
+from threading import Condition, Lock
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+from phases import PhaseRecorder, recording
+
+
+class OnceCache(object):
+    """
+    Runs function once per key. Concurrent and later callers of the
+    same key get the first call result or exception
+    """
+
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self._futures: Dict[Hashable, Future] = {}
+
+    def call(self, key: Hashable, fn: Callable[..., Any], *args) -> Any:
+        """
+        Returns result of fn(*args) computed once for the key
+        """
+        with self._lock:
+            future: Optional[Future] = self._futures.get(key)
+            owner: bool = future is None
+            if owner:
+                future = self._futures[key] = Future()
+        if owner:
+            try:
+                future.set_result(fn(*args))
+            except Exception as e:
+                future.set_exception(e)
+        return future.result()
+
+
+def parse_limits(value: str) -> Dict[str, int]:
+    """
+    Parses comma separated list of name=limit items
+    """
+    limits: Dict[str, int] = {}
+    for item in filter(None, (i.strip() for i in value.split(","))):
+        name, _, limit = item.partition("=")
+        limits[name.strip()] = int(limit)
+    return limits
+
+
+def run_batch(
+    items: List[Any],
+    handler: Callable[[Any], Dict[str, Any]],
+    error_handler: Callable[[Exception], Tuple[Dict[str, Any], int]],
+    concurrency: int,
+    group: Callable[[Any], str],
+    limits: Dict[str, int],
+    gang: Optional[Callable[[Any], Hashable]] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Runs handler for every item with at most concurrency items at
+    once and at most limits[group(item)] items of the same group at
+    once. Items with the same gang key are started together once all
+    of them fit into both limits and every one of them counts against
+    them, a gang larger than a limit runs alone. Items are started in
+    order as soon as limits allow. Returns per-item results in the
+    items order
+    """
+    results: List[Optional[Dict[str, Any]]] = [None] * len(items)
+    units: Dict[Hashable, List[int]] = {}
+    for index, item in enumerate(items):
+        key: Hashable = (0, index) if gang is None \
+            else (1, gang(item))
+        units.setdefault(key, []).append(index)
+    pending: List[List[int]] = list(units.values())
+    running: Dict[str, int] = {}
+    active: int = 0
+    condition = Condition()
+
+    def run(index: int) -> None:
+        nonlocal active
+        item_result: Dict[str, Any] = {"index": index}
+        # noinspection PyBroadException
+        try:
+            with recording(PhaseRecorder()) as phases:
+                try:
+                    item_result["result"] = handler(items[index])
+                    item_result["success"] = True
+                except Exception as e:
+                    exception(f"Batch item {index} has failed")
+                    item_result["error"] = error_handler(e)[0]["error"]
+                    item_result["success"] = False
+            item_result["timings"] = phases.as_dict()
+        finally:
+            with condition:
+                results[index] = item_result
+                active -= 1
+                running[group(items[index])] -= 1
+                condition.notify_all()
+
+    def ready() -> Optional[List[int]]:
+        for unit in pending:
+            if active and active + len(unit) > concurrency:
+                continue
+            name: str = group(items[unit[0]])
+            current: int = running.get(name, 0)
+            if current and current + len(unit) > \
+                    limits.get(name, concurrency):
+                continue
+            return unit
+        return None
+
+    with ThreadPoolExecutor(
+            max_workers=max([concurrency, *map(len, pending)]),
+            thread_name_prefix="batch") as executor:
+        with condition:
+            while pending:
+                ready_unit: Optional[List[int]] = ready()
+                if ready_unit is None:
+                    condition.wait()
+                    continue
+                pending.remove(ready_unit)
+                active += len(ready_unit)
+                name = group(items[ready_unit[0]])
+                running[name] = running.get(name, 0) + len(ready_unit)
+                for index in ready_unit:
+                    executor.submit(copy_context().run, run, index)
+            condition.wait_for(lambda: active == 0)
+    info(f"Batch of {len(items)} items has completed")
+    return results
@@ -0,0 +1,5 @@
+# coding=utf-8
+"""
+Performance benchmarks, run them from the repository root with
+python -m benchmarks.<name>
+"""
@@ -0,0 +1,93 @@
+# coding=utf-8
+"""
+Compares certbot start-up cost of subprocess, in-process and worker
+pool execution modes. Runs `certbot plugins`, which discovers and
+loads every plugin without contacting ACME servers.
+
+Usage: python -m benchmarks.certbot_startup [--iterations N]
+"""
+from argparse import ArgumentParser
+from json import dumps
+from statistics import mean, median
+from tempfile import TemporaryDirectory
+from time import monotonic
+from typing import Callable, Dict, List, Tuple
+
+from certbot_runner import InProcessRunner, WorkerPool
+from providers import preloaded_modules
+from utils import run_subprocess
+
+
+def certbot_command(directory: str) -> List[str]:
+    """
+    Returns cheap certbot command using isolated directories
+    """
+    return [
+        "certbot",
+        "--noninteractive",
+        f"--config-dir={directory}/config",
+        f"--work-dir={directory}/workspace",
+        f"--logs-dir={directory}/logs",
+        "plugins",
+    ]
+
+
+def measure(
+    run: Callable[[List[str]], Tuple[int, str]],
+    iterations: int,
+) -> Dict[str, float]:
+    """
+    Returns wall time statistics of the runs in seconds
+    """
+    durations: List[float] = []
+    for _ in range(iterations):
+        with TemporaryDirectory(prefix="certbot-bench-") as d:
+            start: float = monotonic()
+            code, out = run(certbot_command(d))
+            durations.append(monotonic() - start)
+            if code:
+                raise RuntimeError(f"certbot has failed: {out}")
+    return {
+        "mean": round(mean(durations), 3),
+        "median": round(median(durations), 3),
+        "min": round(min(durations), 3),
+        "max": round(max(durations), 3),
+    }
+
+
+def main():
+    """
+    Entrypoint
+    """
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=10)
+    args = parser.parse_args()
+
+    runner = InProcessRunner(preloaded_modules)
+    warm_start: float = monotonic()
+    runner.warm()
+    warm_seconds: float = monotonic() - warm_start
+    pool = WorkerPool(preloaded_modules, size=2, max_jobs=10,
+                      idle_timeout=0)
+    pool.warm()
+
+    results = {
+        "iterations": args.iterations,
+        "subprocess": measure(
+            lambda cmd: run_subprocess(cmd, timeout=300,
+                                       shell=False, stdin=None),
+            args.iterations),
+        "inprocess": measure(
+            lambda cmd: runner.run(cmd, timeout=300),
+            args.iterations),
+        "pool": measure(
+            lambda cmd: pool.run(cmd, timeout=300),
+            args.iterations),
+        "inprocess_warm_up": round(warm_seconds, 3),
+    }
+    pool.shutdown()
+    print(dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+# coding=utf-8
+"""
+Measures latency and throughput of synchronous issuance through the
+real server. GCS and Secret Manager clients are replaced with
+in-memory fakes with simulated latency and bandwidth, certbot is
+replaced with benchmarks/fake_certbot.py run as a subprocess. Every
+request targets its own path, so no requests are coalesced.
+
+Usage: python -m benchmarks.end_to_end [--requests N]
+    [--concurrency 1,10,50] [--certbot-delay SECONDS]
+    [--gcs-latency SECONDS] [--gcs-bandwidth MBPS]
+    [--secret-latency SECONDS] [--server-threads N]
+    [--output FILE] [--baseline FILE]
+"""
+import sys
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from json import dumps, loads
+from os import chmod, environ, makedirs
+from os.path import abspath, dirname, join
+from statistics import mean, quantiles
+from tempfile import TemporaryDirectory
+from threading import Thread, local
+from time import monotonic
+from typing import Any, Dict, List, Optional, Tuple
+from unittest.mock import patch
+
+import requests
+
+from benchmarks.fakes import FakeSecretManagerClient, FakeStorage, \
+    FakeStorageClient, Network
+
+FAKE_CERTBOT: str = join(dirname(abspath(__file__)), "fake_certbot.py")
+
+_sessions = local()
+
+
+def install_fake_certbot(directory: str) -> None:
+    """
+    Puts certbot executable running the fake one first on PATH
+    """
+    path: str = join(directory, "certbot")
+    with open(path, "w") as f:
+        f.write(f"#!/bin/sh\nexec '{sys.executable}' '{FAKE_CERTBOT}' "
+                f"\"$@\"\n")
+    chmod(path, 0o755)
+    environ["PATH"] = f"{directory}:{environ['PATH']}"
+
+
+def issue(url: str, n: int) -> Tuple[float, int, Dict[str, float]]:
+    """
+    Sends issuance request, returns its latency, status and phase
+    timings reported by the server
+    """
+    session: Optional[requests.Session] = getattr(
+        _sessions, "session", None)
+    if session is None:
+        session = _sessions.session = requests.Session()
+    start: float = monotonic()
+    rsp = session.post(f"{url}/certs", json={
+        "provider": "cloudflare",
+        "secret_id": "cloudflare-token",
+        "project": "bench-project",
+        "domains": [f"n{n}.bench.example.com",
+                    f"*.n{n}.bench.example.com"],
+        "email": "bench@example.com",
+        "target_bucket": "bench-bucket",
+        "target_bucket_path": f"certs/{n}",
+        "propagation_seconds": 60,
+    })
+    seconds: float = monotonic() - start
+    return seconds, rsp.status_code, rsp.json().get("timings") or {}
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    """
+    Returns p50, p95, p99, mean and max of the values in seconds
+    """
+    cuts: List[float] = quantiles(values, n=100, method="inclusive") \
+        if len(values) > 1 else values * 99
+    return {
+        "p50": round(cuts[49], 3),
+        "p95": round(cuts[94], 3),
+        "p99": round(cuts[98], 3),
+        "mean": round(mean(values), 3),
+        "max": round(max(values), 3),
+    }
+
+
+def measure(
+    url: str,
+    first: int,
+    count: int,
+    concurrency: int,
+) -> Dict[str, Any]:
+    """
+    Returns latency percentiles, throughput, statuses and mean phase
+    timings of the requests sent by concurrent clients
+    """
+    start: float = monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as e:
+        results: List[Tuple[float, int, Dict[str, float]]] = list(
+            e.map(lambda n: issue(url, n), range(first, first + count)))
+    seconds: float = monotonic() - start
+    statuses: Dict[str, int] = {}
+    for _, status, _ in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    succeeded = [r for r in results if r[1] == 200]
+    phases: Dict[str, List[float]] = {}
+    for _, _, timings in succeeded:
+        for name, value in timings.items():
+            phases.setdefault(name, []).append(value)
+    return {
+        "requests": count,
+        "statuses": statuses,
+        "seconds": round(seconds, 3),
+        "requests_per_second": round(len(succeeded) / seconds, 2),
+        "latency": percentiles([r[0] for r in succeeded])
+        if succeeded else None,
+        "phases": {k: round(mean(v), 3) for k, v in sorted(phases.items())},
+    }
+
+
+def compare(
+    results: Dict[str, Dict[str, Any]],
+    baseline: Dict[str, Dict[str, Any]],
+) -> Dict[str, Dict[str, float]]:
+    """
+    Returns ratios of p95 latency and throughput to the baseline ones
+    by concurrency, values above 1 are slower and faster respectively
+    """
+    ratios: Dict[str, Dict[str, float]] = {}
+    for concurrency, result in results.items():
+        base: Optional[Dict[str, Any]] = baseline.get(concurrency)
+        if not base or not base["latency"] or not result["latency"] \
+                or not base["requests_per_second"]:
+            continue
+        ratios[concurrency] = {
+            "p95": round(result["latency"]["p95"]
+                         / base["latency"]["p95"], 2),
+            "requests_per_second": round(
+                result["requests_per_second"]
+                / base["requests_per_second"], 2),
+        }
+    return ratios
+
+
+def main():
+    """
+    Entrypoint
+    """
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=50,
+                        help="requests per concurrency level, at least "
+                             "the concurrency")
+    parser.add_argument("--concurrency", default="1,10,50")
+    parser.add_argument("--certbot-delay", type=float, default=1.0)
+    parser.add_argument("--gcs-latency", type=float, default=0.03)
+    parser.add_argument("--gcs-bandwidth", type=float, default=50.0,
+                        help="megabytes per second, 0 is unlimited")
+    parser.add_argument("--secret-latency", type=float, default=0.05)
+    parser.add_argument("--server-threads", type=int, default=60)
+    parser.add_argument("--output",
+                        default="benchmarks/results/end_to_end.json")
+    parser.add_argument("--baseline")
+    args = parser.parse_args()
+
+    levels: List[int] = [int(i) for i in args.concurrency.split(",")]
+    config: Dict[str, Any] = {
+        k: v for k, v in vars(args).items()
+        if k not in ("output", "baseline")
+    }
+    with TemporaryDirectory(prefix="e2e-bench-") as d:
+        install_fake_certbot(d)
+        environ.update({
+            "PORT": "0",
+            "SERVER_THREADS": str(args.server_threads),
+            "CERTBOT_EXECUTION": "subprocess",
+            "FAKE_CERTBOT_DELAY": str(args.certbot_delay),
+        })
+        storage = FakeStorage(
+            Network(args.gcs_latency, args.gcs_bandwidth * 1e6))
+        secret_manager = FakeSecretManagerClient(
+            Network(args.secret_latency, 0), "dns_cloudflare_api_token=x")
+        # server configuration is read on import
+        import server
+        with patch("gcs.Client",
+                   lambda project: FakeStorageClient(project, storage)), \
+                patch("service.SecretManagerServiceClient",
+                      lambda: secret_manager):
+            wsgi = server.init_server()
+            wsgi.prepare()
+            Thread(target=wsgi.serve, daemon=True).start()
+            url: str = f"http://127.0.0.1:{wsgi.bind_addr[1]}"
+            try:
+                results: Dict[str, Dict[str, Any]] = {}
+                first: int = 0
+                for concurrency in levels:
+                    count: int = max(args.requests, concurrency)
+                    results[str(concurrency)] = measure(
+                        url, first, count, concurrency)
+                    first += count
+            finally:
+                wsgi.stop()
+    report: Dict[str, Any] = {
+        "config": config,
+        "concurrency": results,
+        "gcs": {"calls": storage.network.calls,
+                "bytes": storage.network.bytes},
+    }
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            report["baseline"] = compare(
+                results, loads(f.read())["concurrency"])
+    makedirs(dirname(abspath(args.output)), exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        f.write(dumps(report, indent=2))
+    print(dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
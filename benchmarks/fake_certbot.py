@@ -0,0 +1,140 @@
+# coding=utf-8
+"""
+Stands for certbot executable in benchmarks. Spends the delay from
+FAKE_CERTBOT_DELAY environment variable going through ACME steps,
+writes debug log and lineage with self-signed certificate for the
+requested domains the way certbot does.
+
+Usage: python benchmarks/fake_certbot.py [certbot options]
+"""
+from argparse import ArgumentParser
+from datetime import datetime, timedelta, timezone
+from os import environ, makedirs, symlink
+from os.path import join
+from time import sleep
+from typing import List, TextIO
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+ACME = "https://acme-v02.api.letsencrypt.org"
+
+# share of the delay, log message, ACME requests of every step
+STEPS = (
+    (0.05, "certbot._internal.main:certbot version: 2.10.0",
+     ["GET /directory", "POST /acme/new-acct"]),
+    (0.05, "certbot._internal.client:Obtaining a new certificate",
+     ["POST /acme/new-order"]),
+    (0.05, "certbot._internal.client:Fetching authorizations",
+     ["POST /acme/authz-v3/1"]),
+    (0.05, "certbot._internal.auth_handler:Performing the following "
+           "challenges:", []),
+    (0.5, "certbot._internal.display.obj:Notifying user: Waiting 60 "
+          "seconds for DNS changes to propagate", []),
+    (0.15, "certbot._internal.auth_handler:Waiting for verification...",
+     ["POST /acme/chall-v3/1/a", "POST /acme/authz-v3/1"]),
+    (0.05, "certbot._internal.auth_handler:Cleaning up challenges", []),
+    (0.1, "certbot._internal.client:Finalizing order",
+     ["POST /acme/finalize/1/2", "POST /acme/order/1/2"]),
+    (0.0, "certbot._internal.client:Downloading certificate",
+     ["POST /acme/cert/1"]),
+)
+
+
+def log(f: TextIO, message: str) -> None:
+    """
+    Writes record in certbot debug log format
+    """
+    at: datetime = datetime.now()
+    f.write(f"{at:%Y-%m-%d %H:%M:%S},{at.microsecond // 1000:03d}:"
+            f"DEBUG:{message}\n")
+    f.flush()
+
+
+def certificate(domains: List[str]) -> List[bytes]:
+    """
+    Returns PEM encoded private key, certificate and issuer
+    certificate valid for 90 days
+    """
+    now: datetime = datetime.now(tz=timezone.utc)
+    issuer_key = ec.generate_private_key(ec.SECP256R1())
+    issuer_name = x509.Name(
+        [x509.NameAttribute(NameOID.COMMON_NAME, "Fake Issuer")])
+    issuer = x509.CertificateBuilder() \
+        .subject_name(issuer_name) \
+        .issuer_name(issuer_name) \
+        .public_key(issuer_key.public_key()) \
+        .serial_number(x509.random_serial_number()) \
+        .not_valid_before(now) \
+        .not_valid_after(now + timedelta(days=365)) \
+        .sign(issuer_key, hashes.SHA256())
+    key = ec.generate_private_key(ec.SECP256R1())
+    cert = x509.CertificateBuilder() \
+        .subject_name(x509.Name(
+            [x509.NameAttribute(NameOID.COMMON_NAME, domains[0])])) \
+        .issuer_name(issuer_name) \
+        .public_key(key.public_key()) \
+        .serial_number(x509.random_serial_number()) \
+        .not_valid_before(now) \
+        .not_valid_after(now + timedelta(days=90)) \
+        .add_extension(x509.SubjectAlternativeName(
+            [x509.DNSName(i) for i in domains]), critical=False) \
+        .sign(issuer_key, hashes.SHA256())
+    return [
+        key.private_bytes(serialization.Encoding.PEM,
+                          serialization.PrivateFormat.PKCS8,
+                          serialization.NoEncryption()),
+        cert.public_bytes(serialization.Encoding.PEM),
+        issuer.public_bytes(serialization.Encoding.PEM),
+    ]
+
+
+def write_lineage(config_dir: str, cert_name: str,
+                  domains: List[str]) -> None:
+    """
+    Writes archive files and live symlinks to them
+    """
+    archive: str = join(config_dir, "archive", cert_name)
+    live: str = join(config_dir, "live", cert_name)
+    makedirs(archive)
+    makedirs(live)
+    key, cert, chain = certificate(domains)
+    for name, data in (("privkey", key), ("cert", cert),
+                       ("chain", chain), ("fullchain", cert + chain)):
+        with open(join(archive, f"{name}1.pem"), "wb") as f:
+            f.write(data)
+        symlink(join("..", "..", "archive", cert_name, f"{name}1.pem"),
+                join(live, f"{name}.pem"))
+    with open(join(live, "README"), "w") as f:
+        f.write("This directory contains your keys and certificates.\n")
+
+
+def main():
+    """
+    Entrypoint
+    """
+    parser = ArgumentParser()
+    parser.add_argument("--config-dir", required=True)
+    parser.add_argument("--logs-dir", required=True)
+    parser.add_argument("--cert-name", required=True)
+    parser.add_argument("-d", dest="domains", action="append")
+    args, _ = parser.parse_known_args()
+
+    delay: float = float(environ.get("FAKE_CERTBOT_DELAY", "1"))
+    makedirs(args.logs_dir, exist_ok=True)
+    with open(join(args.logs_dir, "letsencrypt.log"), "w") as f:
+        for share, message, requests in STEPS:
+            log(f, message)
+            for request in requests:
+                method, path = request.split()
+                log(f, f"acme.client:Sending {method} request to "
+                       f"{ACME}{path}.")
+            sleep(delay * share)
+        write_lineage(args.config_dir, args.cert_name, args.domains)
+        log(f, "certbot._internal.storage:Writing certificate")
+
+
+if __name__ == "__main__":
+    main()
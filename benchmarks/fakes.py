@@ -0,0 +1,271 @@
+# coding=utf-8
+"""
+In-memory GCS and Secret Manager clients with simulated latency and
+bandwidth, they implement only the API surface used by the service
+"""
+from base64 import b64encode
+from hashlib import md5
+from threading import Lock
+from time import sleep
+from types import SimpleNamespace
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+# noinspection PyPackageRequirements
+from google.api_core.exceptions import NotFound, PreconditionFailed
+from google_crc32c import Checksum
+from requests import Session
+
+
+class Network(object):
+    """
+    Delays every call by latency plus transfer time of its payload
+    """
+
+    def __init__(self, latency: float, bandwidth: float) -> None:
+        self.latency = latency
+        # bytes per second, 0 is unlimited
+        self.bandwidth = bandwidth
+        self._lock = Lock()
+        self.calls = 0
+        self.bytes = 0
+
+    def call(self, size: int = 0) -> None:
+        """
+        Sleeps for duration of a call transferring size bytes
+        """
+        with self._lock:
+            self.calls += 1
+            self.bytes += size
+        transfer: float = size / self.bandwidth if self.bandwidth else 0
+        sleep(self.latency + transfer)
+
+
+class FakeStorage(object):
+    """
+    Objects of all buckets with generations and checksums
+    """
+
+    def __init__(self, network: Network) -> None:
+        self.network = network
+        self._lock = Lock()
+        self._objects: Dict[Tuple[str, str], Tuple[bytes, int]] = {}
+        self._generation = 0
+
+    def get(self, bucket: str, name: str) -> Optional[Tuple[bytes, int]]:
+        """
+        Returns object data and generation, None if it is absent
+        """
+        with self._lock:
+            return self._objects.get((bucket, name))
+
+    def put(
+        self,
+        bucket: str,
+        name: str,
+        data: bytes,
+        if_generation_match: Optional[int] = None,
+    ) -> int:
+        """
+        Stores object, returns its generation
+        """
+        with self._lock:
+            current = self._objects.get((bucket, name))
+            if if_generation_match is not None \
+                    and if_generation_match != (current or (b"", 0))[1]:
+                raise PreconditionFailed(f"gs://{bucket}/{name}")
+            self._generation += 1
+            self._objects[(bucket, name)] = (data, self._generation)
+            return self._generation
+
+    def delete(
+        self,
+        bucket: str,
+        name: str,
+        if_generation_match: Optional[int] = None,
+    ) -> None:
+        """
+        Deletes object
+        """
+        with self._lock:
+            current = self._objects.get((bucket, name))
+            if current is None:
+                raise NotFound(f"gs://{bucket}/{name}")
+            if if_generation_match is not None \
+                    and if_generation_match != current[1]:
+                raise PreconditionFailed(f"gs://{bucket}/{name}")
+            del self._objects[(bucket, name)]
+
+    def names(self, bucket: str, prefix: str) -> Iterator[str]:
+        """
+        Returns sorted object names with the prefix
+        """
+        with self._lock:
+            return iter(sorted(
+                name for b, name in self._objects
+                if b == bucket and name.startswith(prefix)))
+
+
+class FakeBlob(object):
+    """
+    Object handle, metadata is loaded by bucket calls returning it
+    """
+
+    def __init__(self, bucket: "FakeBucket", name: str) -> None:
+        self.bucket = bucket
+        self.name = name
+        self.generation: Optional[int] = None
+        self.crc32c: Optional[str] = None
+        self.md5_hash: Optional[str] = None
+
+    def _load(self, data: bytes, generation: int) -> "FakeBlob":
+        crc32c = Checksum(data)
+        self.generation = generation
+        self.crc32c = b64encode(crc32c.digest()).decode("ascii")
+        self.md5_hash = b64encode(md5(data).digest()).decode("ascii")
+        return self
+
+    def upload_from_string(
+        self,
+        data: Any,
+        content_type: Optional[str] = None,
+        if_generation_match: Optional[int] = None,
+    ) -> None:
+        """
+        Uploads string or bytes
+        """
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        storage: FakeStorage = self.bucket.storage
+        storage.network.call(len(data))
+        self._load(data, storage.put(self.bucket.name, self.name, data,
+                                     if_generation_match))
+
+    def upload_from_filename(self, filename: str, **kwargs) -> None:
+        """
+        Uploads file content
+        """
+        with open(filename, "rb") as f:
+            self.upload_from_string(f.read(), **kwargs)
+
+    def download_as_bytes(self) -> bytes:
+        """
+        Returns object content
+        """
+        storage: FakeStorage = self.bucket.storage
+        stored = storage.get(self.bucket.name, self.name)
+        if stored is None:
+            storage.network.call()
+            raise NotFound(f"gs://{self.bucket.name}/{self.name}")
+        storage.network.call(len(stored[0]))
+        self._load(*stored)
+        return stored[0]
+
+    def delete(self, if_generation_match: Optional[int] = None) -> None:
+        """
+        Deletes object
+        """
+        self.bucket.storage.network.call()
+        self.bucket.storage.delete(self.bucket.name, self.name,
+                                   if_generation_match)
+
+
+class FakeBucket(object):
+    """
+    Bucket handle
+    """
+
+    def __init__(self, storage: FakeStorage, name: str) -> None:
+        self.storage = storage
+        self.name = name
+
+    def blob(self, name: str) -> FakeBlob:
+        """
+        Returns object handle without calling storage
+        """
+        return FakeBlob(self, name)
+
+    def get_blob(self, name: str) -> Optional[FakeBlob]:
+        """
+        Returns object with metadata, None if it is absent
+        """
+        self.storage.network.call()
+        stored = self.storage.get(self.name, name)
+        return None if stored is None \
+            else FakeBlob(self, name)._load(*stored)
+
+    def list_blobs(self, prefix: str = "", **kwargs) -> Iterator[FakeBlob]:
+        """
+        Returns objects with the prefix and their metadata
+        """
+        self.storage.network.call()
+        for name in self.storage.names(self.name, prefix):
+            stored = self.storage.get(self.name, name)
+            if stored is not None:
+                yield FakeBlob(self, name)._load(*stored)
+
+    def copy_blob(
+        self,
+        blob: FakeBlob,
+        destination_bucket: "FakeBucket",
+        new_name: str,
+    ) -> FakeBlob:
+        """
+        Copies object on the server side, no payload is transferred
+        """
+        self.storage.network.call()
+        stored = self.storage.get(self.name, blob.name)
+        if stored is None:
+            raise NotFound(f"gs://{self.name}/{blob.name}")
+        generation: int = self.storage.put(
+            destination_bucket.name, new_name, stored[0])
+        return FakeBlob(destination_bucket, new_name)._load(
+            stored[0], generation)
+
+
+class FakeStorageClient(object):
+    """
+    Replaces google.cloud.storage.Client
+    """
+
+    def __init__(self, project: str, storage: FakeStorage) -> None:
+        self.project = project
+        self.storage = storage
+        # client pool mounts its counting adapter here
+        self._http = Session()
+
+    def bucket(self, name: str) -> FakeBucket:
+        """
+        Returns bucket handle without calling storage
+        """
+        return FakeBucket(self.storage, name)
+
+    def get_bucket(self, name: str) -> FakeBucket:
+        """
+        Returns bucket handle after fetching its metadata
+        """
+        self.storage.network.call()
+        return FakeBucket(self.storage, name)
+
+
+class FakeSecretManagerClient(object):
+    """
+    Replaces SecretManagerServiceClient, every secret has the same
+    value
+    """
+
+    def __init__(self, network: Network, value: str) -> None:
+        self.network = network
+        self.value = value
+
+    def access_secret_version(self, request: Dict[str, str]) -> Any:
+        """
+        Returns secret version with the payload
+        """
+        self.network.call(len(self.value))
+        return SimpleNamespace(
+            name=self._resolve(request["name"]),
+            payload=SimpleNamespace(data=self.value.encode("utf-8")))
+
+    @staticmethod
+    def _resolve(name: str) -> str:
+        return name.replace("/versions/latest", "/versions/1")
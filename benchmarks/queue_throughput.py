@@ -0,0 +1,81 @@
+# coding=utf-8
+"""
+Measures work queue throughput by number of consumers. Each consumer
+stands for an instance with its own queue client, processing of a
+message is simulated by sleeping.
+
+Usage: python -m benchmarks.queue_throughput [--messages N]
+    [--work SECONDS] [--consumers 1,2,4,8]
+"""
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from json import dumps
+from tempfile import TemporaryDirectory
+from time import monotonic, sleep
+from typing import Dict, List, Optional
+
+from object_store import LocalObjectStore
+from work_queue import WorkQueue, Message
+
+
+def drain(store: LocalObjectStore, work: float) -> int:
+    """
+    Processes messages until the queue is empty, returns their number
+    """
+    queue = WorkQueue(store, "", visibility_timeout=60, max_attempts=3)
+    processed = 0
+    while True:
+        message: Optional[Message] = queue.lease()
+        if message is None:
+            return processed
+        sleep(work)
+        queue.ack(message)
+        processed += 1
+
+
+def measure(messages: int, consumers: int, work: float) -> Dict[str, float]:
+    """
+    Returns wall time and throughput of draining the messages
+    """
+    with TemporaryDirectory(prefix="queue-bench-") as d:
+        store = LocalObjectStore(d)
+        producer = WorkQueue(store, "", visibility_timeout=60,
+                             max_attempts=3)
+        for n in range(messages):
+            producer.enqueue({"n": n})
+        start: float = monotonic()
+        with ThreadPoolExecutor(max_workers=consumers) as e:
+            processed: int = sum(e.map(lambda _: drain(store, work),
+                                       range(consumers)))
+        seconds: float = monotonic() - start
+    if processed != messages:
+        raise RuntimeError(f"{processed} of {messages} are processed")
+    return {
+        "seconds": round(seconds, 3),
+        "messages_per_second": round(messages / seconds, 1),
+    }
+
+
+def main():
+    """
+    Entrypoint
+    """
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--work", type=float, default=0.05)
+    parser.add_argument("--consumers", default="1,2,4,8")
+    args = parser.parse_args()
+
+    counts: List[int] = [int(i) for i in args.consumers.split(",")]
+    results: Dict[str, Dict[str, float]] = {
+        str(c): measure(args.messages, c, args.work) for c in counts
+    }
+    base: float = results[str(counts[0])]["messages_per_second"]
+    for result in results.values():
+        result["speedup"] = round(result["messages_per_second"] / base, 2)
+    print(dumps({"messages": args.messages, "work": args.work,
+                 "consumers": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+# coding=utf-8
+"""
+Patches applied inside certbot processes. Subprocesses load them with
+sitecustomize from the site directory added to PYTHONPATH, in-process
+runners install them directly
+"""
+from atexit import register
+from json import dumps, loads
+from os import environ, pathsep
+from os.path import dirname, join, exists
+from resource import getrusage, RUSAGE_SELF, RUSAGE_CHILDREN
+from threading import Lock
+from time import monotonic
+from typing import Any, Dict, List, Optional, Set
+
+PROPAGATION_MODE_ENV = "CERTBOT_PROPAGATION_MODE"
+RUSAGE_FILE_ENV = "CERTBOT_RUSAGE_FILE"
+HTTP_FILE_ENV = "CERTBOT_HTTP_FILE"
+site_directory: str = join(dirname(__file__), "site")
+
+_installed: bool = False
+_http_lock = Lock()
+_http_calls: List[Dict[str, Any]] = []
+
+
+def hook_environment(
+    propagation_mode: str,
+    http_accounting: bool = False,
+    shared_propagation: bool = False,
+) -> Dict[str, str]:
+    """
+    Returns environment variables enabling hooks in certbot process,
+    empty if none of them is needed: HTTP accounting, adaptive or
+    shared propagation
+    """
+    if not http_accounting and not shared_propagation \
+            and propagation_mode != "adaptive":
+        return {}
+    path: List[str] = [site_directory]
+    if environ.get("PYTHONPATH"):
+        path.append(environ["PYTHONPATH"])
+    return {
+        "PYTHONPATH": pathsep.join(path),
+        PROPAGATION_MODE_ENV: propagation_mode,
+    }
+
+
+def install_hooks() -> None:
+    """
+    Patches certbot modules, repeated calls do nothing. Hooks check
+    the environment when called, so they follow the current job
+    """
+    global _installed
+    if _installed:
+        return
+    _installed = True
+    _install_propagation_hook()
+    _install_http_hook()
+    register(_write_process_reports)
+
+
+def resource_usage(
+    before: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
+    """
+    Returns resource usage of the current process and its waited
+    children, minus usage before if it's specified. Max RSS is the
+    peak of the process lifetime in kilobytes
+    """
+    own, children = getrusage(RUSAGE_SELF), getrusage(RUSAGE_CHILDREN)
+    usage: Dict[str, Any] = {
+        "user_cpu_seconds": own.ru_utime + children.ru_utime,
+        "system_cpu_seconds": own.ru_stime + children.ru_stime,
+        "max_rss_kb": max(own.ru_maxrss, children.ru_maxrss),
+        "voluntary_context_switches": own.ru_nvcsw + children.ru_nvcsw,
+        "involuntary_context_switches":
+            own.ru_nivcsw + children.ru_nivcsw,
+    }
+    if before is not None:
+        for key in usage:
+            if key != "max_rss_kb":
+                usage[key] -= before[key]
+    for key in ("user_cpu_seconds", "system_cpu_seconds"):
+        usage[key] = round(usage[key], 3)
+    return usage
+
+
+def process_usage(usage: Any) -> Dict[str, Any]:
+    """
+    Returns resource usage of a process waited by wait4 in the format
+    of resource_usage
+    """
+    return {
+        "user_cpu_seconds": round(usage.ru_utime, 3),
+        "system_cpu_seconds": round(usage.ru_stime, 3),
+        "max_rss_kb": usage.ru_maxrss,
+        "voluntary_context_switches": usage.ru_nvcsw,
+        "involuntary_context_switches": usage.ru_nivcsw,
+    }
+
+
+def http_calls(reset: bool = False) -> List[Dict[str, Any]]:
+    """
+    Returns HTTP requests recorded in the current process, optionally
+    forgetting them
+    """
+    global _http_calls
+    with _http_lock:
+        calls: List[Dict[str, Any]] = _http_calls
+        if reset:
+            _http_calls = []
+        return list(calls)
+
+
+def http_summary(calls: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Returns number of HTTP requests and their wall time per host with
+    counts by method and status
+    """
+    hosts: Dict[str, Dict[str, Any]] = {}
+    for call in calls:
+        host: Dict[str, Any] = hosts.setdefault(call["host"], {
+            "requests": 0,
+            "seconds": 0.0,
+            "max_seconds": 0.0,
+            "methods": {},
+            "statuses": {},
+        })
+        host["requests"] += 1
+        host["seconds"] += call["seconds"]
+        host["max_seconds"] = max(host["max_seconds"], call["seconds"])
+        for key, value in (("methods", call["method"]),
+                           ("statuses", call["status"])):
+            host[key][value] = host[key].get(value, 0) + 1
+    for host in hosts.values():
+        host["seconds"] = round(host["seconds"], 3)
+        host["max_seconds"] = round(host["max_seconds"], 3)
+    return {
+        "requests": len(calls),
+        "seconds": round(sum(c["seconds"] for c in calls), 3),
+        "hosts": hosts,
+    }
+
+
+def write_reports(usage: Dict[str, Any]) -> None:
+    """
+    Writes resource usage and recorded HTTP requests to the files
+    requested by certbot caller
+    """
+    for variable, report in ((RUSAGE_FILE_ENV, usage),
+                             (HTTP_FILE_ENV, http_calls())):
+        path: Optional[str] = environ.get(variable)
+        if path:
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(dumps(report))
+
+
+def read_report(path: str) -> Optional[Any]:
+    """
+    Returns report written by certbot process, None if it hasn't been
+    written, e.g. the process has been killed
+    """
+    if not exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return loads(f.read())
+
+
+def _write_process_reports() -> None:
+    # noinspection PyBroadException
+    try:
+        write_reports(resource_usage())
+    except Exception:
+        pass
+
+
+def _install_http_hook() -> None:
+    from http.client import HTTPConnection
+
+    original_putrequest = HTTPConnection.putrequest
+    original_getresponse = HTTPConnection.getresponse
+
+    def putrequest(self: Any, method: str, *args: Any,
+                   **kwargs: Any) -> Any:
+        self._certbot_request = (method, monotonic())
+        return original_putrequest(self, method, *args, **kwargs)
+
+    # clients built on http.client, i.e. urllib3, requests, httplib2
+    # and botocore, wait for the response with getresponse
+    def getresponse(self: Any) -> Any:
+        request: Optional[Any] = getattr(self, "_certbot_request", None)
+        self._certbot_request = None
+        status: str = "error"
+        try:
+            response: Any = original_getresponse(self)
+            status = str(response.status)
+            return response
+        finally:
+            if request is not None and environ.get(HTTP_FILE_ENV):
+                with _http_lock:
+                    _http_calls.append({
+                        "host": self.host,
+                        "method": request[0],
+                        "status": status,
+                        "seconds": round(monotonic() - request[1], 3),
+                    })
+
+    HTTPConnection.putrequest = putrequest
+    HTTPConnection.getresponse = getresponse
+
+
+def _install_propagation_hook() -> None:
+    # noinspection PyPackageRequirements
+    from certbot.plugins import dns_common
+
+    from propagation import PropagationGroup, parse_nameservers, \
+        wait_for_records
+
+    original_perform = dns_common.DNSAuthenticator.perform
+    fixed_sleep = dns_common.sleep
+
+    def perform(self: Any, achalls: List[Any]) -> List[Any]:
+        adaptive: bool = \
+            environ.get(PROPAGATION_MODE_ENV) == "adaptive"
+        group: Optional[PropagationGroup] = \
+            PropagationGroup.from_environment()
+        if not adaptive and group is None:
+            return original_perform(self, achalls)
+        records: Dict[str, Set[str]] = {}
+        for achall in achalls:
+            records.setdefault(
+                achall.validation_domain_name(achall.domain),
+                set()).add(achall.validation(achall.account_key))
+
+        # propagation-seconds becomes the upper bound of the wait
+        def propagate(seconds: float, expected: Dict[str, Set[str]]):
+            if not adaptive:
+                fixed_sleep(seconds)
+                return
+            wait_for_records(
+                expected,
+                timeout=seconds,
+                interval=float(
+                    environ.get("DNS_PROPAGATION_INTERVAL", "2")),
+                nameservers=parse_nameservers(
+                    environ.get("DNS_PROPAGATION_NAMESERVERS", "")),
+            )
+
+        def wait(seconds: float) -> None:
+            if group is None:
+                propagate(seconds, records)
+                return
+            group.release_publish()
+            group.wait(records, seconds,
+                       lambda expected: propagate(seconds, expected))
+
+        dns_common.sleep = wait
+        try:
+            if group is not None:
+                group.lock_publish()
+            return original_perform(self, achalls)
+        finally:
+            dns_common.sleep = fixed_sleep
+            if group is not None:
+                group.release_publish()
+
+    dns_common.DNSAuthenticator.perform = perform
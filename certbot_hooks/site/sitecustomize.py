@@ -0,0 +1,18 @@
+# coding=utf-8
+"""
+Installs certbot hooks in processes started with this directory in
+PYTHONPATH
+"""
+import sys
+from os.path import abspath, dirname
+
+# application modules are looked up after installed packages
+sys.path.append(dirname(dirname(dirname(abspath(__file__)))))
+
+# noinspection PyBroadException
+try:
+    from certbot_hooks import install_hooks
+
+    install_hooks()
+except Exception as e:
+    print(f"Failed to install certbot hooks: {e}", file=sys.stderr)
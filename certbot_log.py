@@ -0,0 +1,146 @@
+# coding=utf-8
+"""
+Timing of ACME protocol steps from certbot debug log
+"""
+import re
+from collections import namedtuple
+from datetime import datetime
+from gzip import compress
+from os.path import exists
+from typing import Any, Dict, Iterable, List, Optional
+from urllib.parse import urlparse
+
+LOG_FILE = "letsencrypt.log"
+
+AcmeStep = namedtuple("AcmeStep", "step offset seconds requests")
+
+_LINE = re.compile(
+    r"^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3}):[A-Z]+:[^:]*:(.*)$")
+_REQUEST = re.compile(r"^Sending \w+ request to (\S+?)[.:]?$")
+_MARKERS = (
+    ("Performing the following challenges", "challenge_setup"),
+    ("for DNS changes to propagate", "propagation_wait"),
+    ("Waiting for verification", "validation"),
+    ("Cleaning up challenges", "challenge_cleanup"),
+)
+# authorizations fetched before challenges are set up, later ones are
+# validation polling
+_BEFORE_CHALLENGES = ("startup", "account", "new_order", "authorization")
+
+
+def request_step(url: str, current: str) -> Optional[str]:
+    """
+    Returns step of ACME request to the url, None if the request
+    belongs to the current step
+    """
+    path: str = urlparse(url).path.lower()
+    if "nonce" in path:
+        return None
+    if "directory" in path or "acct" in path or "account" in path:
+        return "account"
+    if "new-order" in path or "neworder" in path:
+        return "new_order"
+    if "finalize" in path:
+        return "finalize"
+    if "chall" in path:
+        return "validation"
+    if "authz" in path:
+        return "authorization" if current in _BEFORE_CHALLENGES \
+            else "validation"
+    if "cert" in path:
+        return "certificate_download"
+    return None
+
+
+def parse_log(lines: Iterable[str]) -> List[AcmeStep]:
+    """
+    Splits certbot log into consecutive steps. A step lasts until the
+    next one starts, the last one lasts until the last log record.
+    Offsets are seconds since the first log record
+    """
+    steps: List[AcmeStep] = []
+    start: Optional[datetime] = None
+    step: str = "startup"
+    step_start: Optional[datetime] = None
+    requests: int = 0
+    last: Optional[datetime] = None
+    for line in lines:
+        match = _LINE.match(line.rstrip("\n"))
+        if match is None:
+            # continuation of multiline record, e.g. request body
+            continue
+        at: datetime = datetime.strptime(match.group(1),
+                                         "%Y-%m-%d %H:%M:%S,%f")
+        message: str = match.group(2)
+        if start is None:
+            start = step_start = at
+        last = at
+        request = _REQUEST.match(message)
+        if request is not None:
+            next_step: Optional[str] = \
+                request_step(request.group(1), step)
+        else:
+            next_step = next((s for marker, s in _MARKERS
+                              if marker in message), None)
+        if next_step is not None and next_step != step:
+            # e.g. no startup records before the first step
+            if at > step_start or requests:
+                steps.append(
+                    _step(step, start, step_start, at, requests))
+            step, step_start, requests = next_step, at, 0
+        if request is not None:
+            requests += 1
+    if start is None:
+        return []
+    steps.append(_step(step, start, step_start, last, requests))
+    return steps
+
+
+def _step(
+    name: str,
+    start: datetime,
+    step_start: datetime,
+    end: datetime,
+    requests: int,
+) -> AcmeStep:
+    return AcmeStep(
+        step=name,
+        offset=round((step_start - start).total_seconds(), 3),
+        seconds=round((end - step_start).total_seconds(), 3),
+        requests=requests,
+    )
+
+
+def summarize(steps: List[AcmeStep]) -> Dict[str, Any]:
+    """
+    Returns steps with total time and number of ACME requests per step
+    """
+    totals: Dict[str, float] = {}
+    for step in steps:
+        totals[step.step] = totals.get(step.step, 0.0) + step.seconds
+    return {
+        "seconds": round(sum(s.seconds for s in steps), 3),
+        "requests": sum(s.requests for s in steps),
+        "totals": {k: round(v, 3) for k, v in totals.items()},
+        "steps": [s._asdict() for s in steps],
+    }
+
+
+def analyze_log(path: str) -> Optional[Dict[str, Any]]:
+    """
+    Returns ACME steps summary of certbot log, None if the log hasn't
+    been written
+    """
+    if not exists(path):
+        return None
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        steps: List[AcmeStep] = parse_log(f)
+    return summarize(steps) if steps else None
+
+
+def compress_log(path: str, target: str) -> None:
+    """
+    Writes gzip compressed copy of the log
+    """
+    with open(path, "rb") as source, open(target, "wb") as f:
+        f.write(compress(source.read()))
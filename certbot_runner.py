@@ -0,0 +1,484 @@
+# coding=utf-8
+"""
+Execution of certbot inside warm worker processes
+"""
+import sys
+from abc import ABC, abstractmethod
+from logging import Handler, Logger, getLogger, info, exception
+# noinspection PyProtectedMember
+from multiprocessing.connection import Connection
+from multiprocessing import get_context
+from json import dumps
+from os import environ, dup2, open as open_fd, close, kill, wait4, \
+    waitstatus_to_exitcode, O_WRONLY, O_CREAT, O_TRUNC
+from signal import SIGKILL
+from subprocess import DEVNULL, PIPE, Popen, STDOUT, TimeoutExpired
+from tempfile import NamedTemporaryFile
+from threading import Lock, BoundedSemaphore, Event, Thread
+from time import monotonic
+from traceback import print_exc
+from typing import Any, List, Dict, Optional, Tuple, Union
+
+from certbot_hooks import RUSAGE_FILE_ENV, install_hooks, http_calls, \
+    process_usage, resource_usage, write_reports
+from providers import preloaded_modules
+
+
+def run_certbot_main(
+    argv: List[str],
+    output_path: str,
+    env: Dict[str, str],
+) -> int:
+    """
+    Runs certbot entry point in the current process with stdout and
+    stderr redirected to the file. Resource usage and HTTP requests of
+    the run are written to the files requested by the environment.
+    Returns exit code
+    """
+    before: Dict[str, Any] = resource_usage()
+    http_calls(reset=True)
+    environ.update(env)
+    install_hooks()
+    fd: int = open_fd(output_path, O_WRONLY | O_CREAT | O_TRUNC, 0o600)
+    dup2(fd, 1)
+    dup2(fd, 2)
+    close(fd)
+    code: Union[str, int, None]
+    # noinspection PyBroadException
+    try:
+        from certbot.main import main
+        code = main(argv)
+    except SystemExit as e:
+        code = e.code
+    except BaseException:
+        print_exc()
+        code = 1
+    if isinstance(code, str):
+        print(code, file=sys.stderr)
+        code = 1
+    sys.stdout.flush()
+    sys.stderr.flush()
+    # noinspection PyBroadException
+    try:
+        write_reports(resource_usage(before))
+    except Exception:
+        print_exc()
+    return code or 0
+
+
+def _run_in_child(
+    argv: List[str],
+    output_path: str,
+    env: Dict[str, str],
+) -> None:
+    sys.exit(run_certbot_main(argv, output_path, env))
+
+
+def _reset_logging(handlers: List[Handler], level: int) -> None:
+    """
+    Closes root logger handlers added by a certbot run and restores
+    logging state, so the next run of the worker doesn't write to logs
+    of previous ones
+    """
+    root: Logger = getLogger()
+    for handler in list(root.handlers):
+        if handler not in handlers:
+            root.removeHandler(handler)
+            # noinspection PyBroadException
+            try:
+                handler.close()
+            except Exception:
+                print_exc()
+    root.setLevel(level)
+    sys.excepthook = sys.__excepthook__
+
+
+def _serve(connection: Connection, max_jobs: int) -> None:
+    """
+    Worker process loop, runs up to max_jobs certbot invocations
+    received from the pool and exits
+    """
+    jobs: int = 0
+    while jobs < max_jobs:
+        try:
+            message: Optional[Tuple[List[str], str, Dict[str, str]]] = \
+                connection.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+        argv, output_path, env = message
+        saved: Dict[str, str] = dict(environ)
+        root: Logger = getLogger()
+        handlers: List[Handler] = list(root.handlers)
+        level: int = root.level
+        code: int = run_certbot_main(argv, output_path, env)
+        environ.clear()
+        environ.update(saved)
+        _reset_logging(handlers, level)
+        jobs += 1
+        connection.send(code)
+    connection.close()
+
+
+class CertbotRunner(ABC):
+    """
+    Runs certbot commands outside of the request thread
+    """
+
+    @abstractmethod
+    def warm(self) -> None:
+        """
+        Prepares processes so the first request doesn't pay for imports
+        """
+
+    @abstractmethod
+    def run(
+        self,
+        command: List[str],
+        timeout: int,
+        env: Optional[Dict[str, str]] = None,
+    ) -> Tuple[int, str]:
+        """
+        Runs certbot command, returns exit code and output like
+        utils.run_subprocess does
+        """
+
+    def shutdown(self) -> None:
+        """
+        Stops worker processes
+        """
+
+
+class SubprocessRunner(CertbotRunner):
+    """
+    Starts certbot executable for every invocation. Resource usage of
+    the process is collected by wait4 once it exits or is killed on
+    timeout and written to the file requested by the environment
+    """
+
+    def warm(self) -> None:
+        """
+        Nothing to prepare, the executable is started per invocation
+        """
+
+    def run(
+        self,
+        command: List[str],
+        timeout: int,
+        env: Optional[Dict[str, str]] = None,
+    ) -> Tuple[int, str]:
+        env = env or {}
+        process = Popen(command, stdin=DEVNULL, stdout=PIPE,
+                        stderr=STDOUT, universal_newlines=True,
+                        errors="backslashreplace", env={**environ, **env})
+        lines: List[str] = []
+        reader = Thread(target=_stream, args=(process.stdout, lines),
+                        name="certbot-output", daemon=True)
+        reader.start()
+        # the process is reaped by wait4 only, so its usage isn't lost
+        waited: List[Tuple[int, int, Any]] = []
+        waiter = Thread(target=lambda: waited.append(
+            wait4(process.pid, 0)), name="certbot-wait", daemon=True)
+        waiter.start()
+        waiter.join(timeout)
+        timed_out: bool = waiter.is_alive()
+        if timed_out:
+            kill(process.pid, SIGKILL)
+            waiter.join()
+        _, status, usage = waited[0]
+        process.returncode = waitstatus_to_exitcode(status)
+        # descendants killed with certbot may keep the output open
+        reader.join(1 if timed_out else None)
+        path: Optional[str] = env.get(RUSAGE_FILE_ENV)
+        if path:
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(dumps(process_usage(usage)))
+        out: str = "".join(lines)
+        if timed_out:
+            raise TimeoutExpired(command, timeout, out)
+        return process.returncode, out
+
+
+class InProcessRunner(CertbotRunner):
+    """
+    Runs every certbot invocation in a process forked from a
+    forkserver which has certbot, acme and DNS plugins imported
+    """
+
+    def __init__(self, preload: List[str]) -> None:
+        self._context = get_context("forkserver")
+        self._context.set_forkserver_preload(preload)
+
+    def warm(self) -> None:
+        """
+        Starts forkserver so the first request doesn't pay for imports
+        """
+        process = self._context.Process(target=int)
+        process.start()
+        process.join()
+
+    def run(
+        self,
+        command: List[str],
+        timeout: int,
+        env: Optional[Dict[str, str]] = None,
+    ) -> Tuple[int, str]:
+        with NamedTemporaryFile(prefix="certbot-out-") as output:
+            process = self._context.Process(
+                target=_run_in_child,
+                args=(command[1:], output.name, env or {}),
+                daemon=True,
+            )
+            process.start()
+            process.join(timeout)
+            if process.is_alive():
+                process.kill()
+                process.join()
+                raise TimeoutExpired(command, timeout, _read(output.name))
+            return process.exitcode, _read(output.name)
+
+
+class _Worker(object):
+    """
+    Pool side handle of a worker process
+    """
+
+    def __init__(self, process: Any, connection: Connection) -> None:
+        self.process = process
+        self.connection = connection
+        self.jobs = 0
+        self.idle_since = monotonic()
+
+
+class WorkerPool(CertbotRunner):
+    """
+    Keeps pre-started worker processes forked from a forkserver which
+    has certbot, acme and DNS plugins imported. A worker is replaced
+    after max_jobs invocations, so state leaked by certbot doesn't
+    pile up, and is stopped after idle_timeout seconds without work.
+    At most size invocations run at once, the rest wait for a worker
+    """
+
+    def __init__(
+        self,
+        preload: List[str],
+        size: int,
+        max_jobs: int,
+        idle_timeout: float,
+    ) -> None:
+        self._context = get_context("forkserver")
+        self._context.set_forkserver_preload(preload)
+        self.size = size
+        self.max_jobs = max_jobs
+        self.idle_timeout = idle_timeout
+        self._lock = Lock()
+        self._slots = BoundedSemaphore(size)
+        self._idle: List[_Worker] = []
+        self._workers = 0
+        self._closed = Event()
+        self._reaper: Optional[Thread] = None
+        self.started = 0
+        self.recycled = 0
+        self.reaped = 0
+
+    def warm(self) -> None:
+        """
+        Starts all workers and the idle workers reaper
+        """
+        self._replenish()
+        with self._lock:
+            if self.idle_timeout > 0 and self._reaper is None:
+                self._reaper = Thread(target=self._reap_idle,
+                                      name="certbot-pool-reaper",
+                                      daemon=True)
+                self._reaper.start()
+
+    def run(
+        self,
+        command: List[str],
+        timeout: int,
+        env: Optional[Dict[str, str]] = None,
+    ) -> Tuple[int, str]:
+        with self._slots:
+            worker: _Worker = self._acquire()
+            with NamedTemporaryFile(prefix="certbot-out-") as output:
+                worker.connection.send(
+                    (command[1:], output.name, env or {}))
+                if not worker.connection.poll(timeout):
+                    self._retire(worker, kill=True)
+                    raise TimeoutExpired(command, timeout,
+                                         _read(output.name))
+                try:
+                    code: int = worker.connection.recv()
+                except (EOFError, OSError):
+                    worker.process.join()
+                    code = worker.process.exitcode or 1
+                    self._retire(worker)
+                else:
+                    worker.jobs += 1
+                    self._release(worker)
+                return code, _read(output.name)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns workers counters
+        """
+        with self._lock:
+            return {
+                "workers": self._workers,
+                "idle": len(self._idle),
+                "started": self.started,
+                "recycled": self.recycled,
+                "reaped": self.reaped,
+            }
+
+    def shutdown(self) -> None:
+        self._closed.set()
+        with self._lock:
+            idle: List[_Worker] = self._idle
+            self._idle = []
+        for worker in idle:
+            self._retire(worker)
+        if self._reaper is not None:
+            self._reaper.join()
+
+    def _acquire(self) -> _Worker:
+        with self._lock:
+            worker: Optional[_Worker] = \
+                self._idle.pop() if self._idle else None
+            if worker is None:
+                self._workers += 1
+        if worker is None:
+            worker = self._spawn()
+        self._replenish_later()
+        return worker
+
+    def _release(self, worker: _Worker) -> None:
+        if self._closed.is_set():
+            self._retire(worker)
+            return
+        if worker.jobs >= self.max_jobs:
+            self._retire(worker)
+            with self._lock:
+                self.recycled += 1
+            self._replenish_later()
+            return
+        worker.idle_since = monotonic()
+        with self._lock:
+            self._idle.append(worker)
+
+    def _replenish_later(self) -> None:
+        with self._lock:
+            if self._workers >= self.size:
+                return
+        Thread(target=self._replenish, name="certbot-pool-start",
+               daemon=True).start()
+
+    def _replenish(self) -> None:
+        # noinspection PyBroadException
+        try:
+            while True:
+                with self._lock:
+                    if self._closed.is_set() \
+                            or self._workers >= self.size:
+                        return
+                    self._workers += 1
+                worker: _Worker = self._spawn()
+                with self._lock:
+                    self._idle.append(worker)
+        except Exception:
+            exception("Failed to start certbot worker")
+
+    def _spawn(self) -> _Worker:
+        try:
+            connection, child = self._context.Pipe()
+            process = self._context.Process(
+                target=_serve,
+                args=(child, self.max_jobs),
+                daemon=True,
+            )
+            process.start()
+            child.close()
+        except BaseException:
+            with self._lock:
+                self._workers -= 1
+            raise
+        with self._lock:
+            self.started += 1
+        return _Worker(process, connection)
+
+    def _retire(self, worker: _Worker, kill: bool = False) -> None:
+        if kill:
+            worker.process.kill()
+        elif worker.process.is_alive():
+            try:
+                worker.connection.send(None)
+            except OSError:
+                pass
+        worker.process.join()
+        worker.connection.close()
+        with self._lock:
+            self._workers -= 1
+
+    def _reap_idle(self) -> None:
+        interval: float = max(self.idle_timeout / 2, 0.1)
+        while not self._closed.wait(interval):
+            now: float = monotonic()
+            with self._lock:
+                expired: List[_Worker] = [
+                    w for w in self._idle
+                    if now - w.idle_since >= self.idle_timeout]
+                self._idle = [w for w in self._idle
+                              if w not in expired]
+                self.reaped += len(expired)
+            for worker in expired:
+                self._retire(worker)
+            if expired:
+                info(f"Stopped {len(expired)} idle certbot workers")
+
+
+def _stream(output: Any, lines: List[str]) -> None:
+    with output:
+        for line in output:
+            sys.stdout.write(line)
+            lines.append(line)
+
+
+def _read(path: str) -> str:
+    with open(path, "r", encoding="utf-8", errors="backslashreplace") \
+            as f:
+        return f.read()
+
+
+_runner: Optional[CertbotRunner] = None
+_runner_lock = Lock()
+_subprocess_runner = SubprocessRunner()
+
+
+def certbot_runner() -> CertbotRunner:
+    """
+    Returns runner configured by CERTBOT_EXECUTION environment
+    variable
+    """
+    global _runner
+    mode: str = environ.get("CERTBOT_EXECUTION", "subprocess")
+    if mode == "subprocess":
+        return _subprocess_runner
+    if mode not in ("inprocess", "pool"):
+        raise ValueError(f"Unknown certbot execution mode '{mode}'")
+    with _runner_lock:
+        if _runner is None:
+            info(f"Starting certbot runner in {mode} mode")
+            if mode == "inprocess":
+                _runner = InProcessRunner(preloaded_modules)
+            else:
+                _runner = WorkerPool(
+                    preloaded_modules,
+                    size=int(environ.get("CERTBOT_POOL_SIZE", "2")),
+                    max_jobs=int(
+                        environ.get("CERTBOT_POOL_MAX_JOBS", "10")),
+                    idle_timeout=float(
+                        environ.get("CERTBOT_POOL_IDLE_TIMEOUT", "600")),
+                )
+        return _runner
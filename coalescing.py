@@ -0,0 +1,91 @@
+# coding=utf-8
+"""
+Coalescing of identical concurrent requests
+"""
+from collections import OrderedDict
+from concurrent.futures import Future
+from threading import Lock
+from time import monotonic
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+
+class Coalescer(object):
+    """
+    Runs at most one call per key at a time, concurrent callers of the
+    same key wait for the in-flight call and get its result or
+    exception. Results are served to later callers for ttl seconds
+    """
+
+    def __init__(self, ttl: float, max_size: int) -> None:
+        self._ttl = ttl
+        self._max_size = max_size
+        self._lock = Lock()
+        self._in_flight: Dict[Hashable, Future] = {}
+        self._done: "OrderedDict[Hashable, Tuple[Any, float]]" = \
+            OrderedDict()
+        self.executed = 0
+        self.coalesced = 0
+        self.cached = 0
+
+    def run(
+        self,
+        key: Hashable,
+        fn: Callable[..., Any],
+        *args,
+    ) -> Tuple[Any, bool]:
+        """
+        Returns result of fn(*args) and whether it was obtained by
+        another call
+        """
+        with self._lock:
+            done: Optional[Tuple[Any, float]] = self._done.get(key)
+            if done is not None and monotonic() - done[1] < self._ttl:
+                self.cached += 1
+                return done[0], True
+            future: Optional[Future] = self._in_flight.get(key)
+            owner: bool = future is None
+            if owner:
+                future = self._in_flight[key] = Future()
+                self.executed += 1
+            else:
+                self.coalesced += 1
+        if not owner:
+            return future.result(), True
+        try:
+            result: Any = fn(*args)
+        except BaseException as e:
+            with self._lock:
+                del self._in_flight[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            del self._in_flight[key]
+            if self._ttl > 0:
+                self._done[key] = (result, monotonic())
+                self._done.move_to_end(key)
+                while len(self._done) > self._max_size:
+                    self._done.popitem(last=False)
+        future.set_result(result)
+        return result, False
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns coalescing counters
+        """
+        with self._lock:
+            return {
+                "in_flight": len(self._in_flight),
+                "executed": self.executed,
+                "coalesced": self.coalesced,
+                "cached": self.cached,
+            }
+
+    def clear(self) -> None:
+        """
+        Drops cached results and counters
+        """
+        with self._lock:
+            self._done.clear()
+            self.executed = 0
+            self.coalesced = 0
+            self.cached = 0
@@ -3,15 +3,21 @@
 Request / response classes
 """
 from dataclasses import dataclass
-from typing import List, Optional, Type, Dict
+from os import getenv
+from os.path import normpath
+from typing import List, Optional, Type, Dict, Tuple
 
 from flask import Request
 from marshmallow import Schema, fields, validate, post_load, \
     ValidationError, validates
 from marshmallow.validate import OneOf
 
+from planner import plan_domains
 from providers import providers
 
+# number of names the CA allows in one certificate
+MAX_NAMES: int = int(getenv("CERT_MAX_NAMES", "100"))
+
 
 def validation_errors(cls: Type) -> Dict[str, str]:
     """
@@ -41,6 +47,28 @@ class CertbotRequest(object):
     target_bucket: str
     target_bucket_path: str
     propagation_seconds: Optional[int] = None
+    renew_before_days: Optional[int] = None
+    publish_mode: str = "upload"
+    propagation_mode: str = "fixed"
+    plan_only: bool = False
+    drop_covered: bool = False
+
+    def canonical_key(self) -> Tuple[str, str, Tuple[str, ...], str, str,
+                                     Optional[int], str]:
+        """
+        Returns key of requests issuing the same certificate to the
+        same location with the same renewal and publishing options
+        """
+        return (
+            self.provider,
+            self.project,
+            tuple(sorted(
+                plan_domains(self.domains, self.drop_covered).domains)),
+            self.target_bucket,
+            normpath(self.target_bucket_path),
+            self.renew_before_days,
+            self.publish_mode,
+        )
 
     @staticmethod
     def from_request(req: Request) -> "CertbotRequest":
@@ -52,6 +80,18 @@ class CertbotRequest(object):
             raise ValidationError("Request json is absent or invalid!")
         return CertbotRequestSchema().load(json)
 
+    @staticmethod
+    def from_batch_request(req: Request) -> List["CertbotRequest"]:
+        """
+        Parses request with list of requests
+        """
+        json = req.get_json(silent=True, force=True)
+        if json is None:
+            raise ValidationError("Request json is absent or invalid!")
+        if not isinstance(json, list) or len(json) < 1:
+            raise ValidationError("Requests list can't be empty!")
+        return CertbotRequestSchema(many=True).load(json)
+
 
 class CertbotRequestSchema(Schema):
     """
@@ -84,6 +124,41 @@ class CertbotRequestSchema(Schema):
         missing=60,
         data_key="propagation_seconds",
         error_messages=validation_errors(CertbotRequest))
+    renew_before_days = fields.Int(
+        required=False,
+        allow_none=True,
+        validate=validate.Range(min=1,
+                                error="Value must be greater than 0"),
+        default=None,
+        missing=None,
+        data_key="renew_before_days",
+        error_messages=validation_errors(CertbotRequest))
+    publish_mode = fields.Str(
+        required=False,
+        validate=OneOf(["upload", "copy"]),
+        default="upload",
+        missing="upload",
+        data_key="publish_mode",
+        error_messages=validation_errors(CertbotRequest))
+    propagation_mode = fields.Str(
+        required=False,
+        validate=OneOf(["fixed", "adaptive"]),
+        default="fixed",
+        missing="fixed",
+        data_key="propagation_mode",
+        error_messages=validation_errors(CertbotRequest))
+    plan_only = fields.Bool(
+        required=False,
+        default=False,
+        missing=False,
+        data_key="plan_only",
+        error_messages=validation_errors(CertbotRequest))
+    drop_covered = fields.Bool(
+        required=False,
+        default=False,
+        missing=False,
+        data_key="drop_covered",
+        error_messages=validation_errors(CertbotRequest))
     email = fields.Email(
         required=True,
         data_key="email",
@@ -115,6 +190,20 @@ class CertbotRequestSchema(Schema):
             raise ValidationError(
                 "Domains list can't contain duplicates!")
 
+    @validates('domains')
+    def validate_domain_names(self, value):
+        """
+        Validates domain names and their number after normalization
+        """
+        try:
+            planned: List[str] = plan_domains(value).domains
+        except ValueError as e:
+            raise ValidationError(str(e))
+        if len(planned) > MAX_NAMES:
+            raise ValidationError(
+                f"Domains list can't contain more than {MAX_NAMES} "
+                f"names!")
+
     # noinspection PyUnusedLocal
     @post_load
     def make_entity(self, data, **kwargs):
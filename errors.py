@@ -2,7 +2,7 @@
 """
 Business logic exceptions
 """
-from typing import Union, List
+from typing import Any, Dict, Union, List, Optional, Tuple
 
 
 class ManagedException(Exception):
@@ -27,6 +27,9 @@ class CertbotError(ManagedException):
     cmd: Union[str, List[str]]
     timeout: float
     output: str
+    rusage: Optional[Dict[str, Any]]
+    acme: Optional[Dict[str, Any]]
+    http: Optional[Dict[str, Any]]
 
     def __init__(
         self,
@@ -34,11 +37,17 @@ class CertbotError(ManagedException):
         timeout: float,
         output: str,
         *args: object,
+        rusage: Optional[Dict[str, Any]] = None,
+        acme: Optional[Dict[str, Any]] = None,
+        http: Optional[Dict[str, Any]] = None,
     ) -> None:
         super().__init__(*args)
         self.cmd = cmd
         self.timeout = timeout
         self.output = output
+        self.rusage = rusage
+        self.acme = acme
+        self.http = http
 
 
 class GCSError(ManagedException):
@@ -63,16 +72,19 @@ class GCSUploadError(GCSError):
     """
     source_path: str
     bucket_path: str
+    failures: Optional[List[Tuple[str, str]]]
 
     def __init__(
         self, source_path: str,
         bucket_name: str,
         bucket_path: str,
-        *args: object
+        *args: object,
+        failures: Optional[List[Tuple[str, str]]] = None,
     ) -> None:
         super().__init__(bucket_name, *args)
         self.source_path = source_path
         self.bucket_path = bucket_path
+        self.failures = failures
 
 
 class CertbotTimeoutError(CertbotError):
@@ -86,5 +98,95 @@ class CertbotTimeoutError(CertbotError):
         timeout: float,
         output: str,
         *args: object,
+        rusage: Optional[Dict[str, Any]] = None,
+        acme: Optional[Dict[str, Any]] = None,
+        http: Optional[Dict[str, Any]] = None,
     ) -> None:
-        super().__init__(cmd=cmd, timeout=timeout, output=output, *args)
+        super().__init__(cmd=cmd, timeout=timeout, output=output, *args,
+                         rusage=rusage, acme=acme, http=http)
+
+
+class JobNotFoundError(ManagedException):
+    """
+    Intended to be thrown when requested job is unknown
+    """
+    job_id: str
+
+    def __init__(
+        self,
+        job_id: str,
+        *args: object
+    ) -> None:
+        super().__init__(*args)
+        self.job_id = job_id
+
+
+class IdempotencyKeyReusedError(ManagedException):
+    """
+    Intended to be thrown when idempotency key is sent with a request
+    different from the one it was first used with
+    """
+    key: str
+
+    def __init__(
+        self,
+        key: str,
+        *args: object
+    ) -> None:
+        super().__init__(*args)
+        self.key = key
+
+
+class CertificateLockedError(ManagedException):
+    """
+    Intended to be thrown when certificate is being issued by another
+    instance
+    """
+    lock_path: str
+    owner: str
+
+    def __init__(
+        self,
+        lock_path: str,
+        owner: str,
+        *args: object
+    ) -> None:
+        super().__init__(*args)
+        self.lock_path = lock_path
+        self.owner = owner
+
+
+class QueueNotConfiguredError(ManagedException):
+    """
+    Intended to be thrown when work queue is used without QUEUE_URL
+    """
+    pass
+
+
+class AdmissionError(ManagedException):
+    """
+    Base class of errors thrown when issuance work is not admitted
+    """
+    retry_after: int
+
+    def __init__(
+        self,
+        retry_after: int,
+        *args: object
+    ) -> None:
+        super().__init__(*args)
+        self.retry_after = retry_after
+
+
+class ServerBusyError(AdmissionError):
+    """
+    Intended to be thrown when all synchronous issuance slots are busy
+    """
+    pass
+
+
+class JobQueueFullError(AdmissionError):
+    """
+    Intended to be thrown when too many jobs are not finished yet
+    """
+    pass
@@ -0,0 +1,146 @@
+# coding=utf-8
+"""
+Shared GCS clients, bucket handles and upload workers
+"""
+from concurrent.futures import ThreadPoolExecutor
+from logging import info
+from os import getenv
+from threading import Lock
+from time import monotonic
+from typing import Any, Callable, Dict, List, Tuple
+
+# noinspection PyPackageRequirements
+from google.cloud.storage import Bucket, Client
+from requests.adapters import HTTPAdapter
+
+
+class CountingAdapter(HTTPAdapter):
+    """
+    HTTP adapter exposing connection pool usage
+    """
+
+    def connections(self) -> Tuple[int, int]:
+        """
+        Returns number of opened connections and sent requests
+        """
+        opened, requests = 0, 0
+        pools = self.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is not None:
+                opened += pool.num_connections
+                requests += pool.num_requests
+        return opened, requests
+
+
+class ClientPool(object):
+    """
+    Keeps one authorized client per project with HTTP connection pool
+    sized to upload concurrency, and caches bucket handles for
+    bucket_ttl seconds
+    """
+
+    def __init__(
+        self,
+        client_factory: Callable[[str], Client],
+        pool_size: int,
+        bucket_ttl: float,
+    ) -> None:
+        self._client_factory = client_factory
+        self.pool_size = pool_size
+        self.bucket_ttl = bucket_ttl
+        self._lock = Lock()
+        self._clients: Dict[str, Client] = {}
+        self._adapters: List[CountingAdapter] = []
+        self._buckets: Dict[Tuple[str, str], Tuple[Bucket, float]] = {}
+        self.clients_created = 0
+        self.clients_reused = 0
+        self.buckets_fetched = 0
+        self.buckets_reused = 0
+
+    def client(self, project: str) -> Client:
+        """
+        Returns shared client for the project
+        """
+        with self._lock:
+            client: Client = self._clients.get(project)
+            if client is not None:
+                self.clients_reused += 1
+                return client
+            info(f"Creating GCS client for project {project}")
+            client = self._client_factory(project)
+            adapter = CountingAdapter(pool_connections=4,
+                                      pool_maxsize=self.pool_size)
+            # noinspection PyProtectedMember
+            client._http.mount("https://", adapter)
+            self._adapters.append(adapter)
+            self._clients[project] = client
+            self.clients_created += 1
+            return client
+
+    def bucket(self, project: str, bucket_name: str) -> Bucket:
+        """
+        Returns bucket handle, fetching bucket metadata only if cached
+        handle is absent or expired
+        """
+        key: Tuple[str, str] = (project, bucket_name)
+        with self._lock:
+            cached = self._buckets.get(key)
+            if cached is not None \
+                    and monotonic() - cached[1] < self.bucket_ttl:
+                self.buckets_reused += 1
+                return cached[0]
+        bucket: Bucket = self.client(project).get_bucket(bucket_name)
+        with self._lock:
+            self._buckets[key] = (bucket, monotonic())
+            self.buckets_fetched += 1
+        return bucket
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Returns clients, buckets and connections usage counters
+        """
+        with self._lock:
+            opened, requests = 0, 0
+            for adapter in self._adapters:
+                adapter_opened, adapter_requests = adapter.connections()
+                opened += adapter_opened
+                requests += adapter_requests
+            return {
+                "clients_created": self.clients_created,
+                "clients_reused": self.clients_reused,
+                "buckets_fetched": self.buckets_fetched,
+                "buckets_reused": self.buckets_reused,
+                "connections_opened": opened,
+                "connections_reused": max(requests - opened, 0),
+            }
+
+    def clear(self) -> None:
+        """
+        Drops clients, bucket handles and counters
+        """
+        with self._lock:
+            for adapter in self._adapters:
+                adapter.close()
+            self._clients.clear()
+            self._adapters.clear()
+            self._buckets.clear()
+            self.clients_created = 0
+            self.clients_reused = 0
+            self.buckets_fetched = 0
+            self.buckets_reused = 0
+
+
+upload_concurrency: int = int(getenv("GCS_UPLOAD_CONCURRENCY", "8"))
+skip_unchanged: bool = \
+    getenv("GCS_SKIP_UNCHANGED", "true").lower() == "true"
+
+clients = ClientPool(
+    lambda project: Client(project),
+    pool_size=upload_concurrency,
+    bucket_ttl=float(getenv("GCS_BUCKET_TTL", "300")),
+)
+
+# shared by all requests to bound the overall upload concurrency
+uploads = ThreadPoolExecutor(max_workers=upload_concurrency,
+                             thread_name_prefix="upload")
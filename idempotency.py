@@ -0,0 +1,176 @@
+# coding=utf-8
+"""
+Results of requests sent with idempotency keys
+"""
+from collections import OrderedDict, namedtuple
+from hashlib import sha256
+from json import dumps, loads
+from logging import info, exception
+from os.path import join
+from threading import Lock
+from time import time
+from typing import Any, Dict, Optional
+
+# noinspection PyPackageRequirements
+from google.api_core.exceptions import NotFound
+
+from dto import CertbotRequest
+from errors import IdempotencyKeyReusedError
+from gcs import clients
+
+IdempotencyRecord = namedtuple("IdempotencyRecord",
+                               "fingerprint "
+                               "status "
+                               "response "
+                               "stored_at")
+
+
+def fingerprint(req: CertbotRequest) -> str:
+    """
+    Returns hash of all request parameters
+    """
+    return sha256(dumps(vars(req), sort_keys=True).encode("utf-8")) \
+        .hexdigest()
+
+
+def object_path(key: str, req: CertbotRequest) -> str:
+    """
+    Returns GCS path of the key record
+    """
+    return join(req.target_bucket_path, ".idempotency",
+                f"{sha256(key.encode('utf-8')).hexdigest()}.json")
+
+
+class IdempotencyStore(object):
+    """
+    Keeps responses by idempotency key for retention seconds in
+    memory with LRU eviction and, if persist is set, as small objects
+    under <target_bucket_path>/.idempotency/ so they survive restarts
+    """
+
+    def __init__(self, retention: float, max_size: int, persist: bool):
+        self._retention = retention
+        self._max_size = max_size
+        self._persist = persist
+        self._lock = Lock()
+        self._records: "OrderedDict[str, IdempotencyRecord]" = \
+            OrderedDict()
+
+    def get(
+        self,
+        key: str,
+        req: CertbotRequest,
+    ) -> Optional[IdempotencyRecord]:
+        """
+        Returns stored response of the key. Raises an error if the key
+        was used with another request
+        """
+        with self._lock:
+            record: Optional[IdempotencyRecord] = self._records.get(key)
+            if record is not None:
+                self._records.move_to_end(key)
+        if record is None and self._persist:
+            record = self._load(key, req)
+            if record is not None:
+                self._remember(key, record)
+        if record is None or time() - record.stored_at > self._retention:
+            return None
+        if record.fingerprint != fingerprint(req):
+            raise IdempotencyKeyReusedError(key)
+        return record
+
+    def put(
+        self,
+        key: str,
+        req: CertbotRequest,
+        response: Dict[str, Any],
+        status: int,
+    ) -> None:
+        """
+        Stores final response of the key
+        """
+        record = IdempotencyRecord(fingerprint(req), status, response,
+                                   time())
+        self._remember(key, record)
+        if self._persist:
+            self._save(key, req, record)
+
+    def put_pending(
+        self,
+        key: str,
+        req: CertbotRequest,
+        response: Dict[str, Any],
+        status: int,
+    ) -> None:
+        """
+        Stores response of the key being processed in memory unless
+        final response is already stored
+        """
+        record = IdempotencyRecord(fingerprint(req), status, response,
+                                   time())
+        self._remember(key, record, replace=False)
+
+    def discard(self, key: str) -> None:
+        """
+        Drops record of the key kept in memory, e.g. pending response
+        of a job failed with a server error
+        """
+        with self._lock:
+            self._records.pop(key, None)
+
+    def clear(self) -> None:
+        """
+        Drops records kept in memory
+        """
+        with self._lock:
+            self._records.clear()
+
+    def _remember(
+        self,
+        key: str,
+        record: IdempotencyRecord,
+        replace: bool = True,
+    ) -> None:
+        with self._lock:
+            if replace or key not in self._records:
+                self._records[key] = record
+            self._records.move_to_end(key)
+            while len(self._records) > self._max_size:
+                self._records.popitem(last=False)
+
+    def _load(
+        self,
+        key: str,
+        req: CertbotRequest,
+    ) -> Optional[IdempotencyRecord]:
+        path: str = object_path(key, req)
+        # noinspection PyBroadException
+        try:
+            data: bytes = clients.bucket(req.project, req.target_bucket) \
+                .blob(path).download_as_bytes()
+            return IdempotencyRecord(**loads(data))
+        except NotFound:
+            return None
+        except Exception:
+            exception(f"Failed to load idempotency record "
+                      f"gs://{req.target_bucket}/{path}")
+            return None
+
+    def _save(
+        self,
+        key: str,
+        req: CertbotRequest,
+        record: IdempotencyRecord,
+    ) -> None:
+        path: str = object_path(key, req)
+        # noinspection PyBroadException
+        try:
+            clients.bucket(req.project, req.target_bucket) \
+                .blob(path).upload_from_string(
+                    dumps(record._asdict()),
+                    content_type="application/json")
+            info(f"Idempotency record saved to "
+                 f"gs://{req.target_bucket}/{path}")
+        except Exception:
+            exception(f"Failed to save idempotency record "
+                      f"gs://{req.target_bucket}/{path}")
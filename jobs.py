@@ -0,0 +1,197 @@
+# coding=utf-8
+"""
+Background execution of issuance requests
+"""
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from dataclasses import dataclass, field
+from datetime import datetime
+from logging import info, exception
+from threading import Lock
+from time import monotonic
+from typing import Any, Callable, Dict, Optional, Tuple
+from uuid import uuid4
+
+from pytz import UTC
+
+from phases import PhaseRecorder, recording
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+
+@dataclass
+class Job(object):
+    """
+    Issuance job state
+    """
+    id: str
+    request: Any
+    status: str = QUEUED
+    submitted_at: datetime = field(
+        default_factory=lambda: datetime.now(tz=UTC))
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    phases: PhaseRecorder = field(default_factory=PhaseRecorder)
+    result: Optional[Dict[str, Any]] = None
+    error: Optional[Dict[str, Any]] = None
+
+    @property
+    def finished(self) -> bool:
+        """
+        Whether job has completed with either outcome
+        """
+        return self.status in (SUCCEEDED, FAILED)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        Returns job representation for API responses
+        """
+        rsp: Dict[str, Any] = {
+            "job_id": self.id,
+            "status": self.status,
+            "submitted_at": self.submitted_at.isoformat(),
+            "started_at": self.started_at.isoformat()
+            if self.started_at else None,
+            "finished_at": self.finished_at.isoformat()
+            if self.finished_at else None,
+            "timings": self.phases.as_dict(),
+        }
+        if self.status == SUCCEEDED:
+            rsp["success"] = True
+            rsp["result"] = self.result
+        elif self.status == FAILED:
+            rsp["success"] = False
+            rsp["error"] = self.error
+        return rsp
+
+
+class JobQueue(object):
+    """
+    Runs submitted requests on a bounded worker pool and keeps
+    track of their state
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[Any], Dict[str, Any]],
+        error_handler: Callable[[Exception],
+                                Tuple[Dict[str, Any], int]],
+        workers: int,
+        retention: int,
+    ) -> None:
+        self._handler = handler
+        self._error_handler = error_handler
+        self._workers = workers
+        self._retention = retention
+        self._lock = Lock()
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    @property
+    def workers(self) -> int:
+        """
+        Number of jobs executed concurrently
+        """
+        return self._workers
+
+    @property
+    def depth(self) -> int:
+        """
+        Number of jobs which are not finished yet
+        """
+        with self._lock:
+            return sum(1 for j in self._jobs.values()
+                       if not j.finished)
+
+    def submit(
+        self,
+        request: Any,
+        handler: Optional[Callable[[Any], Dict[str, Any]]] = None,
+    ) -> Job:
+        """
+        Puts request to the queue, returns immediately. Request is
+        processed with the queue handler unless handler is specified
+        """
+        job: Job = self.create(request)
+        self.start(job, handler)
+        return job
+
+    def create(self, request: Any) -> Job:
+        """
+        Registers queued job of the request without running it, so
+        its state can be stored before the job may finish
+        """
+        job = Job(id=str(uuid4()), request=request)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._evict()
+        return job
+
+    def start(
+        self,
+        job: Job,
+        handler: Optional[Callable[[Any], Dict[str, Any]]] = None,
+    ) -> None:
+        """
+        Runs created job with the queue handler unless handler is
+        specified
+        """
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self._workers,
+                    thread_name_prefix="job")
+            executor = self._executor
+        submitted: float = monotonic()
+        # spans of the job continue trace of the submitting request
+        executor.submit(copy_context().run, self._run, job, submitted,
+                        handler or self._handler)
+        info(f"Job {job.id} is queued")
+
+    def get(self, job_id: str) -> Optional[Job]:
+        """
+        Returns job by id
+        """
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def shutdown(self) -> None:
+        """
+        Stops accepting jobs, running ones are not interrupted
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    def _run(
+        self,
+        job: Job,
+        submitted: float,
+        handler: Callable[[Any], Dict[str, Any]],
+    ) -> None:
+        job.phases.add("queued", monotonic() - submitted)
+        job.started_at = datetime.now(tz=UTC)
+        job.status = RUNNING
+        info(f"Job {job.id} is started")
+        # noinspection PyBroadException
+        try:
+            with recording(job.phases):
+                job.result = handler(job.request)
+            job.status = SUCCEEDED
+            info(f"Job {job.id} has succeeded")
+        except Exception as e:
+            exception(f"Job {job.id} has failed")
+            job.error = self._error_handler(e)[0]["error"]
+            job.status = FAILED
+        finally:
+            job.finished_at = datetime.now(tz=UTC)
+
+    def _evict(self) -> None:
+        finished = [k for k, v in self._jobs.items() if v.finished]
+        for k in finished[:max(len(self._jobs) - self._retention, 0)]:
+            del self._jobs[k]
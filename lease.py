@@ -0,0 +1,152 @@
+# coding=utf-8
+"""
+Lease based lock shared by instances through an object store
+"""
+from json import dumps, loads
+from logging import info, warning, exception
+from os import getpid
+from socket import gethostname
+from threading import Event, Thread
+from time import time, monotonic, sleep
+from typing import Optional
+from uuid import uuid4
+
+from errors import CertificateLockedError
+from object_store import ObjectStore
+
+
+class Lease(object):
+    """
+    Lock object holding owner and expiration time. The owner renews it
+    every heartbeat seconds, other owners may take it over once it's
+    expired, e.g. if the owner instance has been stopped
+    """
+
+    def __init__(
+        self,
+        store: ObjectStore,
+        path: str,
+        ttl: float,
+        heartbeat: float,
+        owner: Optional[str] = None,
+    ) -> None:
+        self.store = store
+        self.path = path
+        self.ttl = ttl
+        self.heartbeat = heartbeat
+        self.owner = owner or f"{gethostname()}-{getpid()}-{uuid4()}"
+        self.lost = False
+        self.contended = False
+        self._generation: Optional[int] = None
+        self._renewed_at: float = 0
+        self._stop = Event()
+        self._heartbeat: Optional[Thread] = None
+
+    def acquire(self, wait: float, interval: float = 1) -> bool:
+        """
+        Takes the lease waiting at most wait seconds, returns whether
+        it has been held by another owner. Raises an error if the
+        lease is still held after wait seconds
+        """
+        deadline: float = monotonic() + wait
+        contended = False
+        while True:
+            holder: Optional[str] = self._try_acquire()
+            if holder is None:
+                break
+            remaining: float = deadline - monotonic()
+            if remaining <= 0:
+                raise CertificateLockedError(self.path, holder)
+            contended = True
+            sleep(min(interval, remaining))
+        info(f"Lease {self.path} is acquired by {self.owner}")
+        self.contended = contended
+        self._renewed_at = monotonic()
+        self._stop.clear()
+        self._heartbeat = Thread(target=self._renew,
+                                 name="lease-heartbeat",
+                                 daemon=True)
+        self._heartbeat.start()
+        return contended
+
+    def ensure_held(self) -> None:
+        """
+        Raises an error if the lease has been lost or hasn't been
+        renewed for ttl seconds, so it may be taken over
+        """
+        if not self.lost and monotonic() - self._renewed_at < self.ttl:
+            return
+        holder: str = "unknown"
+        # noinspection PyBroadException
+        try:
+            current = self.store.read(self.path)
+            if current is not None:
+                holder = loads(current[0])["owner"]
+        except Exception:
+            exception(f"Unable to read lease {self.path}")
+        warning(f"Lease {self.path} of {self.owner} is not held")
+        raise CertificateLockedError(self.path, holder)
+
+    def release(self) -> None:
+        """
+        Stops renewal and deletes the lease unless it has been taken
+        over. Failures are logged only, the lease expires anyway
+        """
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+            self._heartbeat = None
+        if self.lost or self._generation is None:
+            return
+        # noinspection PyBroadException
+        try:
+            self.store.delete(self.path, self._generation)
+            info(f"Lease {self.path} is released by {self.owner}")
+        except Exception:
+            exception(f"Unable to release lease {self.path}")
+        self._generation = None
+
+    def _try_acquire(self) -> Optional[str]:
+        generation: Optional[int] = self.store.create(
+            self.path, self._record())
+        if generation is not None:
+            self._generation = generation
+            return None
+        current = self.store.read(self.path)
+        if current is None:
+            # released meanwhile
+            return self._try_acquire()
+        data, generation = current
+        record = loads(data)
+        if record["expires_at"] > time():
+            return record["owner"]
+        generation = self.store.replace(
+            self.path, self._record(), generation)
+        if generation is None:
+            return record["owner"]
+        info(f"Expired lease {self.path} of {record['owner']} "
+             f"is taken over")
+        self._generation = generation
+        return None
+
+    def _renew(self) -> None:
+        while not self._stop.wait(self.heartbeat):
+            # noinspection PyBroadException
+            try:
+                generation: Optional[int] = self.store.replace(
+                    self.path, self._record(), self._generation)
+            except Exception:
+                exception(f"Unable to renew lease {self.path}")
+                continue
+            if generation is None:
+                warning(f"Lease {self.path} is lost by {self.owner}")
+                self.lost = True
+                return
+            self._generation = generation
+            self._renewed_at = monotonic()
+
+    def _record(self) -> bytes:
+        return dumps({
+            "owner": self.owner,
+            "expires_at": time() + self.ttl,
+        }).encode("utf-8")
@@ -0,0 +1,238 @@
+# coding=utf-8
+"""
+Prometheus metrics of issuance phases, errors and certbot HTTP
+requests
+"""
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+from typing import Callable, Dict, Iterator, List, Mapping, Sequence, \
+    Tuple
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+PHASE_BUCKETS: Tuple[float, ...] = (
+    0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600,
+)
+
+
+def escape(value: str) -> str:
+    """
+    Escapes label value
+    """
+    return value.replace("\\", "\\\\").replace("\n", "\\n") \
+        .replace('"', '\\"')
+
+
+def format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    """
+    Returns labels in exposition format
+    """
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{escape(v)}"'
+                          for n, v in zip(names, values)) + "}"
+
+
+class Counter(object):
+    """
+    Monotonic counter by label values
+    """
+
+    def __init__(self, name: str, description: str,
+                 labels: Sequence[str]) -> None:
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._lock = Lock()
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *values: str, amount: float = 1) -> None:
+        """
+        Increments counter of the label values
+        """
+        with self._lock:
+            self._values[values] = self._values.get(values, 0) + amount
+
+    def render(self) -> List[str]:
+        """
+        Returns exposition lines
+        """
+        lines: List[str] = [f"# HELP {self.name} {self.description}",
+                            f"# TYPE {self.name} counter"]
+        with self._lock:
+            for values, value in sorted(self._values.items()):
+                lines.append(f"{self.name}"
+                             f"{format_labels(self.labels, values)} "
+                             f"{value:g}")
+        return lines
+
+    def clear(self) -> None:
+        """
+        Drops recorded values
+        """
+        with self._lock:
+            self._values.clear()
+
+
+class Histogram(object):
+    """
+    Histogram of observed values by label values
+    """
+
+    def __init__(self, name: str, description: str,
+                 labels: Sequence[str],
+                 buckets: Sequence[float]) -> None:
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._lock = Lock()
+        # per bucket counts, the last one is +Inf, and sum
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], float]] = {}
+
+    def observe(self, value: float, *values: str) -> None:
+        """
+        Adds observation of the label values
+        """
+        index: int = bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(values) or \
+                ([0] * (len(self.buckets) + 1), 0.0)
+            counts[index] += 1
+            self._values[values] = (counts, total + value)
+
+    def render(self) -> List[str]:
+        """
+        Returns exposition lines
+        """
+        lines: List[str] = [f"# HELP {self.name} {self.description}",
+                            f"# TYPE {self.name} histogram"]
+        names: Tuple[str, ...] = self.labels + ("le",)
+        with self._lock:
+            for values, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),),
+                                        counts):
+                    cumulative += count
+                    le: str = "+Inf" if bound == float("inf") \
+                        else f"{bound:g}"
+                    lines.append(f"{self.name}_bucket"
+                                 f"{format_labels(names, values + (le,))}"
+                                 f" {cumulative}")
+                labels: str = format_labels(self.labels, values)
+                lines.append(f"{self.name}_sum{labels} {total:g}")
+                lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+    def clear(self) -> None:
+        """
+        Drops recorded values
+        """
+        with self._lock:
+            self._values.clear()
+
+
+class StatsGauge(object):
+    """
+    Gauge of counters reported by a component's stats method, values
+    are read when metrics are rendered
+    """
+
+    def __init__(self, name: str, description: str,
+                 collect: Callable[[], Mapping[str, float]]) -> None:
+        self.name = name
+        self.description = description
+        self._collect = collect
+
+    def render(self) -> List[str]:
+        """
+        Returns exposition lines, one per counter
+        """
+        lines: List[str] = [f"# HELP {self.name} {self.description}",
+                            f"# TYPE {self.name} gauge"]
+        for stat, value in sorted(self._collect().items()):
+            lines.append(f"{self.name}{format_labels(['stat'], [stat])} "
+                         f"{value:g}")
+        return lines
+
+    def clear(self) -> None:
+        """
+        Values belong to the component, nothing to drop
+        """
+
+
+phase_seconds = Histogram(
+    "certbot_updater_phase_seconds",
+    "Wall time of issuance phases",
+    ["phase", "provider", "outcome"],
+    PHASE_BUCKETS,
+)
+
+errors_total = Counter(
+    "certbot_updater_errors_total",
+    "Errors returned to clients by type",
+    ["type"],
+)
+
+certbot_http_seconds = Histogram(
+    "certbot_updater_certbot_http_seconds",
+    "Latency of HTTP requests made by certbot and DNS plugins",
+    ["host", "provider", "status"],
+    PHASE_BUCKETS,
+)
+
+registry: List = [phase_seconds, errors_total, certbot_http_seconds]
+
+
+def register(metric: StatsGauge) -> None:
+    """
+    Adds metric of another component to rendered ones
+    """
+    registry.append(metric)
+
+
+_provider: ContextVar[str] = ContextVar("metrics_provider", default="")
+
+
+@contextmanager
+def provider_label(provider: str) -> Iterator[None]:
+    """
+    Labels phases executed within the context with DNS provider
+    """
+    token = _provider.set(provider)
+    try:
+        yield
+    finally:
+        _provider.reset(token)
+
+
+def observe_phase(name: str, seconds: float, outcome: str) -> None:
+    """
+    Records duration of the phase
+    """
+    phase_seconds.observe(seconds, name, _provider.get(), outcome)
+
+
+def observe_http(host: str, status: str, seconds: float) -> None:
+    """
+    Records HTTP request made by certbot process
+    """
+    certbot_http_seconds.observe(seconds, host, _provider.get(), status)
+
+
+def render() -> str:
+    """
+    Returns all metrics in Prometheus text format
+    """
+    return "\n".join(line for metric in registry
+                     for line in metric.render()) + "\n"
+
+
+def clear() -> None:
+    """
+    Drops all recorded values
+    """
+    for metric in registry:
+        metric.clear()
@@ -0,0 +1,281 @@
+# coding=utf-8
+"""
+Small objects storage with generation preconditions
+"""
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from fcntl import flock, LOCK_EX, LOCK_UN
+from os import makedirs, replace, remove, stat, utime, walk
+from os.path import join, exists, dirname, relpath
+from tempfile import NamedTemporaryFile
+from threading import Lock
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# noinspection PyPackageRequirements
+from google.api_core.exceptions import NotFound, PreconditionFailed
+# noinspection PyPackageRequirements
+from google.cloud.storage import Bucket
+
+
+class ObjectStore(ABC):
+    """
+    Storage of small objects supporting compare-and-swap by object
+    generation
+    """
+
+    @abstractmethod
+    def read(self, path: str) -> Optional[Tuple[bytes, int]]:
+        """
+        Returns object content and generation or None if it doesn't
+        exist
+        """
+
+    @abstractmethod
+    def create(self, path: str, data: bytes) -> Optional[int]:
+        """
+        Creates object unless it exists, returns its generation or
+        None if it already exists
+        """
+
+    @abstractmethod
+    def replace(
+        self,
+        path: str,
+        data: bytes,
+        generation: int,
+    ) -> Optional[int]:
+        """
+        Replaces object of the generation, returns new generation or
+        None if object has been changed or deleted
+        """
+
+    @abstractmethod
+    def delete(self, path: str, generation: int) -> bool:
+        """
+        Deletes object of the generation, returns whether it has been
+        deleted
+        """
+
+    @abstractmethod
+    def list(
+        self,
+        prefix: str,
+        end_offset: Optional[str] = None,
+        start_offset: Optional[str] = None,
+        max_results: Optional[int] = None,
+    ) -> List[str]:
+        """
+        Returns sorted paths of objects starting with the prefix,
+        only the ones sorted before end_offset and not before
+        start_offset if they are given, at most max_results first ones
+        """
+
+
+class GCSObjectStore(ObjectStore):
+    """
+    Keeps objects in GCS bucket, uses generation match preconditions
+    """
+
+    def __init__(self, bucket: Bucket) -> None:
+        self.bucket = bucket
+
+    def read(self, path: str) -> Optional[Tuple[bytes, int]]:
+        blob = self.bucket.blob(path)
+        try:
+            data: bytes = blob.download_as_bytes()
+        except NotFound:
+            return None
+        return data, blob.generation
+
+    def create(self, path: str, data: bytes) -> Optional[int]:
+        return self._upload(path, data, 0)
+
+    def replace(
+        self,
+        path: str,
+        data: bytes,
+        generation: int,
+    ) -> Optional[int]:
+        return self._upload(path, data, generation)
+
+    def delete(self, path: str, generation: int) -> bool:
+        try:
+            self.bucket.blob(path).delete(if_generation_match=generation)
+            return True
+        except (NotFound, PreconditionFailed):
+            return False
+
+    def list(
+        self,
+        prefix: str,
+        end_offset: Optional[str] = None,
+        start_offset: Optional[str] = None,
+        max_results: Optional[int] = None,
+    ) -> List[str]:
+        return sorted(b.name for b in self.bucket.list_blobs(
+            prefix=prefix, start_offset=start_offset, end_offset=end_offset,
+            max_results=max_results, fields="items(name),nextPageToken"))
+
+    def _upload(
+        self,
+        path: str,
+        data: bytes,
+        generation: int,
+    ) -> Optional[int]:
+        blob = self.bucket.blob(path)
+        try:
+            blob.upload_from_string(data,
+                                    content_type="application/json",
+                                    if_generation_match=generation)
+        except PreconditionFailed:
+            return None
+        return blob.generation
+
+
+class MemoryObjectStore(ObjectStore):
+    """
+    Keeps objects in memory, used for tests and single instance setups
+    """
+
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self._objects: Dict[str, Tuple[bytes, int]] = {}
+        self._generation = 0
+
+    def read(self, path: str) -> Optional[Tuple[bytes, int]]:
+        with self._lock:
+            return self._objects.get(path)
+
+    def create(self, path: str, data: bytes) -> Optional[int]:
+        with self._lock:
+            if path in self._objects:
+                return None
+            return self._put(path, data)
+
+    def replace(
+        self,
+        path: str,
+        data: bytes,
+        generation: int,
+    ) -> Optional[int]:
+        with self._lock:
+            current = self._objects.get(path)
+            if current is None or current[1] != generation:
+                return None
+            return self._put(path, data)
+
+    def delete(self, path: str, generation: int) -> bool:
+        with self._lock:
+            current = self._objects.get(path)
+            if current is None or current[1] != generation:
+                return False
+            del self._objects[path]
+            return True
+
+    def list(
+        self,
+        prefix: str,
+        end_offset: Optional[str] = None,
+        start_offset: Optional[str] = None,
+        max_results: Optional[int] = None,
+    ) -> List[str]:
+        with self._lock:
+            return sorted(p for p in self._objects if p.startswith(prefix)
+                          and (end_offset is None or p < end_offset)
+                          and (start_offset is None or p >= start_offset)
+                          )[:max_results]
+
+    def _put(self, path: str, data: bytes) -> int:
+        self._generation += 1
+        self._objects[path] = (data, self._generation)
+        return self._generation
+
+
+class LocalObjectStore(ObjectStore):
+    """
+    Keeps objects in a local directory shared by processes of the
+    host. Modification time in nanoseconds is used as generation,
+    changes are serialized by a lock file
+    """
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+        self._lock = Lock()
+
+    def read(self, path: str) -> Optional[Tuple[bytes, int]]:
+        with self._locked():
+            if not exists(join(self.root, path)):
+                return None
+            with open(join(self.root, path), "rb") as f:
+                return f.read(), self._generation(path)
+
+    def create(self, path: str, data: bytes) -> Optional[int]:
+        with self._locked():
+            if exists(join(self.root, path)):
+                return None
+            return self._write(path, data, 0)
+
+    def replace(
+        self,
+        path: str,
+        data: bytes,
+        generation: int,
+    ) -> Optional[int]:
+        with self._locked():
+            if not exists(join(self.root, path)) \
+                    or self._generation(path) != generation:
+                return None
+            return self._write(path, data, generation)
+
+    def delete(self, path: str, generation: int) -> bool:
+        with self._locked():
+            if not exists(join(self.root, path)) \
+                    or self._generation(path) != generation:
+                return False
+            remove(join(self.root, path))
+            return True
+
+    def list(
+        self,
+        prefix: str,
+        end_offset: Optional[str] = None,
+        start_offset: Optional[str] = None,
+        max_results: Optional[int] = None,
+    ) -> List[str]:
+        paths: List[str] = []
+        for directory, _, files in walk(self.root):
+            for name in files:
+                path: str = relpath(join(directory, name), self.root)
+                if path.startswith(prefix) and path != ".lock" \
+                        and not name.startswith(".tmp") \
+                        and (end_offset is None or path < end_offset) \
+                        and (start_offset is None or path >= start_offset):
+                    paths.append(path)
+        return sorted(paths)[:max_results]
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        makedirs(self.root, exist_ok=True)
+        with self._lock, open(join(self.root, ".lock"), "a") as f:
+            flock(f, LOCK_EX)
+            try:
+                yield
+            finally:
+                flock(f, LOCK_UN)
+
+    def _generation(self, path: str) -> int:
+        return stat(join(self.root, path)).st_mtime_ns
+
+    def _write(self, path: str, data: bytes, previous: int) -> int:
+        target: str = join(self.root, path)
+        makedirs(dirname(target), exist_ok=True)
+        with NamedTemporaryFile(dir=dirname(target), prefix=".tmp",
+                                delete=False) as f:
+            f.write(data)
+        replace(f.name, target)
+        generation: int = self._generation(path)
+        if generation <= previous:
+            # coarse clock, generations have to change on every write
+            generation = previous + 1
+            utime(target, ns=(generation, generation))
+        return generation
@@ -0,0 +1,84 @@
+# coding=utf-8
+"""
+Wall time accounting for issuance pipeline phases
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+from time import monotonic
+from typing import Dict, Iterator, Optional
+
+from metrics import observe_phase
+from tracing import span
+
+
+class PhaseRecorder(object):
+    """
+    Collects wall time spent in named phases
+    """
+
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self._timings: Dict[str, float] = {}
+
+    def add(self, name: str, seconds: float) -> None:
+        """
+        Adds elapsed time to the phase, repeated phases are summed up
+        """
+        with self._lock:
+            self._timings[name] = self._timings.get(name, 0.0) + seconds
+
+    def as_dict(self) -> Dict[str, float]:
+        """
+        Returns recorded timings in seconds
+        """
+        with self._lock:
+            return {k: round(v, 3) for k, v in self._timings.items()}
+
+
+_recorder: ContextVar[Optional[PhaseRecorder]] = \
+    ContextVar("phase_recorder", default=None)
+
+
+@contextmanager
+def recording(
+    recorder: Optional[PhaseRecorder] = None
+) -> Iterator[PhaseRecorder]:
+    """
+    Makes phases executed within the context to be recorded
+    """
+    recorder = recorder or PhaseRecorder()
+    token = _recorder.set(recorder)
+    try:
+        yield recorder
+    finally:
+        _recorder.reset(token)
+
+
+def current_timings() -> Optional[Dict[str, float]]:
+    """
+    Returns timings of the current recorder, None if phases aren't
+    recorded
+    """
+    recorder: Optional[PhaseRecorder] = _recorder.get()
+    return None if recorder is None else recorder.as_dict()
+
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    """
+    Measures wall time of the enclosed block, records it to the
+    current recorder, to the phases histogram and as a tracing span
+    """
+    recorder: Optional[PhaseRecorder] = _recorder.get()
+    start: float = monotonic()
+    outcome: str = "error"
+    try:
+        with span(name):
+            yield
+        outcome = "success"
+    finally:
+        seconds: float = monotonic() - start
+        if recorder is not None:
+            recorder.add(name, seconds)
+        observe_phase(name, seconds, outcome)
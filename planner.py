@@ -0,0 +1,142 @@
+# coding=utf-8
+"""
+Planning of certificates: domain names normalization and packing of
+domain sets into certificates
+"""
+from collections import namedtuple
+from typing import Any, Dict, List, Tuple
+
+DomainPlan = namedtuple("DomainPlan", "domains dropped")
+
+
+def normalize_domain(name: str) -> str:
+    """
+    Returns lowercase ASCII (IDNA) domain name without trailing dot.
+    Raises ValueError if name can't be encoded
+    """
+    name = name.strip().rstrip(".").lower()
+    if not name:
+        raise ValueError("Domain name is empty")
+    labels: List[str] = name.split(".")
+    if any(not label for label in labels) or "*" in labels[1:]:
+        raise ValueError(f"Domain name {name} is invalid")
+    if labels[0] == "*":
+        return ".".join(["*", *_encode(labels[1:])])
+    return ".".join(_encode(labels))
+
+
+def _encode(labels: List[str]) -> List[str]:
+    return [label if label.isascii()
+            else label.encode("idna").decode("ascii")
+            for label in labels]
+
+
+def covered_by(name: str, wildcard: str) -> bool:
+    """
+    Whether wildcard name matches the name, wildcard matches exactly
+    one leftmost label
+    """
+    return wildcard.startswith("*.") and name != wildcard \
+        and name.split(".", 1)[-1] == wildcard[2:] \
+        and name.count(".") == wildcard.count(".")
+
+
+def plan_domains(
+    domains: List[str],
+    drop_covered: bool = False,
+) -> DomainPlan:
+    """
+    Normalizes domains keeping order and drops duplicates, names
+    covered by wildcards of the same list are dropped if drop_covered
+    is set. Dropped names are reported normalized
+    """
+    normalized: List[str] = []
+    dropped: List[str] = []
+    for name in domains:
+        domain: str = normalize_domain(name)
+        if domain in normalized:
+            dropped.append(domain)
+        else:
+            normalized.append(domain)
+    if not drop_covered:
+        return DomainPlan(normalized, dropped)
+    wildcards: List[str] = [d for d in normalized if d.startswith("*.")]
+    planned: List[str] = []
+    for domain in normalized:
+        if any(covered_by(domain, w) for w in wildcards):
+            dropped.append(domain)
+        else:
+            planned.append(domain)
+    return DomainPlan(planned, dropped)
+
+
+def pack_domain_sets(
+    domain_sets: List[List[str]],
+    max_names: int,
+    drop_covered: bool = False,
+) -> List[Tuple[List[str], List[int]]]:
+    """
+    Packs planned domain sets into as few certificates of at most
+    max_names names as possible, largest sets first. Sets sharing
+    names, or covered by wildcards of other sets if drop_covered is
+    set, take less room.
+    Returns certificate domains with indices of packed sets
+    """
+    bins: List[Tuple[List[str], List[int]]] = []
+    order: List[int] = sorted(range(len(domain_sets)),
+                              key=lambda i: -len(domain_sets[i]))
+    for index in order:
+        for position, (domains, indices) in enumerate(bins):
+            merged: List[str] = \
+                plan_domains(domains + domain_sets[index],
+                             drop_covered).domains
+            if len(merged) <= max_names:
+                bins[position] = (merged, indices + [index])
+                break
+        else:
+            bins.append((list(domain_sets[index]), [index]))
+    return [(domains, sorted(indices)) for domains, indices in bins]
+
+
+def plan_certificates(reqs: List[Any], max_names: int) -> Dict[str, Any]:
+    """
+    Builds issuance plan of the requests. Domain sets of requests with
+    the same provider, project, secret, email and drop_covered are
+    packed together
+    """
+    planned: List[DomainPlan] = [
+        plan_domains(r.domains, r.drop_covered) for r in reqs]
+    groups: Dict[Tuple[str, str, str, str, bool], List[int]] = {}
+    for index, req in enumerate(reqs):
+        groups.setdefault(
+            (req.provider, req.project, req.secret_id, req.email,
+             req.drop_covered),
+            []).append(index)
+    certificates: List[Dict[str, Any]] = []
+    for (provider, project, secret_id, email, drop_covered), indices \
+            in groups.items():
+        packed = pack_domain_sets(
+            [planned[i].domains for i in indices], max_names,
+            drop_covered)
+        for domains, positions in packed:
+            certificates.append({
+                "provider": provider,
+                "project": project,
+                "secret_id": secret_id,
+                "email": email,
+                "domains": domains,
+                "requests": [indices[p] for p in positions],
+            })
+    certificates.sort(key=lambda c: c["requests"][0])
+    return {
+        "orders_requested": len(reqs),
+        "orders": len(certificates),
+        "authorizations_requested": sum(len(r.domains) for r in reqs),
+        "authorizations": sum(len(c["domains"]) for c in certificates),
+        "certificates": certificates,
+        "requests": [{
+            "index": index,
+            "domains": plan.domains,
+            "dropped": plan.dropped,
+        } for index, plan in enumerate(planned)],
+    }
@@ -0,0 +1,275 @@
+# coding=utf-8
+"""
+Waiting for ACME challenge TXT records on authoritative nameservers
+"""
+from fcntl import flock, LOCK_EX, LOCK_UN
+from json import dumps, loads
+from logging import info, warning
+from os import environ, listdir, open as open_fd, close, O_CREAT, \
+    O_EXCL, O_WRONLY, replace
+from os.path import join, exists
+from time import monotonic, sleep
+from typing import Any, Callable, Dict, IO, List, Optional, Set, Tuple
+
+# noinspection PyPackageRequirements
+import dns.exception
+# noinspection PyPackageRequirements
+import dns.flags
+# noinspection PyPackageRequirements
+import dns.message
+# noinspection PyPackageRequirements
+import dns.query
+# noinspection PyPackageRequirements
+import dns.rdatatype
+# noinspection PyPackageRequirements
+import dns.resolver
+
+Nameserver = Tuple[str, int]
+
+
+def parse_nameservers(value: str) -> List[Nameserver]:
+    """
+    Parses comma separated list of host[:port] items, IPv6 addresses
+    with port are written as [address]:port
+    """
+    nameservers: List[Nameserver] = []
+    for item in filter(None, (i.strip() for i in value.split(","))):
+        if item.startswith("["):
+            host, _, port = item[1:].partition("]")
+            port = port.lstrip(":")
+        elif item.count(":") == 1:
+            host, port = item.split(":")
+        else:
+            host, port = item, ""
+        nameservers.append((host, int(port or 53)))
+    return nameservers
+
+
+def authoritative_nameservers(
+    name: str,
+    resolver: Optional[dns.resolver.Resolver] = None,
+) -> List[Nameserver]:
+    """
+    Returns addresses of nameservers authoritative for the zone the
+    name belongs to
+    """
+    resolver = resolver or dns.resolver.get_default_resolver()
+    zone = dns.resolver.zone_for_name(name, resolver=resolver)
+    addresses: Set[Nameserver] = set()
+    for ns in resolver.resolve(zone, dns.rdatatype.NS):
+        for rdtype in (dns.rdatatype.A, dns.rdatatype.AAAA):
+            try:
+                answer = resolver.resolve(ns.target, rdtype)
+            except (dns.resolver.NoAnswer, dns.resolver.NXDOMAIN):
+                continue
+            addresses.update((a.address, 53) for a in answer)
+    return sorted(addresses)
+
+
+def txt_values(
+    name: str,
+    nameserver: Nameserver,
+    timeout: float,
+) -> Set[str]:
+    """
+    Returns TXT values of the name served by the nameserver
+    """
+    host, port = nameserver
+    query = dns.message.make_query(name, dns.rdatatype.TXT)
+    response = dns.query.udp(query, host, timeout=timeout, port=port)
+    if response.flags & dns.flags.TC:
+        response = dns.query.tcp(query, host, timeout=timeout, port=port)
+    values: Set[str] = set()
+    for rrset in response.answer:
+        if rrset.rdtype == dns.rdatatype.TXT:
+            values.update(b"".join(r.strings).decode("utf-8")
+                          for r in rrset)
+    return values
+
+
+def wait_for_records(
+    records: Dict[str, Set[str]],
+    timeout: float,
+    interval: float,
+    nameservers: Optional[List[Nameserver]] = None,
+) -> bool:
+    """
+    Polls authoritative nameservers of every record name until all of
+    them serve the expected TXT values. Nameservers are looked up
+    unless specified. Returns False if the values aren't visible
+    everywhere within timeout, after waiting for the whole timeout
+    """
+    deadline: float = monotonic() + timeout
+    pending: Set[Tuple[str, Nameserver]] = set()
+    try:
+        for name in records:
+            servers: List[Nameserver] = \
+                nameservers or authoritative_nameservers(name)
+            if not servers:
+                raise dns.exception.DNSException(
+                    f"No nameservers found for {name}")
+            pending.update((name, ns) for ns in servers)
+    except dns.exception.DNSException as e:
+        warning(f"Failed to find authoritative nameservers, waiting "
+                f"{timeout} seconds: {e}")
+        sleep(max(deadline - monotonic(), 0))
+        return False
+
+    polls: int = 0
+    while True:
+        polls += 1
+        for name, ns in sorted(pending):
+            try:
+                values: Set[str] = txt_values(
+                    name, ns, timeout=max(min(interval, 5.0), 0.5))
+            except (dns.exception.DNSException, OSError):
+                continue
+            if records[name] <= values:
+                pending.discard((name, ns))
+        if not pending:
+            info(f"Challenge records are visible on all authoritative "
+                 f"nameservers after {polls} polls")
+            return True
+        remaining: float = deadline - monotonic()
+        if remaining <= 0:
+            warning(f"Challenge records are not visible on "
+                    f"{sorted({ns for _, ns in pending})} after "
+                    f"{timeout} seconds")
+            return False
+        sleep(min(interval, remaining))
+
+
+GROUP_DIR_ENV = "CERTBOT_GROUP_DIR"
+GROUP_SIZE_ENV = "CERTBOT_GROUP_SIZE"
+GROUP_MEMBER_ENV = "CERTBOT_GROUP_MEMBER"
+
+
+class PropagationGroup(object):
+    """
+    Barrier shared through a directory by certbot processes issuing
+    certificates with the same DNS provider. Members publish challenge
+    records one at a time, wait for each other, then the first member
+    done waiting waits for propagation of all records at once and the
+    rest follow it. Members which finish without reaching the barrier
+    leave the group so nobody waits for them
+    """
+
+    def __init__(self, directory: str, size: int, member: str) -> None:
+        self.directory = directory
+        self.size = size
+        self.member = member
+        self._publish_lock: Optional[IO] = None
+
+    @staticmethod
+    def from_environment() -> Optional["PropagationGroup"]:
+        """
+        Returns group the current process belongs to, if any
+        """
+        if not environ.get(GROUP_DIR_ENV):
+            return None
+        return PropagationGroup(environ[GROUP_DIR_ENV],
+                                int(environ[GROUP_SIZE_ENV]),
+                                environ[GROUP_MEMBER_ENV])
+
+    def environment(self) -> Dict[str, str]:
+        """
+        Returns environment variables making certbot join the group
+        """
+        return {
+            GROUP_DIR_ENV: self.directory,
+            GROUP_SIZE_ENV: str(self.size),
+            GROUP_MEMBER_ENV: self.member,
+        }
+
+    def lock_publish(self) -> None:
+        """
+        Waits until other members have published their records
+        """
+        self._publish_lock = open(join(self.directory, "publish.lock"),
+                                  "w")
+        flock(self._publish_lock.fileno(), LOCK_EX)
+
+    def release_publish(self) -> None:
+        """
+        Lets the next member publish its records
+        """
+        if self._publish_lock is not None:
+            flock(self._publish_lock.fileno(), LOCK_UN)
+            self._publish_lock.close()
+            self._publish_lock = None
+
+    def leave(self) -> None:
+        """
+        Marks member as not waiting for propagation
+        """
+        self._write(f"left-{self.member}", "")
+
+    def wait(
+        self,
+        records: Dict[str, Set[str]],
+        timeout: float,
+        propagate: Callable[[Dict[str, Set[str]]], Any],
+    ) -> None:
+        """
+        Waits for other members within timeout and for propagation of
+        the records. Propagation is waited with propagate once for all
+        members which have arrived in time
+        """
+        self._write(f"arrived-{self.member}.json", dumps(
+            {k: sorted(v) for k, v in records.items()}))
+        deadline: float = monotonic() + timeout
+        while len(self._members()) < self.size \
+                and monotonic() < deadline:
+            sleep(0.1)
+        if self._elect():
+            arrived: Dict[str, Dict[str, List[str]]] = self._arrived()
+            union: Dict[str, Set[str]] = {}
+            for member_records in arrived.values():
+                for name, values in member_records.items():
+                    union.setdefault(name, set()).update(values)
+            info(f"Waiting for propagation of records of "
+                 f"{len(arrived)} certificates")
+            propagate(union)
+            self._write("propagated", dumps(sorted(arrived)))
+            return
+        deadline += timeout + 5
+        while not exists(join(self.directory, "propagated")) \
+                and monotonic() < deadline:
+            sleep(0.1)
+        propagated: List[str] = []
+        if exists(join(self.directory, "propagated")):
+            with open(join(self.directory, "propagated")) as f:
+                propagated = loads(f.read())
+        if self.member not in propagated:
+            warning(f"Records of {self.member} are not covered by "
+                    f"group propagation, waiting on its own")
+            propagate(records)
+
+    def _members(self) -> Set[str]:
+        return {n.split("-", 1)[1].rsplit(".json", 1)[0]
+                for n in listdir(self.directory)
+                if n.startswith(("arrived-", "left-"))
+                and not n.endswith(".tmp")}
+
+    def _arrived(self) -> Dict[str, Dict[str, List[str]]]:
+        arrived: Dict[str, Dict[str, List[str]]] = {}
+        for name in listdir(self.directory):
+            if name.startswith("arrived-") and name.endswith(".json"):
+                with open(join(self.directory, name)) as f:
+                    arrived[name[len("arrived-"):-len(".json")]] = \
+                        loads(f.read())
+        return arrived
+
+    def _elect(self) -> bool:
+        try:
+            close(open_fd(join(self.directory, "leader"),
+                          O_CREAT | O_EXCL | O_WRONLY))
+            return True
+        except FileExistsError:
+            return False
+
+    def _write(self, name: str, content: str) -> None:
+        path: str = join(self.directory, name)
+        with open(f"{path}.tmp", "w") as f:
+            f.write(content)
+        replace(f"{path}.tmp", path)
@@ -83,3 +83,12 @@ providers = {
         "--dns-sakuracloud-propagation-seconds",
     ),
 }
+
+# modules imported ahead of time by warm certbot workers
+preloaded_modules = [
+    "certbot.main",
+    "certbot._internal.main",
+    "acme.client",
+    "cryptography.hazmat.backends.openssl",
+    *[f"certbot_dns_{name}" for name in sorted(providers.keys())],
+]
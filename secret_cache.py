@@ -0,0 +1,140 @@
+# coding=utf-8
+"""
+Secret Manager client sharing and secret values caching
+"""
+from collections import OrderedDict
+from contextlib import contextmanager
+from logging import info
+from threading import Lock
+from time import monotonic
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+# noinspection PyPackageRequirements
+from google.cloud.secretmanager_v1 import AccessSecretVersionResponse
+
+SecretKey = Tuple[str, str]
+
+
+class SecretCache(object):
+    """
+    Caches the latest secret values. Once TTL expires the latest
+    version is accessed again and its name is compared to the cached
+    one to detect rotation, so only secretmanager.versions.access
+    permission is needed. Values are evicted in LRU order once the
+    cache is full
+    """
+
+    def __init__(
+        self,
+        client_factory: Callable[[], Any],
+        ttl: float,
+        max_size: int,
+    ) -> None:
+        self._client_factory = client_factory
+        self._client: Optional[Any] = None
+        self._ttl = ttl
+        self._max_size = max_size
+        self._lock = Lock()
+        # per secret locks with number of their users, dropped once
+        # nobody uses them
+        self._key_locks: Dict[SecretKey, Tuple[Lock, int]] = {}
+        # version, value and time of the latest check by secret
+        self._values: "OrderedDict[SecretKey, Tuple[str, str, float]]" = \
+            OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.rotations = 0
+
+    def client(self) -> Any:
+        """
+        Returns process-wide Secret Manager client
+        """
+        with self._lock:
+            if self._client is None:
+                self._client = self._client_factory()
+            return self._client
+
+    def get(self, project: str, secret_id: str) -> str:
+        """
+        Returns the latest secret value
+        """
+        key: SecretKey = (project, secret_id)
+        # concurrent callers of the same secret wait for a single fetch
+        with self._key_lock(key):
+            with self._lock:
+                cached: Optional[Tuple[str, str, float]] = \
+                    self._values.get(key)
+                if cached is not None \
+                        and monotonic() - cached[2] < self._ttl:
+                    self.hits += 1
+                    self._values.move_to_end(key)
+                    return cached[1]
+            version, value = self._fetch(project, secret_id)
+            rotated: bool = cached is not None and version != cached[0]
+            if rotated:
+                info(f"Secret {secret_id} from project {project} is "
+                     f"rotated to version {version}")
+            with self._lock:
+                if cached is None:
+                    self.misses += 1
+                else:
+                    self.revalidations += 1
+                    self.rotations += int(rotated)
+                self._values[key] = (version, value, monotonic())
+                self._values.move_to_end(key)
+                while len(self._values) > self._max_size:
+                    self._values.popitem(last=False)
+            return value
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns cache counters
+        """
+        with self._lock:
+            return {
+                "size": len(self._values),
+                "hits": self.hits,
+                "misses": self.misses,
+                "revalidations": self.revalidations,
+                "rotations": self.rotations,
+            }
+
+    def clear(self) -> None:
+        """
+        Drops cached values, counters and client
+        """
+        with self._lock:
+            self._client = None
+            self._values.clear()
+            self.hits = 0
+            self.misses = 0
+            self.revalidations = 0
+            self.rotations = 0
+
+    @contextmanager
+    def _key_lock(self, key: SecretKey) -> Iterator[None]:
+        with self._lock:
+            lock, users = self._key_locks.get(key) or (Lock(), 0)
+            self._key_locks[key] = (lock, users + 1)
+        try:
+            with lock:
+                yield
+        finally:
+            with self._lock:
+                users = self._key_locks[key][1] - 1
+                if users:
+                    self._key_locks[key] = (lock, users)
+                else:
+                    del self._key_locks[key]
+
+    def _fetch(self, project: str, secret_id: str) -> Tuple[str, str]:
+        info(f"Getting secret {secret_id} from project {project}")
+        rsp: AccessSecretVersionResponse = \
+            self.client().access_secret_version(request={
+                "name": f"projects/{project}"
+                        f"/secrets/{secret_id}/versions/latest"
+            })
+        info(f"Secret {secret_id} from project {project} fetched")
+        return str(rsp.name).rsplit("/", 1)[-1], \
+            rsp.payload.data.decode("utf-8")
@@ -2,47 +2,329 @@
 """
 Server entry point
 """
-from logging import info, exception
+from contextlib import ExitStack
+from dataclasses import replace
+from functools import partial
+from logging import info, warning, exception
 from os import getenv
-from typing import Dict
+from tempfile import TemporaryDirectory
+from threading import Event, Thread
+from time import monotonic
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type
 from wsgiref.simple_server import WSGIServer
 
 from cheroot.wsgi import PathInfoDispatcher as WSGIPathInfoDispatcher
 from cheroot.wsgi import Server as WSGIServer
-from flask import Flask, jsonify, request
+from flask import Flask, Response, g, jsonify, request
 from marshmallow import ValidationError
 
-from dto import CertbotRequest
+from admission import AdmissionController
+from batch import OnceCache, parse_limits, run_batch
+from certbot_runner import CertbotRunner, certbot_runner
+from coalescing import Coalescer
+from dto import CertbotRequest, MAX_NAMES
 from errors import SecretFetchError, CertbotTimeoutError, \
-    CertbotError, GCSUploadError
-from service import dry_run_upload, issue_certificate
+    CertbotError, GCSError, GCSUploadError, JobNotFoundError, \
+    IdempotencyKeyReusedError, CertificateLockedError, \
+    QueueNotConfiguredError, AdmissionError, JobQueueFullError
+from gcs import clients
+from idempotency import IdempotencyRecord, IdempotencyStore
+from jobs import Job, JobQueue
+from metrics import CONTENT_TYPE, StatsGauge, errors_total, \
+    provider_label, register, render
+from phases import PhaseRecorder, current_timings, phase, recording
+from planner import DomainPlan, plan_domains, plan_certificates
+from propagation import PropagationGroup
+from service import dry_run_upload, issue_certificate, \
+    find_valid_certificate, certbot_environment, secrets
+from tracing import exporter, span, trace_request
 from utils import configure_logger
+from work_queue import Message, WorkQueue, work_queue
 
 # noinspection PyPackageRequirements
 
 app = Flask(__name__)
 
+SERVER_THREADS: int = int(getenv("SERVER_THREADS", "10"))
+SERVER_QUEUE_SIZE: int = int(getenv("SERVER_QUEUE_SIZE", "50"))
 
-@app.route("/certs",
-           endpoint="certs",
-           methods=["POST"])
-def renew_certificates():
+# a couple of threads are left to status requests
+admission = AdmissionController(
+    max_active=int(getenv("ADMISSION_MAX_ACTIVE",
+                          str(max(SERVER_THREADS - 2, 1)))),
+    max_queued=int(getenv("ADMISSION_MAX_QUEUED", "100")),
+    initial_duration=float(getenv("ADMISSION_INITIAL_DURATION", "60")),
+)
+
+wsgi_server: Optional[WSGIServer] = None
+
+inflight = Coalescer(
+    ttl=float(getenv("COALESCE_TTL", "60")),
+    max_size=int(getenv("COALESCE_SIZE", "1000")),
+)
+
+idempotency = IdempotencyStore(
+    retention=float(getenv("IDEMPOTENCY_RETENTION", "86400")),
+    max_size=int(getenv("IDEMPOTENCY_SIZE", "1000")),
+    persist=getenv("IDEMPOTENCY_PERSIST", "false").lower() == "true",
+)
+
+register(StatsGauge("certbot_updater_secret_cache",
+                    "Secret cache counters", secrets.stats))
+register(StatsGauge("certbot_updater_gcs_clients",
+                    "GCS clients, bucket handles and connections usage",
+                    clients.stats))
+
+queue: Optional[WorkQueue] = work_queue()
+QUEUE_WORKERS: int = int(getenv("QUEUE_WORKERS", "1"))
+QUEUE_POLL_INTERVAL: float = float(getenv("QUEUE_POLL_INTERVAL", "10"))
+QUEUE_RETRY_DELAY: float = float(getenv("QUEUE_RETRY_DELAY", "60"))
+
+BATCH_CONCURRENCY: int = int(getenv("BATCH_CONCURRENCY", "4"))
+BATCH_PROVIDER_LIMITS: Dict[str, int] = \
+    parse_limits(getenv("BATCH_PROVIDER_LIMITS", ""))
+
+
+def process_request(
+    req: CertbotRequest,
+    dry_runs: Optional[OnceCache] = None,
+) -> Dict[str, Any]:
     """
-    Job submit endpoint
+    Runs issuance pipeline for the request. Identical requests
+    processed concurrently or shortly before share the result. Result
+    contains the plan if it changed the requested domains
     """
-    req = CertbotRequest.from_request(request)
-    dry_run_upload(req)
-    result: Dict[str, str] = issue_certificate(req)
-    return jsonify({
-        "success": True,
-        "result": result
-    })
+    with provider_label(req.provider):
+        with phase("plan"):
+            plan: DomainPlan = plan_domains(req.domains, req.drop_covered)
+        if req.plan_only:
+            return {"plan": plan._asdict()}
+        rewritten: bool = plan.domains != req.domains
+        req = replace(req, domains=plan.domains)
+        result, shared = inflight.run(
+            req.canonical_key(), issue_request, req, dry_runs)
+    if rewritten:
+        info(f"Requested domains are planned as {plan.domains}, "
+             f"dropped {plan.dropped}")
+        result = {**result, "plan": plan._asdict()}
+    if shared:
+        info(f"Request for {req.domains} is served by identical one")
+        return {**result, "coalesced": True}
+    return result
+
+
+def process_idempotent(req: CertbotRequest, key: str) -> Dict[str, Any]:
+    """
+    Runs issuance pipeline for the request and stores its terminal
+    response, either result or client error, by the idempotency key.
+    Retries after server errors and lock conflicts run the request
+    again
+    """
+    try:
+        result: Dict[str, Any] = process_request(req)
+    except Exception as e:
+        response, status = error_payload(e)
+        if terminal_status(status):
+            idempotency.put(key, req, with_timings(response), status)
+        else:
+            info(f"Response {status} of request with idempotency key "
+                 f"{key} is not stored")
+            idempotency.discard(key)
+        raise
+    idempotency.put(key, req, with_timings(
+        {"success": True, "result": result}), 200)
+    return result
+
+
+def terminal_status(status: int) -> bool:
+    """
+    Whether retry of the request failed with the status gets the same
+    response: client errors except lock conflicts are terminal
+    """
+    return 400 <= status < 500 and status != 409
+
+
+def with_timings(response: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Adds timings of phases recorded so far to the response, so replays
+    of synchronous requests match the original response
+    """
+    timings: Optional[Dict[str, float]] = current_timings()
+    if timings is not None:
+        response["timings"] = timings
+    return response
+
+
+def issue_request(
+    req: CertbotRequest,
+    dry_runs: Optional[OnceCache] = None,
+) -> Dict[str, Any]:
+    """
+    Issues certificate unless live one is still valid. Dry run upload
+    is done once per target if the dry runs cache is specified
+    """
+    with phase("renewal_check"):
+        skipped: Optional[Dict[str, str]] = find_valid_certificate(req)
+    if skipped is not None:
+        return skipped
+    with phase("dry_run_upload"):
+        if dry_runs is None:
+            dry_run_upload(req)
+        else:
+            dry_runs.call((req.project,
+                           req.target_bucket,
+                           req.target_bucket_path),
+                          dry_run_upload, req)
+    with phase("issue_certificate"):
+        start: float = monotonic()
+        result: Dict[str, Any] = issue_certificate(req)
+    # skipped and failed issuances don't tell how long certbot takes
+    if not result.get("skipped"):
+        admission.record(monotonic() - start)
+    return result
+
+
+def process_batch(
+    reqs: List[CertbotRequest],
+    shared_propagation: bool = False,
+) -> Dict[str, Any]:
+    """
+    Runs issuance pipeline for every request of the batch with
+    global and per-provider concurrency limits. With shared
+    propagation requests using the same provider and secret are
+    started together and wait for DNS propagation once
+    """
+    dry_runs = OnceCache()
+    members: Dict[int, PropagationGroup] = {}
+    with ExitStack() as stack:
+        if shared_propagation:
+            for indices in propagation_groups(reqs):
+                directory: str = stack.enter_context(
+                    TemporaryDirectory(prefix="certbot-group-"))
+                for index in indices:
+                    members[index] = PropagationGroup(
+                        directory, len(indices), str(index))
+
+        def process(item: Tuple[int, CertbotRequest]) -> Dict[str, Any]:
+            index, req = item
+            member: Optional[PropagationGroup] = members.get(index)
+            if member is None:
+                return process_request(req, dry_runs)
+            try:
+                with certbot_environment(member.environment()):
+                    return process_request(req, dry_runs)
+            finally:
+                member.leave()
+
+        items: List[Dict[str, Any]] = run_batch(
+            list(enumerate(reqs)),
+            process,
+            report_error,
+            concurrency=BATCH_CONCURRENCY,
+            group=lambda item: item[1].provider,
+            limits=BATCH_PROVIDER_LIMITS,
+            gang=lambda item: members[item[0]].directory
+            if item[0] in members else item[0],
+        )
+    succeeded: int = sum(1 for i in items if i["success"])
+    return {
+        "succeeded": succeeded,
+        "failed": len(items) - succeeded,
+        "items": items,
+    }
+
+
+def drain_queue(work: WorkQueue, stop: Event) -> None:
+    """
+    Issues certificates of queued requests until stopped, polls the
+    queue every QUEUE_POLL_INTERVAL seconds while it's empty
+    """
+    while not stop.is_set():
+        # noinspection PyBroadException
+        try:
+            message: Optional[Message] = work.lease()
+        except Exception:
+            exception("Unable to lease queued request")
+            message = None
+        if message is None:
+            stop.wait(QUEUE_POLL_INTERVAL)
+            continue
+        process_message(work, message)
+
+
+def process_message(work: WorkQueue, message: Message) -> None:
+    """
+    Runs issuance pipeline for the queued request extending its
+    lease while it's processed. Acknowledges processed request,
+    failed one is retried after QUEUE_RETRY_DELAY seconds
+    """
+    done = Event()
+
+    def renew() -> None:
+        while not done.wait(work.visibility_timeout / 3):
+            # noinspection PyBroadException
+            try:
+                if not work.heartbeat(message):
+                    warning(f"Lease of queued request {message.id} "
+                            f"is lost")
+                    return
+            except Exception:
+                exception(f"Unable to extend lease of queued request "
+                          f"{message.id}")
+
+    info(f"Processing queued request {message.id}, "
+         f"attempt {message.attempts}")
+    renewal = Thread(target=renew, name="queue-heartbeat", daemon=True)
+    renewal.start()
+    error: Optional[Dict[str, Any]] = None
+    # noinspection PyBroadException
+    try:
+        with span("process_message", message_id=message.id,
+                  attempt=message.attempts,
+                  provider=message.payload["provider"],
+                  domain_count=len(message.payload["domains"])):
+            process_request(CertbotRequest(**message.payload))
+    except Exception as e:
+        exception(f"Queued request {message.id} failed")
+        error = report_error(e)[0]["error"]
+    finally:
+        done.set()
+        renewal.join()
+    # noinspection PyBroadException
+    try:
+        if error is None:
+            work.ack(message)
+            info(f"Queued request {message.id} is processed")
+        else:
+            work.fail(message, error, QUEUE_RETRY_DELAY)
+    except Exception:
+        exception(f"Unable to complete queued request {message.id}")
 
 
-@app.errorhandler(ValidationError)
-def handle_api_error(error: ValidationError):
+def propagation_groups(reqs: List[CertbotRequest]) -> List[List[int]]:
+    """
+    Returns indices of requests sharing DNS provider and its secret
+    split into chunks fitting both BATCH_CONCURRENCY and the provider
+    limit, chunks of a single request are omitted
     """
-    Handles api errors
+    groups: Dict[Tuple[str, str, str], List[int]] = {}
+    for index, req in enumerate(reqs):
+        groups.setdefault((req.provider, req.project, req.secret_id),
+                          []).append(index)
+    chunks: List[List[int]] = []
+    for (provider, _, _), indices in groups.items():
+        size: int = max(min(BATCH_CONCURRENCY, BATCH_PROVIDER_LIMITS.get(
+            provider, BATCH_CONCURRENCY)), 1)
+        chunks.extend(indices[i:i + size]
+                      for i in range(0, len(indices), size))
+    return [c for c in chunks if len(c) > 1]
+
+
+def validation_error_payload(
+    error: ValidationError
+) -> Tuple[Dict[str, Any], int]:
+    """
+    Builds api error payload
     """
     response = {
         "success": False,
@@ -53,13 +335,14 @@ def handle_api_error(error: ValidationError):
         }
     }
 
-    return jsonify(response), 400
+    return response, 400
 
 
-@app.errorhandler(SecretFetchError)
-def handle_secret_error(error: SecretFetchError):
+def secret_error_payload(
+    error: SecretFetchError
+) -> Tuple[Dict[str, Any], int]:
     """
-    Handles secret fetch errors
+    Builds secret fetch error payload
     """
     response = {
         "success": False,
@@ -70,13 +353,14 @@ def handle_secret_error(error: SecretFetchError):
         }
     }
 
-    return jsonify(response), 500
+    return response, 500
 
 
-@app.errorhandler(GCSUploadError)
-def handle_gcs_upload_error(error: GCSUploadError):
+def gcs_upload_error_payload(
+    error: GCSUploadError
+) -> Tuple[Dict[str, Any], int]:
     """
-    Handles errors related to GCS bucket uploads
+    Builds payload of errors related to GCS bucket uploads
     """
     response = {
         "success": False,
@@ -88,14 +372,39 @@ def handle_gcs_upload_error(error: GCSUploadError):
             "bucket_path": error.bucket_path,
         }
     }
+    if error.failures:
+        response["error"]["failures"] = [{
+            "source_path": source_path,
+            "bucket_path": bucket_path,
+        } for source_path, bucket_path in error.failures]
+
+    return response, 500
+
+
+def gcs_error_payload(
+    error: GCSError
+) -> Tuple[Dict[str, Any], int]:
+    """
+    Builds payload of errors related to GCS bucket access
+    """
+    response = {
+        "success": False,
+        "error": {
+            "type": error.__class__.__name__,
+            "message": "There is a problem with GCS bucket access. "
+                       "Check logs and bucket permissions.",
+            "bucket": error.bucket_name,
+        }
+    }
 
-    return jsonify(response), 500
+    return response, 500
 
 
-@app.errorhandler(CertbotTimeoutError)
-def handle_certbot_timeout_error(error: CertbotTimeoutError):
+def certbot_timeout_error_payload(
+    error: CertbotTimeoutError
+) -> Tuple[Dict[str, Any], int]:
     """
-    Handles secret fetch errors
+    Builds certbot timeout error payload
     """
     response = {
         "success": False,
@@ -104,17 +413,21 @@ def handle_certbot_timeout_error(error: CertbotTimeoutError):
             "message": "Certbot instance aborted by timeout",
             "command": error.cmd,
             "timeout": error.timeout,
-            "output": error.output.split("\n")
+            "output": error.output.split("\n"),
+            "rusage": error.rusage,
+            "acme": error.acme,
+            "http": error.http,
         }
     }
 
-    return jsonify(response), 500
+    return response, 500
 
 
-@app.errorhandler(CertbotError)
-def handle_certbot_error(error: CertbotError):
+def certbot_error_payload(
+    error: CertbotError
+) -> Tuple[Dict[str, Any], int]:
     """
-    Handles secret fetch errors
+    Builds certbot error payload
     """
     response = {
         "success": False,
@@ -123,17 +436,114 @@ def handle_certbot_error(error: CertbotError):
             "message": "Certbot instance failed",
             "command": error.cmd,
             "timeout": error.timeout,
-            "output": error.output.split("\n")
+            "output": error.output.split("\n"),
+            "rusage": error.rusage,
+            "acme": error.acme,
+            "http": error.http,
         }
     }
 
-    return jsonify(response), 500
+    return response, 500
 
 
-@app.errorhandler(Exception)
-def handle_error(error: Exception):
+def job_not_found_error_payload(
+    error: JobNotFoundError
+) -> Tuple[Dict[str, Any], int]:
     """
-    Handles generic errors
+    Builds unknown job error payload
+    """
+    response = {
+        "success": False,
+        "error": {
+            "type": error.__class__.__name__,
+            "message": "Job is not found",
+            "job_id": error.job_id,
+        }
+    }
+
+    return response, 404
+
+
+def idempotency_key_reused_error_payload(
+    error: IdempotencyKeyReusedError
+) -> Tuple[Dict[str, Any], int]:
+    """
+    Builds reused idempotency key error payload
+    """
+    response = {
+        "success": False,
+        "error": {
+            "type": error.__class__.__name__,
+            "message": "Idempotency key is already used "
+                       "with another request",
+            "key": error.key,
+        }
+    }
+
+    return response, 422
+
+
+def certificate_locked_error_payload(
+    error: CertificateLockedError
+) -> Tuple[Dict[str, Any], int]:
+    """
+    Builds payload of certificate being issued by another instance
+    """
+    response = {
+        "success": False,
+        "error": {
+            "type": error.__class__.__name__,
+            "message": "Certificate is being issued by another instance",
+            "lock_path": error.lock_path,
+            "owner": error.owner,
+        }
+    }
+
+    return response, 409
+
+
+def queue_not_configured_error_payload(
+    error: QueueNotConfiguredError
+) -> Tuple[Dict[str, Any], int]:
+    """
+    Builds payload of work queue usage without configuration
+    """
+    response = {
+        "success": False,
+        "error": {
+            "type": error.__class__.__name__,
+            "message": "Work queue is not configured, set QUEUE_URL",
+        }
+    }
+
+    return response, 404
+
+
+def admission_error_payload(
+    error: AdmissionError
+) -> Tuple[Dict[str, Any], int]:
+    """
+    Builds payload of issuance work rejected by admission control
+    """
+    response = {
+        "success": False,
+        "error": {
+            "type": error.__class__.__name__,
+            "message": "Too many jobs are queued"
+            if isinstance(error, JobQueueFullError)
+            else "All issuance slots are busy",
+            "retry_after": error.retry_after,
+        }
+    }
+
+    return response, 429 if isinstance(error, JobQueueFullError) else 503
+
+
+def generic_error_payload(
+    error: Exception
+) -> Tuple[Dict[str, Any], int]:
+    """
+    Builds generic error payload
     """
     response = {
         "success": False,
@@ -143,21 +553,282 @@ def handle_error(error: Exception):
         }
     }
 
-    return jsonify(response), 500
+    return response, 500
+
+
+# most specific error types go first
+ERROR_PAYLOADS: List[Tuple[Type[Exception], Callable]] = [
+    (ValidationError, validation_error_payload),
+    (SecretFetchError, secret_error_payload),
+    (GCSUploadError, gcs_upload_error_payload),
+    (GCSError, gcs_error_payload),
+    (CertbotTimeoutError, certbot_timeout_error_payload),
+    (CertbotError, certbot_error_payload),
+    (JobNotFoundError, job_not_found_error_payload),
+    (IdempotencyKeyReusedError, idempotency_key_reused_error_payload),
+    (CertificateLockedError, certificate_locked_error_payload),
+    (QueueNotConfiguredError, queue_not_configured_error_payload),
+    (AdmissionError, admission_error_payload),
+    (Exception, generic_error_payload),
+]
+
+
+def error_payload(error: Exception) -> Tuple[Dict[str, Any], int]:
+    """
+    Builds response payload and status code for the error
+    """
+    for error_type, builder in ERROR_PAYLOADS:
+        if isinstance(error, error_type):
+            return builder(error)
+    return generic_error_payload(error)
+
+
+def report_error(error: Exception) -> Tuple[Dict[str, Any], int]:
+    """
+    Counts the error returned to a client, builds its payload
+    """
+    errors_total.inc(error.__class__.__name__)
+    return error_payload(error)
+
+
+jobs = JobQueue(
+    process_request,
+    report_error,
+    workers=int(getenv("JOB_WORKERS", "2")),
+    retention=int(getenv("JOB_RETENTION", "1000")),
+)
+
+
+@app.route("/certs",
+           endpoint="certs",
+           methods=["POST"])
+def renew_certificates():
+    """
+    Job submit endpoint
+    """
+    with trace_request("renew_certificates", request.headers) as root:
+        req = CertbotRequest.from_request(request)
+        root.set(provider=req.provider, domain_count=len(req.domains))
+        return submit_request(req)
+
+
+def submit_request(req: CertbotRequest):
+    """
+    Replays idempotent response, submits the request as a job or
+    processes it synchronously
+    """
+    key: Optional[str] = request.headers.get("Idempotency-Key")
+    if key:
+        record: Optional[IdempotencyRecord] = idempotency.get(key, req)
+        if record is not None:
+            info(f"Request with idempotency key {key} is replayed")
+            return jsonify(record.response), record.status, \
+                {"Idempotent-Replayed": "true"}
+    if request.args.get("async", "false").lower() == "true":
+        admission.admit_job(jobs.depth, jobs.workers)
+        job: Job = jobs.create(req)
+        response: Dict[str, Any] = {
+            "success": True,
+            "job": job.to_dict()
+        }
+        if key:
+            # stored before the job starts, so its final response,
+            # or discard after a server error, replaces it
+            idempotency.put_pending(key, req, response, 202)
+        jobs.start(job, partial(process_idempotent, key=key)
+                   if key else None)
+        return jsonify(response), 202, {"Location": f"/jobs/{job.id}"}
+    # error handler reports timings of the failed request too
+    g.phases = PhaseRecorder()
+    with admission.admit(), recording(g.phases):
+        if key:
+            result: Dict[str, Any] = process_idempotent(req, key)
+        else:
+            result: Dict[str, Any] = process_request(req)
+    return jsonify({
+        "success": True,
+        "result": result,
+        "timings": g.phases.as_dict(),
+    })
+
+
+@app.route("/certs/batch",
+           endpoint="certs_batch",
+           methods=["POST"])
+def renew_certificates_batch():
+    """
+    Batch submit endpoint
+    """
+    with trace_request("renew_certificates_batch",
+                       request.headers) as root:
+        reqs: List[CertbotRequest] = \
+            CertbotRequest.from_batch_request(request)
+        root.set(items=len(reqs))
+        return submit_batch(reqs)
+
+
+def submit_batch(reqs: List[CertbotRequest]):
+    """
+    Submits the batch as a job or processes it synchronously
+    """
+    shared_propagation: bool = request.args.get(
+        "shared_propagation", "false").lower() == "true"
+    if request.args.get("async", "false").lower() == "true":
+        admission.admit_job(jobs.depth, jobs.workers)
+        job: Job = jobs.submit(reqs, partial(
+            process_batch, shared_propagation=shared_propagation))
+        return jsonify({
+            "success": True,
+            "job": job.to_dict()
+        }), 202, {"Location": f"/jobs/{job.id}"}
+    with admission.admit():
+        result: Dict[str, Any] = process_batch(reqs, shared_propagation)
+    return jsonify({
+        "success": True,
+        "result": result
+    })
+
+
+@app.route("/plan",
+           endpoint="plan",
+           methods=["POST"])
+def plan_certificates_batch():
+    """
+    Issuance plan endpoint
+    """
+    reqs: List[CertbotRequest] = CertbotRequest.from_batch_request(
+        request)
+    return jsonify({
+        "success": True,
+        "result": plan_certificates(reqs, MAX_NAMES)
+    })
+
+
+@app.route("/queue",
+           endpoint="queue",
+           methods=["POST"])
+def enqueue_certificates():
+    """
+    Puts list of requests to the work queue
+    """
+    if queue is None:
+        raise QueueNotConfiguredError()
+    reqs: List[CertbotRequest] = CertbotRequest.from_batch_request(
+        request)
+    return jsonify({
+        "success": True,
+        "messages": [queue.enqueue(vars(req)) for req in reqs]
+    }), 202
+
+
+@app.route("/queue",
+           endpoint="queue_stats",
+           methods=["GET"])
+def get_queue_stats():
+    """
+    Work queue status endpoint
+    """
+    if queue is None:
+        raise QueueNotConfiguredError()
+    return jsonify({
+        "success": True,
+        "queue": queue.stats()
+    })
+
+
+@app.route("/jobs/<job_id>",
+           endpoint="jobs",
+           methods=["GET"])
+def get_job(job_id: str):
+    """
+    Job status endpoint
+    """
+    job: Optional[Job] = jobs.get(job_id)
+    if job is None:
+        raise JobNotFoundError(job_id)
+    return jsonify(job.to_dict())
+
+
+@app.route("/stats",
+           endpoint="stats",
+           methods=["GET"])
+def get_stats():
+    """
+    Server saturation endpoint
+    """
+    return jsonify({
+        "success": True,
+        "server": server_stats(),
+        "admission": admission.stats(),
+        "jobs": {
+            "workers": jobs.workers,
+            "queued": jobs.depth,
+        },
+        "coalescing": inflight.stats(),
+        "secret_cache": secrets.stats(),
+        "gcs": clients.stats(),
+    })
+
+
+def server_stats() -> Dict[str, int]:
+    """
+    Returns request threads usage of the running server
+    """
+    stats: Dict[str, int] = {
+        "threads": SERVER_THREADS,
+        "busy_threads": 0,
+        "queue_depth": 0,
+        "queue_size": SERVER_QUEUE_SIZE,
+    }
+    if wsgi_server is not None and wsgi_server.requests is not None:
+        pool = wsgi_server.requests
+        # noinspection PyProtectedMember
+        threads: int = len(pool._threads)
+        stats.update(threads=threads,
+                     busy_threads=threads - pool.idle,
+                     queue_depth=pool.qsize)
+    return stats
+
+
+@app.route("/metrics",
+           endpoint="metrics",
+           methods=["GET"])
+def get_metrics():
+    """
+    Prometheus metrics endpoint
+    """
+    return Response(render(), content_type=CONTENT_TYPE)
+
+
+@app.errorhandler(Exception)
+def handle_error(error: Exception):
+    """
+    Handles errors
+    """
+    response, status = report_error(error)
+    phases: Optional[PhaseRecorder] = g.get("phases")
+    if phases is not None:
+        response["timings"] = phases.as_dict()
+    if isinstance(error, AdmissionError):
+        return jsonify(response), status, \
+            {"Retry-After": str(error.retry_after)}
+    return jsonify(response), status
 
 
 def init_server() -> WSGIServer:
     """
     Init server
     """
+    global wsgi_server
     port: int = int(getenv("PORT", "8080"))
     # noinspection HttpUrlsUsage
     info("App is about to start, visit http://{}:{}"
          .format("0.0.0.0", port))
     d = WSGIPathInfoDispatcher({"/": app})
-    return WSGIServer(("0.0.0.0", port), d,
-                      numthreads=10,
-                      request_queue_size=50)
+    wsgi_server = WSGIServer(("0.0.0.0", port), d,
+                             numthreads=SERVER_THREADS,
+                             request_queue_size=SERVER_QUEUE_SIZE)
+    return wsgi_server
 
 
 def main():
@@ -165,7 +836,17 @@ def main():
     Entrypoint
     """
     configure_logger()
+    runner: CertbotRunner = certbot_runner()
+    runner.warm()
     server = init_server()
+    stop = Event()
+    consumers: List[Thread] = [] if queue is None else [
+        Thread(target=drain_queue, args=(queue, stop),
+               name=f"queue-{i}", daemon=True)
+        for i in range(QUEUE_WORKERS)
+    ]
+    for consumer in consumers:
+        consumer.start()
     # noinspection PyBroadException
     try:
         server.start()
@@ -175,6 +856,13 @@ def main():
         exception("Server stopped")
     finally:
         server.stop()
+        stop.set()
+        for consumer in consumers:
+            consumer.join()
+        jobs.shutdown()
+        runner.shutdown()
+        if exporter is not None:
+            exporter.shutdown()
 
 
 if __name__ == "__main__":
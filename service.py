@@ -2,75 +2,299 @@
 """
 Main business logic
 """
+from base64 import b64encode
 from collections import namedtuple
-from datetime import datetime
-from logging import info
-from os import makedirs, walk
-from os.path import join, relpath, normpath
+from concurrent.futures import Future
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from dataclasses import replace
+from datetime import datetime, timedelta
+from hashlib import md5
+from json import dumps
+from logging import info, exception
+from os import makedirs, walk, getenv
+from os.path import join, relpath, normpath, getsize, exists
 from subprocess import TimeoutExpired
 from tempfile import TemporaryDirectory
-from typing import List, Dict
+from time import monotonic
+from typing import List, Dict, Optional, Tuple, Any, Iterator
 from uuid import uuid4
 
+from cryptography.x509 import load_pem_x509_certificate, Certificate, \
+    SubjectAlternativeName, DNSName, ExtensionNotFound
 # noinspection PyPackageRequirements
-from google.cloud.secretmanager_v1 import SecretManagerServiceClient, \
-    AccessSecretVersionResponse, SecretPayload
+from google.api_core.exceptions import NotFound
 # noinspection PyPackageRequirements
-from google.cloud.storage import Bucket, Blob, Client
+from google.cloud.secretmanager_v1 import SecretManagerServiceClient
+# noinspection PyPackageRequirements
+from google.cloud.storage import Bucket, Blob
+# noinspection PyPackageRequirements
+from google_crc32c import Checksum
 from pytz import UTC
 
+from certbot_hooks import RUSAGE_FILE_ENV, HTTP_FILE_ENV, \
+    hook_environment, http_summary, read_report
+from certbot_log import LOG_FILE, analyze_log, compress_log
+from certbot_runner import certbot_runner
 from dto import CertbotRequest
 from errors import CertbotError, CertbotTimeoutError, \
     SecretFetchError, GCSUploadError, GCSError
+from gcs import clients, uploads, skip_unchanged
+from lease import Lease
+from object_store import ObjectStore, GCSObjectStore
+from metrics import observe_http
+from phases import phase
+from tracing import span, current_span
+from planner import plan_domains
 from providers import DnsProvider, providers
-from utils import run_subprocess
+from secret_cache import SecretCache
+from state import StateStore, state_store, lineage_name, \
+    restore_state, save_state
+
+secrets = SecretCache(
+    lambda: SecretManagerServiceClient(),
+    ttl=float(getenv("SECRET_CACHE_TTL", "300")),
+    max_size=int(getenv("SECRET_CACHE_SIZE", "64")),
+)
+
+CERT_LOCK_ENABLED: bool = getenv("CERT_LOCK", "false").lower() == "true"
+CERT_LOCK_TTL: float = float(getenv("CERT_LOCK_TTL", "120"))
+CERT_LOCK_HEARTBEAT: float = float(getenv("CERT_LOCK_HEARTBEAT", "30"))
+CERT_LOCK_WAIT: float = float(getenv("CERT_LOCK_WAIT", "0"))
+CERTBOT_LOG_UPLOAD: bool = \
+    getenv("CERTBOT_LOG_UPLOAD", "false").lower() == "true"
+CERTBOT_HTTP_ACCOUNTING: bool = \
+    getenv("CERTBOT_HTTP_ACCOUNTING", "false").lower() == "true"
+MANIFEST_FILE = "manifest.json"
+
+
+def issue_certificate(req: CertbotRequest) -> Dict[str, Any]:
+    """
+    Issues certificate holding the lease of its domains set. If the
+    lease has been held by another instance, the certificate it
+    published is returned if it covers the domains and satisfies
+    renew_before_days, or isn't expired if renew_before_days is unset
+    """
+    with certificate_lease(req) as lease:
+        if lease is not None and lease.contended:
+            published: Optional[Dict[str, str]] = find_valid_certificate(
+                replace(req, renew_before_days=req.renew_before_days or 0))
+            if published is not None:
+                return published
+        return obtain_certificate(req, lease)
+
+
+@contextmanager
+def certificate_lease(req: CertbotRequest) -> Iterator[Optional[Lease]]:
+    """
+    Holds lease of the request domains set under the target path
+    while certificate is issued and uploaded. Does nothing and yields
+    None unless CERT_LOCK is enabled
+    """
+    if not CERT_LOCK_ENABLED:
+        yield None
+        return
+    lease = Lease(lease_store(req),
+                  join(req.target_bucket_path, ".locks",
+                       f"{lineage_name(req.domains)}.json"),
+                  ttl=CERT_LOCK_TTL,
+                  heartbeat=CERT_LOCK_HEARTBEAT)
+    lease.acquire(CERT_LOCK_WAIT)
+    try:
+        yield lease
+    finally:
+        lease.release()
+
+
+def lease_store(req: CertbotRequest) -> ObjectStore:
+    """
+    Returns store of certificate leases in the target bucket
+    """
+    return GCSObjectStore(clients.bucket(req.project, req.target_bucket))
 
 
-def issue_certificate(req: CertbotRequest) -> Dict[str, str]:
+def obtain_certificate(
+    req: CertbotRequest,
+    lease: Optional[Lease] = None,
+) -> Dict[str, Any]:
     """
-    Issues certificate
+    Runs certbot and uploads obtained certificate. Nothing is uploaded
+    or published if the lease is lost meanwhile
     """
     provider: DnsProvider = providers[req.provider]
+    store: Optional[StateStore] = state_store(req.project)
 
     with TemporaryDirectory(prefix="certbot-") as d:
-        certificates_dir: str = call_certbot(provider, req, d)
-        client = Client(req.project)
+        run: CertbotRun = call_certbot(provider, req, d, store)
+        certificates_dir: str = run.certificates_dir
         try:
-            bucket: Bucket = client.get_bucket(req.target_bucket)
+            bucket: Bucket = clients.bucket(
+                req.project, req.target_bucket)
         except Exception:
             raise GCSError(req.target_bucket)
         live_directory: str = join(req.target_bucket_path, "live")
-        upload_directory_to_gcs(
-            certificates_dir,
-            bucket,
-            live_directory
-        )
         now: datetime = datetime.now(tz=UTC)
         timed_directory = join(
             req.target_bucket_path,
             now.strftime("%Y-%m-%d_%H-%M-%S_UTC"))
-        upload_directory_to_gcs(
-            certificates_dir,
-            bucket,
-            timed_directory
-        )
+        result: Dict[str, Any] = {
+            "live_gcs_path": f"gs://{bucket.name}/{live_directory}",
+            "timed_gcs_path": f"gs://{bucket.name}/{timed_directory}",
+        }
+        if lease is not None:
+            lease.ensure_held()
+        if req.publish_mode == "copy":
+            stats: UploadStats = upload_directories_to_gcs(
+                certificates_dir,
+                bucket,
+                [timed_directory]
+            )
+            if lease is not None:
+                lease.ensure_held()
+            generations: Dict[str, int] = copy_live_directory(
+                certificates_dir, bucket, timed_directory, live_directory)
+            manifest_path: str = join(
+                req.target_bucket_path, MANIFEST_FILE)
+            if lease is not None:
+                lease.ensure_held()
+            publish_manifest(bucket, timed_directory, live_directory,
+                             manifest_path, generations, now)
+            result["manifest_gcs_path"] = \
+                f"gs://{bucket.name}/{manifest_path}"
+        else:
+            stats = upload_directories_to_gcs(
+                certificates_dir,
+                bucket,
+                [live_directory, timed_directory]
+            )
+        if CERTBOT_LOG_UPLOAD:
+            log_path: str = join(
+                req.target_bucket_path, "logs",
+                now.strftime("%Y-%m-%d_%H-%M-%S_UTC") + ".log.gz")
+            if upload_certbot_log(run.logs_dir, bucket, log_path):
+                result["log_gcs_path"] = f"gs://{bucket.name}/{log_path}"
+    result["upload"] = stats._asdict()
+    result["rusage"] = run.rusage
+    result["acme"] = run.acme
+    result["http"] = run.http
+    return result
+
+
+def upload_certbot_log(
+    logs_dir: str,
+    bucket: Bucket,
+    gcs_path: str,
+) -> bool:
+    """
+    Uploads gzip compressed certbot log. The certificate is published
+    already, so failures are only logged. Returns whether the log has
+    been uploaded
+    """
+    source_path: str = join(logs_dir, LOG_FILE)
+    if not exists(source_path):
+        return False
+    with phase("upload_log"):
+        # noinspection PyBroadException
+        try:
+            compress_log(source_path, f"{source_path}.gz")
+            upload_file_to_gcs(f"{source_path}.gz", bucket, gcs_path)
+        except Exception:
+            exception(f"Failed to upload certbot log to {gcs_path}")
+            return False
+    return True
+
+
+def find_valid_certificate(
+    req: CertbotRequest
+) -> Optional[Dict[str, str]]:
+    """
+    Checks live certificate in GCS. Returns skipped result if it
+    covers requested domains and is far from expiry, None if
+    certificate has to be issued
+    """
+    if req.renew_before_days is None:
+        return None
+    live_directory: str = join(req.target_bucket_path, "live")
+    cert_path: str = join(live_directory, "cert.pem")
+    try:
+        bucket: Bucket = clients.bucket(req.project, req.target_bucket)
+        data: bytes = bucket.blob(cert_path).download_as_bytes()
+    except NotFound:
+        info(f"No live certificate found at "
+             f"gs://{req.target_bucket}/{cert_path}")
+        return None
+    except Exception:
+        raise GCSError(req.target_bucket)
+
+    try:
+        cert: Certificate = load_pem_x509_certificate(data)
+        names: List[str] = cert.extensions \
+            .get_extension_for_class(SubjectAlternativeName) \
+            .value.get_values_for_type(DNSName)
+    except (ValueError, ExtensionNotFound):
+        exception(f"Live certificate gs://{req.target_bucket}/"
+                  f"{cert_path} is unreadable")
+        return None
+    if set(plan_domains(names, req.drop_covered).domains) \
+            != set(plan_domains(req.domains, req.drop_covered).domains):
+        info(f"Live certificate domains {sorted(names)} don't match "
+             f"requested ones")
+        return None
+    not_after: datetime = cert.not_valid_after_utc
+    renew_at: datetime = \
+        not_after - timedelta(days=req.renew_before_days)
+    if datetime.now(tz=UTC) >= renew_at:
+        info(f"Live certificate expires at {not_after.isoformat()}, "
+             f"renewal is due")
+        return None
+    info(f"Live certificate expires at {not_after.isoformat()}, "
+         f"issuance is skipped")
     return {
-        "live_gcs_path": f"gs://{bucket.name}/{live_directory}",
-        "timed_gcs_path": f"gs://{bucket.name}/{timed_directory}"
+        "skipped": True,
+        "live_gcs_path": f"gs://{req.target_bucket}/{live_directory}",
+        "expires_at": not_after.isoformat(),
     }
 
 
+_certbot_environment: ContextVar[Dict[str, str]] = \
+    ContextVar("certbot_environment", default={})
+
+
+@contextmanager
+def certbot_environment(env: Dict[str, str]) -> Iterator[None]:
+    """
+    Passes additional environment variables to certbot runs made
+    within the context
+    """
+    token = _certbot_environment.set(
+        {**_certbot_environment.get(), **env})
+    try:
+        yield
+    finally:
+        _certbot_environment.reset(token)
+
+
+CertbotRun = namedtuple("CertbotRun",
+                        "certificates_dir logs_dir rusage acme http")
+
+
 def call_certbot(
     provider: DnsProvider,
     req: CertbotRequest,
     temp_directory: str,
-) -> str:
+    store: Optional[StateStore] = None,
+) -> CertbotRun:
     """
-    Calls certbot. Returns directory with live certificates.
+    Calls certbot. Returns directories with live certificates and
+    logs, resource usage, ACME steps timing and HTTP requests of
+    certbot process.
+    Certbot account and lineage are restored from and saved to the
+    state store if it's specified
     """
     try:
-        secret: str = get_secret_value(
-            req.project, req.secret_id)
+        with phase("get_secret_value"):
+            secret: str = get_secret_value(
+                req.project, req.secret_id)
     except Exception:
         raise SecretFetchError("Secret obtain filed!")
 
@@ -78,7 +302,15 @@ def call_certbot(
     secret_path_option: str = provider.secret_path_option
     propagation_time_option: str = provider.propagation_time_option
 
-    certbot_env = prepare_certbot_directory(secret, temp_directory)
+    with phase("prepare_certbot_directory"):
+        if store is None:
+            certbot_env = prepare_certbot_directory(
+                secret, temp_directory)
+        else:
+            certbot_env = prepare_certbot_directory(
+                secret, temp_directory, lineage_name(req.domains))
+            restore_state(store, certbot_env.cert_name,
+                          certbot_env.config_dir)
 
     command = [
         "certbot",
@@ -102,21 +334,66 @@ def call_certbot(
     ]
     info(f"Issue command: '{' '.join(command)}'")
     timeout = max(2 * req.propagation_seconds, 10)
+    extra_env: Dict[str, str] = _certbot_environment.get()
+    env: Dict[str, str] = {
+        **hook_environment(req.propagation_mode,
+                           http_accounting=CERTBOT_HTTP_ACCOUNTING,
+                           shared_propagation=bool(extra_env)),
+        **extra_env,
+        RUSAGE_FILE_ENV: join(temp_directory, "rusage.json"),
+    }
+    if CERTBOT_HTTP_ACCOUNTING:
+        env[HTTP_FILE_ENV] = join(temp_directory, "http.json")
+    if extra_env:
+        # time to wait for other certbot processes sharing propagation
+        timeout += 2 * req.propagation_seconds
     out: str = ""
+    with phase("certbot"):
+        try:
+            code, out = certbot_runner().run(
+                command, timeout=timeout, env=env)
+        except TimeoutExpired as e:
+            raise CertbotTimeoutError(
+                command, timeout, e.output,
+                **certbot_report(env, certbot_env.logs_dir))
+        except Exception:
+            raise CertbotError(
+                command, timeout, out,
+                **certbot_report(env, certbot_env.logs_dir))
+        report: Dict[str, Any] = \
+            certbot_report(env, certbot_env.logs_dir)
+        current_span().set(exit_code=code)
+        if code:
+            raise CertbotError(command, timeout, out, **report)
+    if store is not None:
+        save_state(store, certbot_env.cert_name, certbot_env.config_dir)
+    return CertbotRun(certbot_env.certificates_dir, certbot_env.logs_dir,
+                      **report)
+
+
+def certbot_report(env: Dict[str, str], logs_dir: str) -> Dict[str, Any]:
+    """
+    Returns resource usage, ACME steps timing and HTTP requests summary
+    of certbot run, values are None if certbot hasn't reported them.
+    HTTP requests are recorded to metrics
+    """
+    # noinspection PyBroadException
     try:
-        code, out = run_subprocess(
-            command,
-            timeout=timeout,
-            shell=False,
-            stdin=None,
-        )
-    except TimeoutExpired as e:
-        raise CertbotTimeoutError(command, timeout, e.output)
+        acme: Optional[Dict[str, Any]] = \
+            analyze_log(join(logs_dir, LOG_FILE))
     except Exception:
-        raise CertbotError(command, timeout, out)
-    if code:
-        raise CertbotError(command, timeout, out)
-    return certbot_env.certificates_dir
+        exception("Failed to analyze certbot log")
+        acme = None
+    calls: Optional[List[Dict[str, Any]]] = None
+    if HTTP_FILE_ENV in env:
+        calls = read_report(env[HTTP_FILE_ENV])
+        for call in calls or []:
+            observe_http(call["host"], call["status"], call["seconds"])
+    return {
+        "rusage": read_report(env[RUSAGE_FILE_ENV]),
+        "acme": acme,
+        "http": None if calls is None else http_summary(calls),
+    }
 
 
 CertbotEnv = namedtuple("CertbotEnv",
@@ -130,10 +407,12 @@ CertbotEnv = namedtuple("CertbotEnv",
 
 def prepare_certbot_directory(
     secret: str,
-    temp_directory: str
+    temp_directory: str,
+    cert_name: Optional[str] = None,
 ) -> CertbotEnv:
     """
-    Prepares specified directory for certbot
+    Prepares specified directory for certbot. Random lineage name
+    is used unless it's specified
     """
     config_dir: str = join(temp_directory, "config")
     makedirs(config_dir)
@@ -144,7 +423,7 @@ def prepare_certbot_directory(
     secret_location = join(temp_directory, "secret.file")
     with open(secret_location, "w", encoding="utf-8") as f:
         f.write(secret)
-    cert_name = "cert-" + str(uuid4())
+    cert_name = cert_name or "cert-" + str(uuid4())
     certificates_dir = join(config_dir, "live", cert_name)
     return CertbotEnv(
         cert_name=cert_name,
@@ -165,8 +444,7 @@ def dry_run_upload(req: CertbotRequest) -> None:
     gcs_path: str = join(req.target_bucket_path, "logs",
                          now.strftime("%Y-%m-%d_%H-%M-%S_UTC"))
     try:
-        client = Client(req.project)
-        bucket: Bucket = client.get_bucket(req.target_bucket)
+        bucket: Bucket = clients.bucket(req.project, req.target_bucket)
         info(f"Uploading log file to {gcs_path}")
         blob: Blob = bucket.blob(gcs_path)
         blob.upload_from_string(data="")
@@ -179,60 +457,309 @@ def dry_run_upload(req: CertbotRequest) -> None:
         )
 
 
+UploadStats = namedtuple("UploadStats",
+                         "files "
+                         "uploaded "
+                         "skipped "
+                         "bytes "
+                         "seconds")
+
+Checksums = namedtuple("Checksums", "crc32c md5")
+
+
 def upload_directory_to_gcs(
     source_path: str,
     bucket: Bucket,
     gcs_path: str,
-) -> None:
+) -> UploadStats:
     """
     Uploads specified directory to GCS recursively
     """
+    return upload_directories_to_gcs(source_path, bucket, [gcs_path])
+
+
+def upload_directories_to_gcs(
+    source_path: str,
+    bucket: Bucket,
+    gcs_paths: List[str],
+) -> UploadStats:
+    """
+    Uploads specified directory to every GCS path concurrently.
+    Objects with the same content are skipped. All files are
+    attempted, failures are reported together
+    """
+    with phase("upload_directory"):
+        return _upload_directories_to_gcs(source_path, bucket, gcs_paths)
+
+
+def _upload_directories_to_gcs(
+    source_path: str,
+    bucket: Bucket,
+    gcs_paths: List[str],
+) -> UploadStats:
+    destinations: str = ", ".join(
+        f"gs://{bucket.name}/{i}" for i in gcs_paths)
     info(f"Uploading directory '{source_path}' content to "
-         f"gs://{bucket.name}/{gcs_path}")
-    for root, _, files in walk(source_path):
-        for file in sorted(files):
-            rel_dir: str = relpath(root, source_path)
-            rel_file: str = join(rel_dir, file)
+         f"{destinations}")
+    start: float = monotonic()
+    rel_files: List[str] = directory_files(source_path)
+    local: Dict[str, Checksums] = {
+        i: file_checksums(join(source_path, i)) for i in rel_files
+    } if skip_unchanged else {}
+    files: List[Tuple[str, str]] = []
+    skipped: int = 0
+    for gcs_path in gcs_paths:
+        remote: Dict[str, Blob] = \
+            list_objects(bucket, gcs_path) if skip_unchanged else {}
+        for rel_file in rel_files:
             bucket_path: str = normpath(join(gcs_path, rel_file))
-            upload_file_to_gcs(join(root, file), bucket, bucket_path)
-    info(f"Upload of '{source_path}' content to "
-         f"gs://{bucket.name}/{gcs_path} has completed")
+            if rel_file in local and same_content(
+                    remote.get(bucket_path), local[rel_file]):
+                info(f"Skipping unchanged {bucket_path}")
+                skipped += 1
+                continue
+            files.append((join(source_path, rel_file), bucket_path))
 
+    # upload spans are children of the current one
+    wait_gcs_operations(bucket, [
+        uploads.submit(copy_context().run,
+                       upload_file_to_gcs, src, bucket, dst)
+        for src, dst in files
+    ])
+    stats = UploadStats(
+        files=len(files) + skipped,
+        uploaded=len(files),
+        skipped=skipped,
+        bytes=sum(getsize(src) for src, _ in files),
+        seconds=round(monotonic() - start, 3),
+    )
+    info(f"Upload of '{source_path}' content to {destinations} has "
+         f"completed: {stats.uploaded} files uploaded, {stats.skipped} "
+         f"skipped, {stats.bytes} bytes in {stats.seconds}s")
+    current_span().set(files=stats.files, uploaded=stats.uploaded,
+                       bytes=stats.bytes)
+    return stats
 
-def upload_file_to_gcs(
+
+def file_checksums(path: str) -> Checksums:
+    """
+    Returns base64-encoded CRC32C and MD5 of the file in the same
+    format as GCS object metadata
+    """
+    crc32c = Checksum()
+    md5_hash = md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b""):
+            crc32c.update(chunk)
+            md5_hash.update(chunk)
+    return Checksums(
+        crc32c=b64encode(crc32c.digest()).decode("ascii"),
+        md5=b64encode(md5_hash.digest()).decode("ascii"),
+    )
+
+
+def list_objects(bucket: Bucket, gcs_path: str) -> Dict[str, Blob]:
+    """
+    Returns objects under the path with checksums and generations
+    using a single listing. Listing failures are not fatal, all
+    objects are considered absent in this case
+    """
+    # noinspection PyBroadException
+    try:
+        return {
+            blob.name: blob
+            for blob in bucket.list_blobs(
+                prefix=f"{normpath(gcs_path)}/",
+                fields="items(name,generation,crc32c,md5Hash),"
+                       "nextPageToken")
+        }
+    except Exception:
+        exception(f"Unable to list gs://{bucket.name}/{gcs_path}")
+        return {}
+
+
+def same_content(blob: Optional[Blob], checksums: Checksums) -> bool:
+    """
+    Whether remote object has the same checksums
+    """
+    if blob is None:
+        return False
+    return Checksums(crc32c=blob.crc32c, md5=blob.md5_hash) == checksums
+
+
+def copy_live_directory(
     source_path: str,
     bucket: Bucket,
-    gcs_path: str,
+    timed_path: str,
+    live_path: str,
+) -> Dict[str, int]:
+    """
+    Builds live directory from already uploaded timed one with
+    server-side copies, live objects with the same content are kept.
+    Returns generations of live objects by relative path
+    """
+    with phase("copy_live_directory"):
+        info(f"Copying gs://{bucket.name}/{timed_path} "
+             f"to gs://{bucket.name}/{live_path}")
+        rel_files: List[str] = directory_files(source_path)
+        remote: Dict[str, Blob] = \
+            list_objects(bucket, live_path) if skip_unchanged else {}
+        generations: Dict[str, int] = {}
+        changed: List[str] = []
+        for i in rel_files:
+            blob: Optional[Blob] = remote.get(normpath(join(live_path, i)))
+            # checksums are computed only if there is an object to skip
+            if blob is not None and same_content(
+                    blob, file_checksums(join(source_path, i))):
+                info(f"Skipping unchanged {blob.name}")
+                generations[i] = blob.generation
+            else:
+                changed.append(i)
+        copies: List[Blob] = wait_gcs_operations(bucket, [
+            uploads.submit(copy_context().run,
+                           copy_blob_in_gcs,
+                           bucket,
+                           normpath(join(timed_path, i)),
+                           normpath(join(live_path, i)))
+            for i in changed
+        ])
+        generations.update({
+            i: blob.generation for i, blob in zip(changed, copies)
+        })
+        return generations
+
+
+def publish_manifest(
+    bucket: Bucket,
+    timed_path: str,
+    live_path: str,
+    manifest_path: str,
+    generations: Dict[str, int],
+    issued_at: datetime,
 ) -> None:
     """
-    Uploads specified file to GCS
+    Replaces manifest with the one pointing to timed directory and
+    generations of live objects copied from it, so readers of the
+    manifest always see a consistent set
     """
+    info(f"Publishing gs://{bucket.name}/{live_path} "
+         f"with gs://{bucket.name}/{manifest_path}")
+    manifest: Dict[str, Any] = {
+        "issued_at": issued_at.isoformat(),
+        "timed_path": timed_path,
+        "live_path": live_path,
+        "files": {
+            i: {"generation": generations[i]}
+            for i in sorted(generations)
+        },
+    }
     # noinspection PyBroadException
     try:
-        info(f"Uploading {source_path} to {gcs_path}")
-        blob: Blob = bucket.blob(gcs_path)
-        blob.upload_from_filename(source_path)
-        info(f"Upload {source_path} completed")
+        current: Optional[Blob] = bucket.get_blob(manifest_path)
+        generation: int = current.generation if current else 0
+        # the manifest flips only if nobody has replaced it meanwhile
+        bucket.blob(manifest_path).upload_from_string(
+            data=dumps(manifest, indent=2),
+            content_type="application/json",
+            if_generation_match=generation,
+        )
     except Exception:
         raise GCSUploadError(
-            source_path=source_path,
+            source_path="Manifest",
             bucket_name=bucket.name,
-            bucket_path=gcs_path
+            bucket_path=manifest_path,
         )
+    info(f"Manifest gs://{bucket.name}/{manifest_path} now points to "
+         f"gs://{bucket.name}/{timed_path}")
+
+
+def directory_files(source_path: str) -> List[str]:
+    """
+    Returns sorted file paths relative to the directory
+    """
+    files: List[str] = []
+    for root, _, names in walk(source_path):
+        rel_dir: str = relpath(root, source_path)
+        for file in sorted(names):
+            files.append(normpath(join(rel_dir, file)))
+    return files
+
+
+def wait_gcs_operations(
+    bucket: Bucket,
+    futures: List[Future],
+) -> List[Any]:
+    """
+    Waits for all GCS operations, raises an error with every
+    failure if there are any. Returns results in submission order
+    """
+    results: List[Any] = []
+    failures: List[GCSUploadError] = []
+    for future in futures:
+        try:
+            results.append(future.result())
+        except GCSUploadError as e:
+            failures.append(e)
+    if failures:
+        raise GCSUploadError(
+            failures[0].source_path,
+            bucket.name,
+            failures[0].bucket_path,
+            failures=[(i.source_path, i.bucket_path) for i in failures],
+        )
+    return results
+
+
+def upload_file_to_gcs(
+    source_path: str,
+    bucket: Bucket,
+    gcs_path: str,
+) -> None:
+    """
+    Uploads specified file to GCS
+    """
+    with span("upload_file", path=gcs_path) as upload:
+        # noinspection PyBroadException
+        try:
+            info(f"Uploading {source_path} to {gcs_path}")
+            upload.set(bytes=getsize(source_path))
+            blob: Blob = bucket.blob(gcs_path)
+            blob.upload_from_filename(source_path)
+            info(f"Upload {source_path} completed")
+        except Exception:
+            raise GCSUploadError(
+                source_path=source_path,
+                bucket_name=bucket.name,
+                bucket_path=gcs_path
+            )
+
+
+def copy_blob_in_gcs(
+    bucket: Bucket,
+    source_path: str,
+    gcs_path: str,
+) -> Blob:
+    """
+    Copies object within the bucket without downloading it
+    """
+    with span("copy_file", path=gcs_path):
+        # noinspection PyBroadException
+        try:
+            info(f"Copying {source_path} to {gcs_path}")
+            blob: Blob = bucket.copy_blob(
+                bucket.blob(source_path), bucket, gcs_path)
+            info(f"Copy {source_path} completed")
+            return blob
+        except Exception:
+            raise GCSUploadError(
+                source_path=f"gs://{bucket.name}/{source_path}",
+                bucket_name=bucket.name,
+                bucket_path=gcs_path
+            )
 
 
 def get_secret_value(project: str, secret_id: str) -> str:
     """
     Returns secret by secret id
     """
-    info(f"Getting secret {secret_id} from project {project}")
-    client = SecretManagerServiceClient()
-    rsp: AccessSecretVersionResponse = \
-        client.access_secret_version(request={
-            "name": f"projects/{project}"
-                    f"/secrets/{secret_id}/versions/latest"
-        })
-    info(f"Secret {secret_id} from project {project} fetched")
-    payload: SecretPayload = rsp.payload
-    payload_bytes: bytes = payload.data
-    return payload_bytes.decode("utf-8")
+    return secrets.get(project, secret_id)
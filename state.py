@@ -0,0 +1,187 @@
+# coding=utf-8
+"""
+Persistence of certbot configuration directory between runs
+"""
+from abc import ABC, abstractmethod
+from glob import glob
+from hashlib import sha256
+from io import BytesIO
+from logging import info, exception
+from os import makedirs, replace, listdir, getenv
+from os.path import join, exists, dirname
+from shutil import move, rmtree
+from tarfile import open as open_tar, TarInfo
+from tempfile import NamedTemporaryFile, mkdtemp
+from typing import Optional, List
+
+# noinspection PyPackageRequirements
+from google.api_core.exceptions import NotFound
+# noinspection PyPackageRequirements
+from google.cloud.storage import Client
+
+from gcs import clients
+CONFIG_DIR_MEMBER = ".config_dir"
+
+
+class StateStore(ABC):
+    """
+    Storage of packed certbot state
+    """
+
+    @abstractmethod
+    def load(self, key: str) -> Optional[bytes]:
+        """
+        Returns state archive by key or None if it doesn't exist
+        """
+
+    @abstractmethod
+    def save(self, key: str, data: bytes) -> None:
+        """
+        Atomically replaces state archive by key
+        """
+
+
+class LocalStateStore(StateStore):
+    """
+    Keeps state archives in a local directory
+    """
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+
+    def load(self, key: str) -> Optional[bytes]:
+        path: str = join(self.root, f"{key}.tar.gz")
+        if not exists(path):
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+
+    def save(self, key: str, data: bytes) -> None:
+        makedirs(self.root, exist_ok=True)
+        with NamedTemporaryFile(dir=self.root, delete=False) as f:
+            f.write(data)
+        replace(f.name, join(self.root, f"{key}.tar.gz"))
+
+
+class GCSStateStore(StateStore):
+    """
+    Keeps state archives in GCS bucket under specified prefix
+    """
+
+    def __init__(
+        self,
+        client: Client,
+        bucket: str,
+        prefix: str,
+    ) -> None:
+        self.bucket = client.bucket(bucket)
+        self.prefix = prefix
+
+    def load(self, key: str) -> Optional[bytes]:
+        try:
+            return self.bucket.blob(self._path(key)).download_as_bytes()
+        except NotFound:
+            return None
+
+    def save(self, key: str, data: bytes) -> None:
+        # single object upload is atomic in GCS
+        self.bucket.blob(self._path(key)).upload_from_string(
+            data, content_type="application/gzip")
+
+    def _path(self, key: str) -> str:
+        return join(self.prefix, f"{key}.tar.gz")
+
+
+def state_store(project: str) -> Optional[StateStore]:
+    """
+    Returns state store configured by CERTBOT_STATE_URL environment
+    variable, either gs://bucket/prefix or a local directory path
+    """
+    url: str = getenv("CERTBOT_STATE_URL", "")
+    if not url:
+        return None
+    if url.startswith("gs://"):
+        bucket, _, prefix = url[len("gs://"):].partition("/")
+        return GCSStateStore(clients.client(project), bucket, prefix)
+    return LocalStateStore(url[len("file://"):]
+                           if url.startswith("file://") else url)
+
+
+def lineage_name(domains: List[str]) -> str:
+    """
+    Returns stable certbot lineage name for the domains set
+    """
+    key: str = "\n".join(sorted({i.lower() for i in domains}))
+    digest: str = sha256(key.encode("utf-8")).hexdigest()
+    return f"cert-{digest[:16]}"
+
+
+def pack_state(config_dir: str) -> bytes:
+    """
+    Packs certbot config directory
+    """
+    buffer = BytesIO()
+    with open_tar(fileobj=buffer, mode="w:gz") as tar:
+        for name in sorted(listdir(config_dir)):
+            tar.add(join(config_dir, name), arcname=name)
+        marker: bytes = config_dir.encode("utf-8")
+        member = TarInfo(CONFIG_DIR_MEMBER)
+        member.size = len(marker)
+        tar.addfile(member, BytesIO(marker))
+    return buffer.getvalue()
+
+
+def unpack_state(data: bytes, config_dir: str) -> None:
+    """
+    Unpacks certbot state to config directory. Absolute paths in
+    renewal configuration are rewritten to the new location
+    """
+    staging: str = mkdtemp(dir=dirname(config_dir))
+    try:
+        with open_tar(fileobj=BytesIO(data), mode="r:gz") as tar:
+            tar.extractall(staging, filter="data")
+        with open(join(staging, CONFIG_DIR_MEMBER), "r",
+                  encoding="utf-8") as f:
+            previous_config_dir: str = f.read()
+        for path in glob(join(staging, "renewal", "*.conf")):
+            with open(path, "r", encoding="utf-8") as f:
+                content: str = f.read()
+            content = content.replace(previous_config_dir, config_dir)
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(content)
+        for name in listdir(staging):
+            if name != CONFIG_DIR_MEMBER:
+                move(join(staging, name), join(config_dir, name))
+    finally:
+        rmtree(staging, ignore_errors=True)
+
+
+def restore_state(store: StateStore, key: str, config_dir: str) -> bool:
+    """
+    Restores certbot state, returns whether it has been found
+    """
+    # noinspection PyBroadException
+    try:
+        data: Optional[bytes] = store.load(key)
+        if data is None:
+            info(f"No saved certbot state for {key}")
+            return False
+        unpack_state(data, config_dir)
+        info(f"Certbot state for {key} is restored")
+        return True
+    except Exception:
+        exception(f"Unable to restore certbot state for {key}, "
+                  f"starting from scratch")
+        return False
+
+
+def save_state(store: StateStore, key: str, config_dir: str) -> None:
+    """
+    Saves certbot state, failures don't affect issuance
+    """
+    # noinspection PyBroadException
+    try:
+        store.save(key, pack_state(config_dir))
+        info(f"Certbot state for {key} is saved")
+    except Exception:
+        exception(f"Unable to save certbot state for {key}")
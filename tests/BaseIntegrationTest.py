@@ -5,11 +5,23 @@ Base class for all integration tests
 from flask.testing import FlaskClient
 from flask_testing import TestCase
 
-from server import app
+import metrics
+from server import app, inflight, idempotency, admission
 
 
 class BaseTestCase(TestCase):
 
+    def _pre_setup(self):
+        """
+        Drops results of identical and idempotent requests, admission
+        counters and metrics of previous tests
+        """
+        super()._pre_setup()
+        inflight.clear()
+        idempotency.clear()
+        admission.clear()
+        metrics.clear()
+
     def create_app(self):
         """
         Creates a test cases-ready flask app
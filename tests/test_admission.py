@@ -0,0 +1,147 @@
+# coding=utf-8
+"""
+Admission control tests
+"""
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
+from typing import Any, Dict
+from unittest import TestCase
+from unittest.mock import patch, MagicMock
+
+from admission import AdmissionController
+from errors import ServerBusyError, JobQueueFullError, CertbotError
+from tests.BaseIntegrationTest import BaseTestCase
+
+
+class AdmissionControllerTests(TestCase):
+    """
+    Admission limits tests
+    """
+
+    def test_active_limit(self):
+        admission = AdmissionController(max_active=1, max_queued=1,
+                                        initial_duration=30)
+        with admission.admit():
+            with self.assertRaises(ServerBusyError) as e:
+                with admission.admit():
+                    pass
+            self.assertEqual(e.exception.retry_after, 30)
+        with admission.admit():
+            pass
+        self.assertEqual(admission.stats()["rejected_busy"], 1)
+
+    def test_retry_after_of_queue(self):
+        admission = AdmissionController(max_active=1, max_queued=10,
+                                        initial_duration=100)
+        admission.admit_job(depth=9, workers=2)
+        admission.record(50)
+        self.assertEqual(admission.duration, 90)
+        with self.assertRaises(JobQueueFullError) as e:
+            admission.admit_job(depth=10, workers=4)
+        # backlog of 10 jobs drained by 4 workers
+        self.assertEqual(e.exception.retry_after, 225)
+        self.assertEqual(admission.stats()["rejected_queue_full"], 1)
+
+
+class AdmissionApiTests(BaseTestCase):
+    """
+    Admission control API tests
+    """
+    mock_issue_certificate: MagicMock
+
+    request = {
+        "provider": "google",
+        "secret_id": "some-secret-id",
+        "project": "some-project-id",
+        "domains": ["*.example.com"],
+        "email": "test@example.com",
+        "target_bucket": "some-bucket",
+        "target_bucket_path": "some-path",
+    }
+
+    def setUp(self):
+        """
+        Tests init method
+        """
+        self.admission = AdmissionController(
+            max_active=1, max_queued=1, initial_duration=60)
+        for target, value in (("server.admission", self.admission),
+                              ("server.dry_run_upload", MagicMock()),
+                              ("server.find_valid_certificate",
+                               MagicMock(return_value=None))):
+            patcher = patch(target, value)
+            self.addCleanup(patcher.stop)
+            patcher.start()
+
+        patcher_issue_certificate = patch("server.issue_certificate")
+        self.addCleanup(patcher_issue_certificate.stop)
+        self.mock_issue_certificate = patcher_issue_certificate.start()
+        self.started = Event()
+        self.release = Event()
+        self.addCleanup(self.release.set)
+        self.mock_issue_certificate.side_effect = self._issue
+
+    def test_busy(self):
+        with ThreadPoolExecutor(max_workers=1) as e:
+            first = e.submit(self.app.test_client().post, "/certs",
+                             json=self.request)
+            self.started.wait(10)
+            response = self.http().post("/certs", json={
+                **self.request, "target_bucket_path": "other-path"})
+            self.assertStatus(response, 503)
+            self.assertEqual(response.headers["Retry-After"], "60")
+            self.assertEqual(response.json["error"], {
+                "type": "ServerBusyError",
+                "message": "All issuance slots are busy",
+                "retry_after": 60,
+            })
+            stats = self.http().get("/stats").json
+            self.assertEqual(stats["admission"]["active"], 1)
+            self.assertEqual(stats["admission"]["rejected_busy"], 1)
+            self.release.set()
+            self.assert200(first.result())
+        self.assertEqual(self.admission.completed, 1)
+
+    def test_only_issued_certificates_recorded(self):
+        self.release.set()
+        with patch("server.find_valid_certificate",
+                   MagicMock(return_value={"skipped": True})):
+            self.assert200(self.http().post("/certs", json=self.request))
+        self.mock_issue_certificate.side_effect = \
+            CertbotError(["certbot"], 10, "failed")
+        self.assert500(self.http().post("/certs", json={
+            **self.request, "target_bucket_path": "failed-path"}))
+        self.mock_issue_certificate.side_effect = [{"skipped": True}]
+        self.assert200(self.http().post("/certs", json={
+            **self.request, "target_bucket_path": "leased-path"}))
+        self.assertEqual(self.admission.completed, 0)
+        self.assertEqual(self.admission.duration, 60)
+
+    def test_queue_full(self):
+        self.assertStatus(self.http().post("/certs?async=true",
+                                           json=self.request), 202)
+        self.started.wait(10)
+        response = self.http().post("/certs/batch?async=true",
+                                    json=[self.request])
+        self.assertStatus(response, 429)
+        # one queued job, two workers
+        self.assertEqual(response.headers["Retry-After"], "30")
+        self.assertEqual(response.json["error"]["type"],
+                         "JobQueueFullError")
+
+    def test_stats(self):
+        response = self.http().get("/stats")
+        self.assert200(response)
+        self.assertEqual(response.json["server"], {
+            "threads": 10,
+            "busy_threads": 0,
+            "queue_depth": 0,
+            "queue_size": 50,
+        })
+        self.assertEqual(response.json["jobs"], {"workers": 2,
+                                                 "queued": 0})
+
+    def _issue(self, _) -> Dict[str, Any]:
+        self.started.set()
+        self.release.wait(10)
+        return {"live_gcs_path": "gs://some-bucket/some-path/live"}
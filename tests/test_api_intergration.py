@@ -10,6 +10,7 @@ from tests.BaseIntegrationTest import BaseTestCase
 class TestApi(BaseTestCase):
     mock_dry_run_upload: MagicMock
     mock_issue_certificate: MagicMock
+    mock_find_valid_certificate: MagicMock
 
     def setUp(self):
         """
@@ -23,6 +24,13 @@ class TestApi(BaseTestCase):
         self.addCleanup(patcher_issue_certificate.stop)
         self.mock_issue_certificate = patcher_issue_certificate.start()
 
+        patcher_find_valid_certificate = patch(
+            "server.find_valid_certificate")
+        self.addCleanup(patcher_find_valid_certificate.stop)
+        self.mock_find_valid_certificate = \
+            patcher_find_valid_certificate.start()
+        self.mock_find_valid_certificate.return_value = None
+
     def test_non_json(self):
         response = self.http().post("/certs")
         self.assert400(response)
@@ -97,13 +105,22 @@ class TestApi(BaseTestCase):
             "project": "some-project-id",
             "domains": ["*.example.com", "www.example.com"],
             "propagation_seconds": 600,
+            "renew_before_days": 30,
+            "publish_mode": "copy",
+            "propagation_mode": "adaptive",
+            "plan_only": False,
+            "drop_covered": False,
             "email": "test@example.com",
             "target_bucket": "some-bucket",
             "target_bucket_path": "some-path",
         }
         response = self.http().post("/certs", json=req)
         self.assert200(response)
-        self.assertEqual(response.json, {
+        rsp = response.json
+        self.assertEqual(sorted(rsp.pop("timings")), [
+            "dry_run_upload", "issue_certificate", "plan", "renewal_check"
+        ])
+        self.assertEqual(rsp, {
             "result": {
                 "live_gcs_path": "gs://live",
                 "timed_gcs_path": "gs://timed",
@@ -142,9 +159,18 @@ class TestApi(BaseTestCase):
             vars(self.mock_issue_certificate.call_args.args[0]), {
                 **req,
                 "propagation_seconds": 60,
+                "renew_before_days": None,
+                "publish_mode": "upload",
+                "propagation_mode": "fixed",
+                "plan_only": False,
+                "drop_covered": False,
             }
         )
-        self.assertEqual(response.json, {
+        rsp = response.json
+        self.assertEqual(sorted(rsp.pop("timings")), [
+            "dry_run_upload", "issue_certificate", "plan", "renewal_check"
+        ])
+        self.assertEqual(rsp, {
             "result": {
                 "live_gcs_path": "gs://live",
                 "timed_gcs_path": "gs://timed",
@@ -0,0 +1,244 @@
+# coding=utf-8
+"""
+Batch issuance tests
+"""
+from os.path import exists
+from threading import Lock
+from time import sleep, monotonic
+from typing import Any, Dict
+from unittest import TestCase
+from unittest.mock import patch, MagicMock
+
+import service
+from batch import run_batch, parse_limits
+from errors import CertbotError
+from server import error_payload
+from tests.BaseIntegrationTest import BaseTestCase
+
+
+def request(domain: str, **kwargs) -> Dict[str, Any]:
+    """
+    Returns valid request payload for the domain
+    """
+    return {
+        "provider": "google",
+        "secret_id": "some-secret-id",
+        "project": "some-project-id",
+        "domains": [domain],
+        "email": "test@example.com",
+        "target_bucket": "some-bucket",
+        "target_bucket_path": f"some-path/{domain}",
+        **kwargs,
+    }
+
+
+class RunBatchTests(TestCase):
+    """
+    Batch execution limits tests
+    """
+
+    def test_limits(self):
+        lock = Lock()
+        running: Dict[str, int] = {}
+        peaks: Dict[str, int] = {}
+
+        def handler(item: str) -> Dict[str, Any]:
+            with lock:
+                running[item] = running.get(item, 0) + 1
+                running["all"] = running.get("all", 0) + 1
+                peaks[item] = max(peaks.get(item, 0), running[item])
+                peaks["all"] = max(peaks.get("all", 0), running["all"])
+            sleep(0.05)
+            with lock:
+                running[item] -= 1
+                running["all"] -= 1
+            if item == "c":
+                raise CertbotError(["certbot"], 10, "failed")
+            return {"item": item}
+
+        items = ["a"] * 6 + ["b"] * 4 + ["c"]
+        results = run_batch(items, handler, error_payload,
+                            concurrency=4, group=lambda i: i,
+                            limits=parse_limits("a=1, b=2"))
+        self.assertEqual(peaks["a"], 1)
+        self.assertEqual(peaks["b"], 2)
+        self.assertLessEqual(peaks["all"], 4)
+        self.assertEqual([r["index"] for r in results],
+                         list(range(len(items))))
+        self.assertTrue(all(r["success"] for r in results[:-1]))
+        self.assertFalse(results[-1]["success"])
+        self.assertEqual(results[-1]["error"]["type"], "CertbotError")
+
+
+    def test_gang_members_count_against_limits(self):
+        lock = Lock()
+        running, peak = [0], [0]
+
+        def handler(item: int) -> Dict[str, Any]:
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            sleep(0.05)
+            with lock:
+                running[0] -= 1
+            return {"item": item}
+
+        results = run_batch(list(range(8)), handler, error_payload,
+                            concurrency=4, group=lambda i: "google",
+                            limits=parse_limits("google=2"),
+                            gang=lambda i: i // 2)
+        # gangs of two run one at a time under the provider limit
+        self.assertEqual(peak[0], 2)
+        self.assertTrue(all(r["success"] for r in results))
+
+
+class BatchApiTests(BaseTestCase):
+    """
+    Batch API tests
+    """
+    mock_dry_run_upload: MagicMock
+    mock_issue_certificate: MagicMock
+    mock_find_valid_certificate: MagicMock
+
+    def setUp(self):
+        """
+        Tests init method
+        """
+        patcher_dry_run_upload = patch("server.dry_run_upload")
+        self.addCleanup(patcher_dry_run_upload.stop)
+        self.mock_dry_run_upload = patcher_dry_run_upload.start()
+
+        patcher_issue_certificate = patch("server.issue_certificate")
+        self.addCleanup(patcher_issue_certificate.stop)
+        self.mock_issue_certificate = patcher_issue_certificate.start()
+        self.mock_issue_certificate.side_effect = self._issue
+
+        patcher_find_valid_certificate = patch(
+            "server.find_valid_certificate")
+        self.addCleanup(patcher_find_valid_certificate.stop)
+        self.mock_find_valid_certificate = \
+            patcher_find_valid_certificate.start()
+        self.mock_find_valid_certificate.return_value = None
+
+    def test_batch(self):
+        response = self.http().post("/certs/batch", json=[
+            request("a.example.com"),
+            request("b.example.com",
+                    target_bucket_path="some-path/a.example.com"),
+            request("fail.example.com"),
+        ])
+        self.assert200(response)
+        result = response.json["result"]
+        self.assertEqual(result["succeeded"], 2)
+        self.assertEqual(result["failed"], 1)
+        self.assertEqual(
+            [i["result"] for i in result["items"][:2]],
+            [{"live_gcs_path": "gs://some-bucket/a.example.com"},
+             {"live_gcs_path": "gs://some-bucket/b.example.com"}])
+        self.assertEqual(result["items"][2]["error"], {
+            "command": ["certbot"],
+            "message": "Certbot instance failed",
+            "output": ["failed"],
+            "rusage": None,
+            "acme": None,
+            "http": None,
+            "timeout": 10,
+            "type": "CertbotError"
+        })
+        self.assertIn("issue_certificate", result["items"][0]["timings"])
+        self.assertEqual(self.mock_issue_certificate.call_count, 3)
+        # two items share the same target
+        self.assertEqual(self.mock_dry_run_upload.call_count, 2)
+
+    def test_invalid_item(self):
+        response = self.http().post("/certs/batch", json=[
+            request("a.example.com"),
+            request("b.example.com", provider="unknown"),
+        ])
+        self.assert400(response)
+        self.assertEqual(list(response.json["error"]["errors"].keys()),
+                         ["1"])
+        self.mock_issue_certificate.assert_not_called()
+
+    def test_empty_batch(self):
+        response = self.http().post("/certs/batch", json=[])
+        self.assert400(response)
+        self.assertEqual(response.json["error"]["errors"],
+                         ["Requests list can't be empty!"])
+
+    def test_async_batch(self):
+        response = self.http().post("/certs/batch?async=true", json=[
+            request("a.example.com"),
+            request("b.example.com"),
+        ])
+        self.assertStatus(response, 202)
+        job_id: str = response.json["job"]["job_id"]
+        deadline: float = monotonic() + 10
+        while monotonic() < deadline:
+            job = self.http().get(f"/jobs/{job_id}").json
+            if job["status"] == "succeeded":
+                break
+            sleep(0.01)
+        else:
+            self.fail(f"Job {job_id} is not finished in time")
+        self.assertEqual(job["result"]["succeeded"], 2)
+        self.assertEqual(len(job["result"]["items"]), 2)
+
+    def test_shared_propagation(self):
+        environments: Dict[str, Dict[str, str]] = {}
+
+        def issue(req) -> Dict[str, Any]:
+            environments[req.domains[0]] = \
+                service._certbot_environment.get()
+            return self._issue(req)
+
+        self.mock_issue_certificate.side_effect = issue
+        response = self.http().post(
+            "/certs/batch?shared_propagation=true", json=[
+                request("a.example.com"),
+                request("b.example.com"),
+                request("c.example.com", secret_id="other-secret"),
+                request("d.example.com"),
+            ])
+        self.assert200(response)
+        self.assertEqual(response.json["result"]["succeeded"], 4)
+        group_dir = environments["a.example.com"]["CERTBOT_GROUP_DIR"]
+        for domain, member in (("a.example.com", "0"),
+                               ("b.example.com", "1"),
+                               ("d.example.com", "3")):
+            self.assertEqual(environments[domain], {
+                "CERTBOT_GROUP_DIR": group_dir,
+                "CERTBOT_GROUP_SIZE": "3",
+                "CERTBOT_GROUP_MEMBER": member,
+            })
+        self.assertEqual(environments["c.example.com"], {})
+        self.assertFalse(exists(group_dir))
+
+    def test_shared_propagation_chunks(self):
+        environments: Dict[str, Dict[str, str]] = {}
+
+        def issue(req) -> Dict[str, Any]:
+            environments[req.domains[0]] = \
+                service._certbot_environment.get()
+            return self._issue(req)
+
+        self.mock_issue_certificate.side_effect = issue
+        with patch("server.BATCH_CONCURRENCY", 4), \
+                patch("server.BATCH_PROVIDER_LIMITS", {"google": 2}):
+            response = self.http().post(
+                "/certs/batch?shared_propagation=true", json=[
+                    request(f"{i}.example.com") for i in range(5)])
+        self.assert200(response)
+        self.assertEqual(response.json["result"]["succeeded"], 5)
+        sizes = [environments[f"{i}.example.com"].get(
+            "CERTBOT_GROUP_SIZE") for i in range(5)]
+        self.assertEqual(sizes, ["2", "2", "2", "2", None])
+        directories = {environments[f"{i}.example.com"][
+            "CERTBOT_GROUP_DIR"] for i in range(4)}
+        self.assertEqual(len(directories), 2)
+
+    @staticmethod
+    def _issue(req) -> Dict[str, Any]:
+        if req.domains[0].startswith("fail"):
+            raise CertbotError(["certbot"], 10, "failed")
+        return {"live_gcs_path": f"gs://some-bucket/{req.domains[0]}"}
@@ -0,0 +1,123 @@
+# coding=utf-8
+"""
+Certbot process hooks tests
+"""
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from os import environ
+from os.path import join
+from tempfile import TemporaryDirectory
+from threading import Thread
+from unittest import TestCase
+from unittest.mock import patch
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+import requests
+
+from certbot_hooks import HTTP_FILE_ENV, PROPAGATION_MODE_ENV, \
+    hook_environment, http_calls, http_summary, install_hooks, \
+    read_report, site_directory, write_reports
+
+
+class Handler(BaseHTTPRequestHandler):
+    """
+    Responds with status from the path
+    """
+
+    def do_GET(self):
+        self.send_response(int(self.path.strip("/")))
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    do_POST = do_GET
+
+    def log_message(self, *args):
+        pass
+
+
+class HttpAccountingTests(TestCase):
+    """
+    Outbound HTTP requests accounting tests
+    """
+
+    def setUp(self):
+        """
+        Starts local HTTP server
+        """
+        install_hooks()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        http_calls(reset=True)
+
+    def test_requests_are_recorded(self):
+        with TemporaryDirectory() as d, \
+                patch.dict(environ, {HTTP_FILE_ENV: join(d, "http.json")}):
+            self.assertEqual(requests.get(f"{self.url}/200").status_code,
+                             200)
+            requests.post(f"{self.url}/429")
+            with self.assertRaises(HTTPError):
+                urlopen(f"{self.url}/503")
+            write_reports({})
+            calls = read_report(join(d, "http.json"))
+        self.assertEqual(calls, http_calls())
+        self.assertEqual(
+            [(c["host"], c["method"], c["status"]) for c in calls], [
+                ("127.0.0.1", "GET", "200"),
+                ("127.0.0.1", "POST", "429"),
+                ("127.0.0.1", "GET", "503"),
+            ])
+        self.assertTrue(all(c["seconds"] >= 0 for c in calls))
+
+    def test_disabled(self):
+        requests.get(f"{self.url}/200")
+        self.assertEqual(http_calls(), [])
+
+    def test_summary(self):
+        self.assertEqual(http_summary([
+            {"host": "api.cloudflare.com", "method": "GET",
+             "status": "200", "seconds": 0.25},
+            {"host": "api.cloudflare.com", "method": "POST",
+             "status": "429", "seconds": 1.5},
+            {"host": "acme-v02.api.letsencrypt.org", "method": "POST",
+             "status": "error", "seconds": 0.1},
+        ]), {
+            "requests": 3,
+            "seconds": 1.85,
+            "hosts": {
+                "api.cloudflare.com": {
+                    "requests": 2,
+                    "seconds": 1.75,
+                    "max_seconds": 1.5,
+                    "methods": {"GET": 1, "POST": 1},
+                    "statuses": {"200": 1, "429": 1},
+                },
+                "acme-v02.api.letsencrypt.org": {
+                    "requests": 1,
+                    "seconds": 0.1,
+                    "max_seconds": 0.1,
+                    "methods": {"POST": 1},
+                    "statuses": {"error": 1},
+                },
+            },
+        })
+
+
+class HookEnvironmentTests(TestCase):
+    """
+    Hooks injection into certbot subprocess tests
+    """
+
+    def test_not_needed(self):
+        self.assertEqual(hook_environment("fixed"), {})
+
+    def test_needed(self):
+        for env in (hook_environment("adaptive"),
+                    hook_environment("fixed", http_accounting=True),
+                    hook_environment("fixed", shared_propagation=True)):
+            self.assertTrue(env["PYTHONPATH"].startswith(site_directory))
+        self.assertEqual(
+            hook_environment("adaptive")[PROPAGATION_MODE_ENV],
+            "adaptive")
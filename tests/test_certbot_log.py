@@ -0,0 +1,115 @@
+# coding=utf-8
+"""
+Certbot log analysis tests
+"""
+from gzip import decompress
+from os.path import join
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from certbot_log import analyze_log, compress_log, parse_log, \
+    request_step
+
+ACME = "https://acme-v02.api.letsencrypt.org"
+
+LOG = f"""\
+2024-05-01 10:00:00,000:DEBUG:certbot._internal.main:certbot version: 2.10.0
+2024-05-01 10:00:00,500:DEBUG:acme.client:Sending GET request to \
+{ACME}/directory.
+2024-05-01 10:00:00,700:DEBUG:acme.client:Received response:
+HTTP 200
+Content-Type: application/json
+
+{{"newAccount": "{ACME}/acme/new-acct"}}
+2024-05-01 10:00:00,800:DEBUG:acme.client:Requesting fresh nonce
+2024-05-01 10:00:00,800:DEBUG:acme.client:Sending HEAD request to \
+{ACME}/acme/new-nonce.
+2024-05-01 10:00:01,000:DEBUG:acme.client:Sending POST request to \
+{ACME}/acme/new-acct:
+{{
+  "protected": "eyJhbGciOiAiRVMyNTYifQ"
+}}
+2024-05-01 10:00:01,500:DEBUG:certbot._internal.display.obj:Notifying \
+user: Account registered.
+2024-05-01 10:00:02,000:DEBUG:acme.client:Sending POST request to \
+{ACME}/acme/new-order:
+2024-05-01 10:00:02,500:DEBUG:acme.client:Sending POST request to \
+{ACME}/acme/authz-v3/1:
+2024-05-01 10:00:03,000:INFO:certbot._internal.auth_handler:Performing \
+the following challenges:
+2024-05-01 10:00:03,000:INFO:certbot._internal.auth_handler:dns-01 \
+challenge for example.com
+2024-05-01 10:00:05,000:DEBUG:certbot._internal.display.obj:Notifying \
+user: Waiting 60 seconds for DNS changes to propagate
+2024-05-01 10:01:05,000:DEBUG:acme.client:Sending POST request to \
+{ACME}/acme/chall-v3/1/abc:
+2024-05-01 10:01:05,500:INFO:certbot._internal.auth_handler:Waiting \
+for verification...
+2024-05-01 10:01:06,000:DEBUG:acme.client:Sending POST request to \
+{ACME}/acme/authz-v3/1:
+2024-05-01 10:01:08,000:DEBUG:acme.client:Sending POST request to \
+{ACME}/acme/authz-v3/1:
+2024-05-01 10:01:09,000:INFO:certbot._internal.auth_handler:Cleaning \
+up challenges
+2024-05-01 10:01:10,000:DEBUG:acme.client:Sending POST request to \
+{ACME}/acme/finalize/1/2:
+2024-05-01 10:01:11,000:DEBUG:acme.client:Sending POST request to \
+{ACME}/acme/order/1/2:
+2024-05-01 10:01:12,000:DEBUG:acme.client:Sending POST request to \
+{ACME}/acme/cert/abc:
+2024-05-01 10:01:12,400:DEBUG:certbot._internal.storage:Writing \
+certificate to /tmp/live/cert.pem
+"""
+
+
+class CertbotLogTests(TestCase):
+    """
+    ACME steps timing tests
+    """
+
+    def test_steps(self):
+        steps = [tuple(s) for s in parse_log(LOG.splitlines())]
+        self.assertEqual(steps, [
+            ("startup", 0.0, 0.5, 0),
+            ("account", 0.5, 1.5, 3),
+            ("new_order", 2.0, 0.5, 1),
+            ("authorization", 2.5, 0.5, 1),
+            ("challenge_setup", 3.0, 2.0, 0),
+            ("propagation_wait", 5.0, 60.0, 0),
+            ("validation", 65.0, 4.0, 3),
+            ("challenge_cleanup", 69.0, 1.0, 0),
+            ("finalize", 70.0, 2.0, 2),
+            ("certificate_download", 72.0, 0.4, 1),
+        ])
+
+    def test_request_step(self):
+        self.assertEqual(
+            request_step(f"{ACME}/acme/acct/123", "startup"), "account")
+        self.assertEqual(
+            request_step(f"{ACME}/acme/authz-v3/1", "validation"),
+            "validation")
+        self.assertIsNone(
+            request_step(f"{ACME}/acme/order/1/2", "finalize"))
+        self.assertIsNone(
+            request_step(f"{ACME}/acme/new-nonce", "new_order"))
+
+    def test_analyze(self):
+        with TemporaryDirectory() as d:
+            path = join(d, "letsencrypt.log")
+            self.assertIsNone(analyze_log(path))
+            with open(path, "w") as f:
+                f.write(LOG)
+            summary = analyze_log(path)
+            compress_log(path, f"{path}.gz")
+            with open(f"{path}.gz", "rb") as f:
+                self.assertEqual(decompress(f.read()).decode(), LOG)
+        self.assertEqual(summary["seconds"], 72.4)
+        self.assertEqual(summary["requests"], 11)
+        self.assertEqual(summary["totals"]["propagation_wait"], 60.0)
+        self.assertEqual(summary["steps"][0], {
+            "step": "startup", "offset": 0.0, "seconds": 0.5,
+            "requests": 0,
+        })
+
+    def test_empty_log(self):
+        self.assertEqual(parse_log(["not a record"]), [])
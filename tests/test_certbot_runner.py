@@ -0,0 +1,161 @@
+# coding=utf-8
+"""
+Certbot worker processes tests
+"""
+import sys
+from os import environ
+from os.path import join
+from subprocess import TimeoutExpired
+from tempfile import TemporaryDirectory
+from time import sleep
+from unittest import TestCase
+from unittest.mock import patch
+
+from certbot_hooks import RUSAGE_FILE_ENV, hook_environment, read_report
+from certbot_runner import InProcessRunner, SubprocessRunner, \
+    WorkerPool, certbot_runner
+from providers import preloaded_modules
+
+USAGE_KEYS = [
+    "involuntary_context_switches",
+    "max_rss_kb",
+    "system_cpu_seconds",
+    "user_cpu_seconds",
+    "voluntary_context_switches",
+]
+
+
+class InProcessRunnerTests(TestCase):
+    """
+    Certbot worker processes tests
+    """
+    runner: InProcessRunner
+
+    @classmethod
+    def setUpClass(cls):
+        """
+        Starts forkserver once for all tests
+        """
+        cls.runner = InProcessRunner(preloaded_modules)
+        cls.runner.warm()
+
+    def test_success(self):
+        code, out = self.runner.run(["certbot", "--version"], timeout=60)
+        self.assertEqual(code, 0)
+        self.assertTrue(out.startswith("certbot "))
+
+    def test_invalid_arguments(self):
+        code, out = self.runner.run(
+            ["certbot", "--not-an-option"], timeout=60)
+        self.assertEqual(code, 2)
+        self.assertIn("--not-an-option", out)
+
+    def test_resource_usage(self):
+        with TemporaryDirectory() as d:
+            path = join(d, "rusage.json")
+            code, _ = self.runner.run(["certbot", "--version"], timeout=60,
+                                      env={RUSAGE_FILE_ENV: path})
+            self.assertEqual(code, 0)
+            usage = read_report(path)
+        self.assertEqual(sorted(usage), USAGE_KEYS)
+        self.assertGreater(usage["max_rss_kb"], 0)
+        self.assertGreaterEqual(usage["user_cpu_seconds"], 0)
+
+
+class SubprocessRunnerTests(TestCase):
+    """
+    Certbot executable started per invocation tests
+    """
+
+    def test_success(self):
+        code, out = SubprocessRunner().run(["certbot", "--version"],
+                                           timeout=60)
+        self.assertEqual(code, 0)
+        self.assertTrue(out.startswith("certbot "))
+
+    def test_resource_usage(self):
+        # default run, hooks are not loaded
+        env = hook_environment("fixed")
+        self.assertEqual(env, {})
+        with TemporaryDirectory() as d:
+            path = join(d, "rusage.json")
+            self.assertIsNone(read_report(path))
+            with patch.dict(environ, {"CERTBOT_EXECUTION": "subprocess"}):
+                runner = certbot_runner()
+            code, out = runner.run(["certbot", "--version"], timeout=60,
+                                   env={**env, RUSAGE_FILE_ENV: path})
+            self.assertEqual(code, 0, out)
+            usage = read_report(path)
+        self.assertEqual(sorted(usage), USAGE_KEYS)
+        self.assertGreater(usage["max_rss_kb"], 0)
+        self.assertGreater(usage["user_cpu_seconds"], 0)
+
+    def test_timeout_resource_usage(self):
+        with TemporaryDirectory() as d:
+            path = join(d, "rusage.json")
+            with self.assertRaises(TimeoutExpired) as e:
+                SubprocessRunner().run(
+                    [sys.executable, "-c",
+                     "print('started', flush=True)\nwhile True: pass"],
+                    timeout=1, env={RUSAGE_FILE_ENV: path})
+            usage = read_report(path)
+        self.assertEqual(e.exception.output, "started\n")
+        # usage of the killed process is collected too
+        self.assertEqual(sorted(usage), USAGE_KEYS)
+        self.assertGreater(usage["user_cpu_seconds"], 0)
+
+
+class WorkerPoolTests(TestCase):
+    """
+    Pre-started certbot workers tests
+    """
+
+    def test_workers_are_recycled(self):
+        pool = WorkerPool(preloaded_modules, size=1, max_jobs=2,
+                          idle_timeout=0)
+        self.addCleanup(pool.shutdown)
+        pool.warm()
+        self.assertEqual(pool.stats()["idle"], 1)
+        for _ in range(3):
+            code, out = pool.run(["certbot", "--version"], timeout=60)
+            self.assertEqual(code, 0)
+            self.assertTrue(out.startswith("certbot "))
+        code, out = pool.run(["certbot", "--not-an-option"], timeout=60)
+        self.assertEqual(code, 2)
+        self.assertIn("--not-an-option", out)
+        stats = pool.stats()
+        self.assertEqual(stats["recycled"], 2)
+        self.assertLessEqual(stats["workers"], 1)
+
+    def test_logs_are_not_shared_between_jobs(self):
+        pool = WorkerPool(preloaded_modules, size=1, max_jobs=10,
+                          idle_timeout=0)
+        self.addCleanup(pool.shutdown)
+        with TemporaryDirectory() as d:
+            for run in ["first", "second"]:
+                code, out = pool.run([
+                    "certbot", "--noninteractive",
+                    f"--config-dir={d}/{run}/config",
+                    f"--work-dir={d}/{run}/workspace",
+                    f"--logs-dir={d}/{run}/logs",
+                    "plugins",
+                ], timeout=60)
+                self.assertEqual(code, 0, out)
+            self.assertEqual(pool.stats()["workers"], 1)
+            for run in ["first", "second"]:
+                with open(join(d, run, "logs", "letsencrypt.log")) as f:
+                    arguments = [i for i in f if "Arguments:" in i]
+                self.assertEqual(len(arguments), 1)
+                self.assertIn(f"{d}/{run}/config", arguments[0])
+
+    def test_idle_workers_are_stopped(self):
+        pool = WorkerPool(preloaded_modules, size=2, max_jobs=10,
+                          idle_timeout=0.2)
+        self.addCleanup(pool.shutdown)
+        pool.warm()
+        self.assertEqual(pool.stats()["workers"], 2)
+        sleep(1)
+        self.assertEqual(pool.stats()["workers"], 0)
+        self.assertEqual(pool.stats()["reaped"], 2)
+        code, _ = pool.run(["certbot", "--version"], timeout=60)
+        self.assertEqual(code, 0)
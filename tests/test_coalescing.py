@@ -0,0 +1,134 @@
+# coding=utf-8
+"""
+Identical requests coalescing tests
+"""
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
+from time import sleep
+from typing import Any, Dict
+from unittest import TestCase
+from unittest.mock import patch, MagicMock
+
+from coalescing import Coalescer
+from tests.BaseIntegrationTest import BaseTestCase
+
+
+class CoalescerTests(TestCase):
+    """
+    Identical calls coalescing tests
+    """
+
+    def test_concurrent_calls(self):
+        coalescer = Coalescer(ttl=0, max_size=10)
+        calls = MagicMock(side_effect=lambda: sleep(0.2) or "result")
+        with ThreadPoolExecutor(max_workers=5) as e:
+            results = list(e.map(
+                lambda _: coalescer.run("key", calls), range(5)))
+        calls.assert_called_once()
+        self.assertEqual(sorted(results), [("result", False)] +
+                         [("result", True)] * 4)
+        self.assertEqual(coalescer.stats(), {
+            "in_flight": 0, "executed": 1, "coalesced": 4, "cached": 0,
+        })
+
+    def test_cached_result(self):
+        coalescer = Coalescer(ttl=60, max_size=1)
+        self.assertEqual(coalescer.run("a", lambda: 1), (1, False))
+        self.assertEqual(coalescer.run("a", lambda: 2), (1, True))
+        self.assertEqual(coalescer.run("b", lambda: 3), (3, False))
+        # evicted by b
+        self.assertEqual(coalescer.run("a", lambda: 4), (4, False))
+
+    def test_errors_are_not_cached(self):
+        coalescer = Coalescer(ttl=60, max_size=10)
+        with self.assertRaises(ValueError):
+            coalescer.run("a", MagicMock(side_effect=ValueError()))
+        self.assertEqual(coalescer.run("a", lambda: 1), (1, False))
+
+
+class CoalescingApiTests(BaseTestCase):
+    """
+    Identical issuance requests tests
+    """
+    mock_dry_run_upload: MagicMock
+    mock_issue_certificate: MagicMock
+
+    request = {
+        "provider": "google",
+        "secret_id": "some-secret-id",
+        "project": "some-project-id",
+        "domains": ["www.example.com", "*.example.com"],
+        "email": "test@example.com",
+        "target_bucket": "some-bucket",
+        "target_bucket_path": "some-path",
+    }
+
+    def setUp(self):
+        """
+        Tests init method
+        """
+        patcher_dry_run_upload = patch("server.dry_run_upload")
+        self.addCleanup(patcher_dry_run_upload.stop)
+        self.mock_dry_run_upload = patcher_dry_run_upload.start()
+
+        patcher_issue_certificate = patch("server.issue_certificate")
+        self.addCleanup(patcher_issue_certificate.stop)
+        self.mock_issue_certificate = patcher_issue_certificate.start()
+
+    def test_identical_requests(self):
+        started = Event()
+        release = Event()
+
+        def issue(_) -> Dict[str, Any]:
+            started.set()
+            release.wait(10)
+            return {"live_gcs_path": "gs://some-bucket/some-path/live"}
+
+        self.mock_issue_certificate.side_effect = issue
+        with ThreadPoolExecutor(max_workers=2) as e:
+            first = e.submit(self.app.test_client().post, "/certs",
+                             json=self.request)
+            started.wait(10)
+            second = e.submit(self.app.test_client().post, "/certs",
+                              json={**self.request,
+                                    "domains": ["*.EXAMPLE.com",
+                                                "WWW.example.com."],
+                                    "target_bucket_path": "some-path/",
+                                    "email": "other@example.com"})
+            sleep(0.2)
+            release.set()
+            responses = [first.result(), second.result()]
+        self.assertEqual([r.status_code for r in responses], [200, 200])
+        self.assertNotIn("coalesced", responses[0].json["result"])
+        self.assertTrue(responses[1].json["result"]["coalesced"])
+        self.mock_issue_certificate.assert_called_once()
+
+        # served from recently finished results
+        response = self.http().post("/certs", json=self.request)
+        self.assertTrue(response.json["result"]["coalesced"])
+        self.mock_issue_certificate.assert_called_once()
+
+        response = self.http().post("/certs", json={
+            **self.request, "target_bucket_path": "other-path"})
+        self.assertNotIn("coalesced", response.json["result"])
+        self.assertEqual(self.mock_issue_certificate.call_count, 2)
+
+    def test_renewal_options_are_part_of_key(self):
+        self.mock_issue_certificate.return_value = {
+            "live_gcs_path": "gs://some-bucket/some-path/live"}
+        with patch("server.find_valid_certificate") as find:
+            find.side_effect = lambda req: None \
+                if req.renew_before_days is None \
+                else {"skipped": "Certificate is still valid"}
+            response = self.http().post("/certs", json={
+                **self.request, "renew_before_days": 30})
+            self.assertIn("skipped", response.json["result"])
+
+            # a skipped renewal isn't served to a forced or copy request
+            for request in [self.request,
+                            {**self.request, "renew_before_days": 30,
+                             "publish_mode": "copy"}]:
+                response = self.http().post("/certs", json=request)
+                self.assertNotIn("coalesced", response.json["result"])
+        self.assertEqual(find.call_count, 3)
+        self.mock_issue_certificate.assert_called_once()
@@ -28,6 +28,11 @@ class DtoTests(TestCase):
             "project": "some-project-id",
             "domains": ["*.example.com", "www.example.com"],
             "propagation_seconds": 600,
+            "renew_before_days": 30,
+            "publish_mode": "copy",
+            "propagation_mode": "adaptive",
+            "plan_only": False,
+            "drop_covered": False,
             "email": "test@example.com",
             "target_bucket": "some-bucket",
             "target_bucket_path": "some-path",
@@ -61,6 +66,11 @@ class DtoTests(TestCase):
                     "project": "some-project-id",
                     "domains": ["*.example.com", "www.example.com"],
                     "propagation_seconds": 60,
+                    "renew_before_days": None,
+                    "publish_mode": "upload",
+                    "propagation_mode": "fixed",
+                    "plan_only": False,
+                    "drop_covered": False,
                     "email": "test@example.com",
                     "target_bucket": "some-bucket",
                     "target_bucket_path": "some-path",
@@ -2,17 +2,32 @@
 """
 End-to-end tests
 """
-from datetime import datetime
-from itertools import zip_longest
-from os import makedirs
+from datetime import datetime, timedelta
+from json import dumps, loads
+from os import makedirs, environ, pathsep
 from os.path import join, exists
 from subprocess import TimeoutExpired
+from tempfile import TemporaryDirectory
 from typing import Callable, Any, List, Tuple, Optional, Dict
 from unittest.mock import patch, MagicMock
 
+from cryptography.hazmat.primitives.asymmetric.ec import \
+    generate_private_key, SECP256R1
+from cryptography.hazmat.primitives.hashes import SHA256
+from cryptography.hazmat.primitives.serialization import Encoding
+from cryptography.x509 import CertificateBuilder, Name, NameAttribute, \
+    SubjectAlternativeName, DNSName, random_serial_number
+from cryptography.x509.oid import NameOID
+# noinspection PyPackageRequirements
+from google.api_core.exceptions import Forbidden
+from pytz import UTC
+
 from BaseIntegrationTest import BaseTestCase
+from certbot_hooks import hook_environment, site_directory
+from gcs import clients
 from service import prepare_certbot_directory, CertbotEnv, \
-    issue_certificate
+    issue_certificate, secrets
+from state import lineage_name
 
 
 class EndToEndTests(BaseTestCase):
@@ -23,9 +38,10 @@ class EndToEndTests(BaseTestCase):
     mock_storage_client: MagicMock
     mock_storage_bucket: MagicMock
     mock_storage_blob: MagicMock
-    mock_run_subprocess: MagicMock
+    mock_run_certbot: MagicMock
     mock_issue_certs: MagicMock
     certbot_env: CertbotEnv
+    temp_directory: str
 
     bucket: MagicMock
     blob: MagicMock
@@ -39,11 +55,11 @@ class EndToEndTests(BaseTestCase):
             autospec=True,
         )
         patcher_storage_client = patch(
-            "service.Client",
+            "gcs.Client",
             autospec=True,
         )
-        patcher_run_subprocess = patch(
-            "service.run_subprocess"
+        patcher_run_certbot = patch(
+            "certbot_runner.SubprocessRunner.run"
         )
         patcher_prepare_dir = patch(
             "service.prepare_certbot_directory"
@@ -56,20 +72,28 @@ class EndToEndTests(BaseTestCase):
         )
         self.addCleanup(patcher_secrets_client.stop)
         self.addCleanup(patcher_storage_client.stop)
-        self.addCleanup(patcher_run_subprocess.stop)
+        self.addCleanup(patcher_run_certbot.stop)
         self.addCleanup(patcher_prepare_dir.stop)
         self.addCleanup(patcher_datetime.stop)
         self.addCleanup(patcher_issue_certs.stop)
         self.mock_secrets_client = patcher_secrets_client.start()
         self.mock_storage_client = patcher_storage_client.start()
-        self.mock_run_subprocess = patcher_run_subprocess.start()
+        self.mock_run_certbot = patcher_run_certbot.start()
         self.mock_prepare_dir = patcher_prepare_dir.start()
         self.mock_datetime = patcher_datetime.start()
         self.mock_issue_certs = patcher_issue_certs.start()
+        secrets.clear()
+        self.addCleanup(secrets.clear)
+        clients.clear()
+        self.addCleanup(clients.clear)
 
         self.bucket = self.mock_storage_client.return_value \
             .get_bucket.return_value
-        self.blob = self.bucket.blob.return_value
+        # uploads are concurrent, so every path gets its own blob
+        # recording calls and delegating behavior to the shared one
+        self.blob = MagicMock()
+        self.blob_calls = []
+        self.bucket.blob.side_effect = self._blob
 
         # some default behavior stuff
         self.bucket.name = "some-bucket"
@@ -78,7 +102,7 @@ class EndToEndTests(BaseTestCase):
         self.mock_secrets_client.return_value \
             .access_secret_version.return_value \
             .payload.data = "some-data".encode("utf-8")
-        self.mock_run_subprocess.return_value = 0, "ok"
+        self.mock_run_certbot.return_value = 0, "ok"
         self.mock_datetime.now.return_value = datetime(
             year=1996, month=2, day=22, hour=9, minute=10, second=11)
         self.mocked_time = "1996-02-22_09-10-11_UTC"
@@ -100,7 +124,17 @@ class EndToEndTests(BaseTestCase):
         }
         response = self.http().post("/certs", json=req)
         self.assert200(response)
-        self.assertEqual(response.json, {
+        rsp = response.json
+        upload = rsp["result"].pop("upload")
+        self.assertIsNone(rsp["result"].pop("rusage"))
+        self.assertIsNone(rsp["result"].pop("acme"))
+        self.assertIsNone(rsp["result"].pop("http"))
+        self.assertEqual(sorted(rsp.pop("timings")), [
+            "certbot", "dry_run_upload", "get_secret_value",
+            "issue_certificate", "plan", "prepare_certbot_directory",
+            "renewal_check", "upload_directory",
+        ])
+        self.assertEqual(rsp, {
             "result": {
                 "live_gcs_path": "gs://some-bucket/some-path/live",
                 "timed_gcs_path": "gs://some-bucket/some-path"
@@ -108,12 +142,14 @@ class EndToEndTests(BaseTestCase):
             },
             "success": True
         })
+        self.assertEqual(upload["files"], 8)
+        self.assertEqual(upload["bytes"], 0)
 
         self._assert_secret_fetch()
         self._assert_certbot_env()
         self._assert_certbot_workdir_cleaned()
 
-        self.mock_run_subprocess.assert_called_once_with([
+        self.mock_run_certbot.assert_called_once_with([
             "certbot", "--noninteractive",
             f"--config-dir={self.certbot_env.config_dir}",
             f"--work-dir={self.certbot_env.workspace_dir}",
@@ -126,15 +162,73 @@ class EndToEndTests(BaseTestCase):
             "--dns-google-propagation-seconds", "600",
             "--cert-name", f"{self.certbot_env.cert_name}",
             "-d", "*.example.com", "-d", "www.example.com"
-        ], timeout=1200, shell=False, stdin=None, )
+        ], timeout=1200,
+            env=self._certbot_process_env())
 
         self._assert_file_uploads([
             "chain.pem", "certificate.pem",
             "fullchain.pem", "privkey.pem"
         ], expect_log_file=True, time=self.mocked_time)
 
+    def test_metrics(self):
+        self._mock_cert_files_creation()
+        req = {
+            "provider": "google",
+            "secret_id": "some-secret-id",
+            "project": "some-project-id",
+            "domains": ["*.example.com"],
+            "propagation_seconds": 600,
+            "email": "test@example.com",
+            "target_bucket": "some-bucket",
+            "target_bucket_path": "some-path",
+        }
+        self.assert200(self.http().post("/certs", json=req))
+        self.mock_run_certbot.return_value = 1, "something is wrong"
+        self.assert500(self.http().post("/certs", json={
+            **req, "target_bucket_path": "other-path"}))
+
+        response = self.http().get("/metrics")
+        self.assert200(response)
+        self.assertTrue(response.content_type.startswith("text/plain"))
+        lines: List[str] = response.data.decode("utf-8").split("\n")
+        for name, outcome, count in (
+                ("plan", "success", 2),
+                ("renewal_check", "success", 2),
+                ("dry_run_upload", "success", 2),
+                ("get_secret_value", "success", 2),
+                ("prepare_certbot_directory", "success", 2),
+                ("certbot", "success", 1),
+                ("certbot", "error", 1),
+                ("upload_directory", "success", 1),
+                ("issue_certificate", "error", 1)):
+            self.assertIn(
+                f'certbot_updater_phase_seconds_count{{phase="{name}",'
+                f'provider="google",outcome="{outcome}"}} {count}',
+                lines)
+        self.assertIn(
+            'certbot_updater_errors_total{type="CertbotError"} 1', lines)
+        self.assertIn(
+            'certbot_updater_secret_cache{stat="misses"} 1', lines)
+        self.assertIn(
+            'certbot_updater_secret_cache{stat="hits"} 1', lines)
+        self.assertEqual(
+            self.http().get("/stats").json["secret_cache"], {
+                "size": 1, "hits": 1, "misses": 1,
+                "revalidations": 0, "rotations": 0,
+            })
+        self.assertIn(
+            'certbot_updater_gcs_clients{stat="clients_created"} 1', lines)
+        stats = self.http().get("/stats").json["gcs"]
+        self.assertEqual(stats["clients_created"], 1)
+        self.assertGreater(stats["buckets_reused"], 0)
+
     def test_certbot_failed(self):
-        self.mock_run_subprocess.return_value = 1, "something is wrong"
+        def run(*args, env: Dict[str, str], **kwargs) -> Tuple[int, str]:
+            with open(env["CERTBOT_RUSAGE_FILE"], "w") as f:
+                f.write('{"user_cpu_seconds": 0.5}')
+            return 1, "something is wrong"
+
+        self.mock_run_certbot.side_effect = run
         self._intercept_workdir(lambda *args: None)
 
         req = {
@@ -165,11 +259,16 @@ class EndToEndTests(BaseTestCase):
             "--cert-name", f"{self.certbot_env.cert_name}",
             "-d", "*.example.com", "-d", "www.example.com"
         ]
-        self.assertEqual(response.json, {
+        rsp = response.json
+        self.assertIn("plan", rsp.pop("timings"))
+        self.assertEqual(rsp, {
             "error": {
                 "command": expected_certbot_command,
                 "message": "Certbot instance failed",
                 "output": ["something is wrong"],
+                "rusage": {"user_cpu_seconds": 0.5},
+                "acme": None,
+                "http": None,
                 "timeout": 1200,
                 "type": "CertbotError"
             },
@@ -180,11 +279,10 @@ class EndToEndTests(BaseTestCase):
         self._assert_certbot_env()
         self._assert_certbot_workdir_cleaned()
 
-        self.mock_run_subprocess.assert_called_once_with(
+        self.mock_run_certbot.assert_called_once_with(
             expected_certbot_command,
             timeout=1200,
-            shell=False,
-            stdin=None,
+            env=self._certbot_process_env(),
         )
 
         self._assert_file_uploads(
@@ -193,7 +291,7 @@ class EndToEndTests(BaseTestCase):
         )
 
     def test_certbot_failed_exc(self):
-        self.mock_run_subprocess.return_value = OSError("some-err")
+        self.mock_run_certbot.return_value = OSError("some-err")
         self._intercept_workdir(lambda *args: None)
 
         req = {
@@ -224,11 +322,16 @@ class EndToEndTests(BaseTestCase):
             "--cert-name", f"{self.certbot_env.cert_name}",
             "-d", "*.example.com", "-d", "www.example.com"
         ]
-        self.assertEqual(response.json, {
+        rsp = response.json
+        self.assertIn("plan", rsp.pop("timings"))
+        self.assertEqual(rsp, {
             "error": {
                 "command": expected_certbot_command,
                 "message": "Certbot instance failed",
                 "output": [""],
+                "rusage": None,
+                "acme": None,
+                "http": None,
                 "timeout": 1200,
                 "type": "CertbotError"
             },
@@ -239,11 +342,10 @@ class EndToEndTests(BaseTestCase):
         self._assert_certbot_env()
         self._assert_certbot_workdir_cleaned()
 
-        self.mock_run_subprocess.assert_called_once_with(
+        self.mock_run_certbot.assert_called_once_with(
             expected_certbot_command,
             timeout=1200,
-            shell=False,
-            stdin=None,
+            env=self._certbot_process_env(),
         )
 
         self._assert_file_uploads(
@@ -266,7 +368,9 @@ class EndToEndTests(BaseTestCase):
 
         response = self.http().post("/certs", json=req)
         self.assert500(response)
-        self.assertEqual(response.json, {
+        rsp = response.json
+        self.assertIn("plan", rsp.pop("timings"))
+        self.assertEqual(rsp, {
             "error": {
                 "message": "Generic error happened. "
                            "Check logs for details",
@@ -276,7 +380,7 @@ class EndToEndTests(BaseTestCase):
         })
 
         self._assert_secret_no_fetch()
-        self.mock_run_subprocess.assert_not_called()
+        self.mock_run_certbot.assert_not_called()
 
         self._assert_file_uploads(
             [], expect_log_file=True,
@@ -284,7 +388,7 @@ class EndToEndTests(BaseTestCase):
         )
 
     def test_certbot_timeout(self):
-        self.mock_run_subprocess.side_effect = \
+        self.mock_run_certbot.side_effect = \
             TimeoutExpired(["a", "command"], timeout=1,
                            output="some output")
         self._intercept_workdir(lambda *args: None)
@@ -317,11 +421,16 @@ class EndToEndTests(BaseTestCase):
             "--cert-name", f"{self.certbot_env.cert_name}",
             "-d", "*.example.com", "-d", "www.example.com"
         ]
-        self.assertEqual(response.json, {
+        rsp = response.json
+        self.assertIn("plan", rsp.pop("timings"))
+        self.assertEqual(rsp, {
             "error": {
                 "command": expected_certbot_command,
                 "message": "Certbot instance aborted by timeout",
                 "output": ["some output"],
+                "rusage": None,
+                "acme": None,
+                "http": None,
                 "timeout": 1200,
                 "type": "CertbotTimeoutError"
             },
@@ -332,11 +441,10 @@ class EndToEndTests(BaseTestCase):
         self._assert_certbot_env()
         self._assert_certbot_workdir_cleaned()
 
-        self.mock_run_subprocess.assert_called_once_with(
+        self.mock_run_certbot.assert_called_once_with(
             expected_certbot_command,
             timeout=1200,
-            shell=False,
-            stdin=None,
+            env=self._certbot_process_env(),
         )
 
         self._assert_file_uploads(
@@ -362,7 +470,9 @@ class EndToEndTests(BaseTestCase):
 
         response = self.http().post("/certs", json=req)
         self.assert500(response)
-        self.assertEqual(response.json, {
+        rsp = response.json
+        self.assertIn("plan", rsp.pop("timings"))
+        self.assertEqual(rsp, {
             "error": {
                 "bucket": "some-bucket",
                 "bucket_path": "some-path/logs/1996-02-22_09-10-11_UTC",
@@ -375,7 +485,7 @@ class EndToEndTests(BaseTestCase):
         })
 
         self._assert_secret_no_fetch()
-        self.mock_run_subprocess.assert_not_called()
+        self.mock_run_certbot.assert_not_called()
 
         self._assert_file_uploads(
             [], expect_log_file=True,
@@ -387,6 +497,10 @@ class EndToEndTests(BaseTestCase):
         self.mock_storage_client.return_value.get_bucket.side_effect = [
             self.bucket, ValueError("bucket get error")
         ]
+        # bucket handle has to be fetched again to fail
+        patcher_bucket_ttl = patch.object(clients, "bucket_ttl", 0)
+        self.addCleanup(patcher_bucket_ttl.stop)
+        patcher_bucket_ttl.start()
 
         req = {
             "provider": "google",
@@ -401,11 +515,14 @@ class EndToEndTests(BaseTestCase):
 
         response = self.http().post("/certs", json=req)
         self.assert500(response)
-        self.assertEqual(response.json, {
+        rsp = response.json
+        self.assertIn("plan", rsp.pop("timings"))
+        self.assertEqual(rsp, {
             "error": {
-                "message": "Generic error happened. "
-                           "Check logs for details",
-                "type": "GCSError"},
+                "message": "There is a problem with GCS bucket access. "
+                           "Check logs and bucket permissions.",
+                "type": "GCSError",
+                "bucket": "some-bucket"},
             "success": False
         })
 
@@ -413,7 +530,7 @@ class EndToEndTests(BaseTestCase):
         self._assert_certbot_env()
         self._assert_certbot_workdir_cleaned()
 
-        self.mock_run_subprocess.assert_called_once_with([
+        self.mock_run_certbot.assert_called_once_with([
             "certbot", "--noninteractive",
             f"--config-dir={self.certbot_env.config_dir}",
             f"--work-dir={self.certbot_env.workspace_dir}",
@@ -426,7 +543,8 @@ class EndToEndTests(BaseTestCase):
             "--dns-google-propagation-seconds", "600",
             "--cert-name", f"{self.certbot_env.cert_name}",
             "-d", "*.example.com", "-d", "www.example.com"
-        ], timeout=1200, shell=False, stdin=None, )
+        ], timeout=1200,
+            env=self._certbot_process_env())
 
         self._assert_file_uploads(
             [], expect_log_file=True,
@@ -451,7 +569,9 @@ class EndToEndTests(BaseTestCase):
 
         response = self.http().post("/certs", json=req)
         self.assert500(response)
-        self.assertEqual(response.json, {
+        rsp = response.json
+        self.assertIn("plan", rsp.pop("timings"))
+        self.assertEqual(rsp, {
             "error": {
                 "message": "There is a problem with DNS provider "
                            "secret fetch error. "
@@ -462,7 +582,7 @@ class EndToEndTests(BaseTestCase):
         })
 
         self._assert_secret_fetch()
-        self.mock_run_subprocess.assert_not_called()
+        self.mock_run_certbot.assert_not_called()
 
         self._assert_file_uploads(
             [], expect_log_file=True,
@@ -486,7 +606,9 @@ class EndToEndTests(BaseTestCase):
         }
         response = self.http().post("/certs", json=req)
         self.assert500(response)
-        self.assertEqual(response.json, {
+        rsp = response.json
+        self.assertIn("plan", rsp.pop("timings"))
+        self.assertEqual(rsp, {
             "error": {
                 "bucket": "some-bucket",
                 "bucket_path": "some-path/live/certificate.pem",
@@ -494,7 +616,15 @@ class EndToEndTests(BaseTestCase):
                            "file upload to GCS.",
                 "source_path": f"{self.certbot_env.certificates_dir}"
                                f"/certificate.pem",
-                "type": "GCSUploadError"
+                "type": "GCSUploadError",
+                "failures": [{
+                    "bucket_path": f"some-path/{path}/{i}",
+                    "source_path": f"{self.certbot_env.certificates_dir}"
+                                   f"/{i}",
+                } for path in ["live", self.mocked_time] for i in [
+                    "certificate.pem", "chain.pem",
+                    "fullchain.pem", "privkey.pem"
+                ]],
             },
             "success": False
         })
@@ -503,7 +633,7 @@ class EndToEndTests(BaseTestCase):
         self._assert_certbot_env()
         self._assert_certbot_workdir_cleaned()
 
-        self.mock_run_subprocess.assert_called_once_with([
+        self.mock_run_certbot.assert_called_once_with([
             "certbot", "--noninteractive",
             f"--config-dir={self.certbot_env.config_dir}",
             f"--work-dir={self.certbot_env.workspace_dir}",
@@ -516,14 +646,435 @@ class EndToEndTests(BaseTestCase):
             "--dns-google-propagation-seconds", "600",
             "--cert-name", f"{self.certbot_env.cert_name}",
             "-d", "*.example.com", "-d", "www.example.com"
-        ], timeout=1200, shell=False, stdin=None, )
+        ], timeout=1200,
+            env=self._certbot_process_env())
 
+        # all files are attempted even if some of them have failed
         self._assert_file_uploads([
-            "certificate.pem"
-        ], expect_log_file=True,
-            time=self.mocked_time,
-            live_only={"certificate.pem": True}
-        )
+            "chain.pem", "certificate.pem",
+            "fullchain.pem", "privkey.pem"
+        ], expect_log_file=True, time=self.mocked_time)
+
+    def test_renewal_skipped(self):
+        now = datetime(year=1996, month=2, day=22, tzinfo=UTC)
+        self.mock_datetime.now.return_value = now
+        self.blob.download_as_bytes.return_value = self._certificate(
+            ["*.example.com", "www.example.com"],
+            not_after=now + timedelta(days=60))
+
+        req = {
+            "provider": "google",
+            "secret_id": "some-secret-id",
+            "project": "some-project-id",
+            "domains": ["*.example.com", "www.example.com"],
+            "propagation_seconds": 600,
+            "renew_before_days": 30,
+            "email": "test@example.com",
+            "target_bucket": "some-bucket",
+            "target_bucket_path": "some-path",
+        }
+        response = self.http().post("/certs", json=req)
+        self.assert200(response)
+        rsp = response.json
+        self.assertIn("plan", rsp.pop("timings"))
+        self.assertEqual(rsp, {
+            "result": {
+                "skipped": True,
+                "live_gcs_path": "gs://some-bucket/some-path/live",
+                "expires_at": "1996-04-22T00:00:00+00:00"
+            },
+            "success": True
+        })
+        self.bucket.blob.assert_called_once_with(
+            "some-path/live/cert.pem")
+        self._assert_secret_no_fetch()
+        self.mock_run_certbot.assert_not_called()
+        self.blob.upload_from_string.assert_not_called()
+        self.blob.upload_from_filename.assert_not_called()
+
+    def test_renewal_due(self):
+        self._mock_cert_files_creation()
+        now = datetime(year=1996, month=2, day=22, tzinfo=UTC)
+        self.mock_datetime.now.return_value = now
+        self.blob.download_as_bytes.return_value = self._certificate(
+            ["*.example.com", "www.example.com"],
+            not_after=now + timedelta(days=20))
+
+        req = {
+            "provider": "google",
+            "secret_id": "some-secret-id",
+            "project": "some-project-id",
+            "domains": ["*.example.com", "www.example.com"],
+            "propagation_seconds": 600,
+            "renew_before_days": 30,
+            "email": "test@example.com",
+            "target_bucket": "some-bucket",
+            "target_bucket_path": "some-path",
+        }
+        response = self.http().post("/certs", json=req)
+        self.assert200(response)
+        self.assertEqual(response.json["result"]["live_gcs_path"],
+                         "gs://some-bucket/some-path/live")
+        self._assert_secret_fetch()
+        self.mock_run_certbot.assert_called_once()
+
+    def test_renewal_domains_changed(self):
+        self._mock_cert_files_creation()
+        now = datetime(year=1996, month=2, day=22, tzinfo=UTC)
+        self.mock_datetime.now.return_value = now
+        self.blob.download_as_bytes.return_value = self._certificate(
+            ["*.example.com"],
+            not_after=now + timedelta(days=60))
+
+        req = {
+            "provider": "google",
+            "secret_id": "some-secret-id",
+            "project": "some-project-id",
+            "domains": ["*.example.com", "www.example.com"],
+            "propagation_seconds": 600,
+            "renew_before_days": 30,
+            "email": "test@example.com",
+            "target_bucket": "some-bucket",
+            "target_bucket_path": "some-path",
+        }
+        response = self.http().post("/certs", json=req)
+        self.assert200(response)
+        self.assertNotIn("skipped", response.json["result"])
+        self.mock_run_certbot.assert_called_once()
+
+    def test_renewal_live_certificate_unreadable(self):
+        self._mock_cert_files_creation()
+        now = datetime(year=1996, month=2, day=22, tzinfo=UTC)
+        self.mock_datetime.now.return_value = now
+        without_names = self._certificate(
+            [], not_after=now + timedelta(days=60))
+        req = {
+            "provider": "google",
+            "secret_id": "some-secret-id",
+            "project": "some-project-id",
+            "domains": ["*.example.com"],
+            "propagation_seconds": 600,
+            "renew_before_days": 30,
+            "email": "test@example.com",
+            "target_bucket": "some-bucket",
+            "target_bucket_path": "some-path",
+        }
+        for data in [b"corrupted", without_names]:
+            self.blob.download_as_bytes.return_value = data
+            response = self.http().post(
+                "/certs", json={**req, "target_bucket_path": str(data)})
+            self.assert200(response)
+            self.assertNotIn("skipped", response.json["result"])
+        self.assertEqual(self.mock_run_certbot.call_count, 2)
+
+    def test_renewal_check_forbidden(self):
+        self.blob.download_as_bytes.side_effect = Forbidden("denied")
+        response = self.http().post("/certs", json={
+            "provider": "google",
+            "secret_id": "some-secret-id",
+            "project": "some-project-id",
+            "domains": ["*.example.com"],
+            "propagation_seconds": 600,
+            "renew_before_days": 30,
+            "email": "test@example.com",
+            "target_bucket": "some-bucket",
+            "target_bucket_path": "some-path",
+        })
+        self.assert500(response)
+        self.assertEqual(response.json["error"], {
+            "message": "There is a problem with GCS bucket access. "
+                       "Check logs and bucket permissions.",
+            "type": "GCSError",
+            "bucket": "some-bucket",
+        })
+        self.mock_run_certbot.assert_not_called()
+
+    def test_copy_publish_mode(self):
+        self._mock_cert_files_creation()
+        self.bucket.get_blob.return_value = MagicMock(generation=7)
+        self.bucket.copy_blob.side_effect = \
+            lambda blob, bucket, name: MagicMock(generation=len(name))
+        files = ["certificate.pem", "chain.pem",
+                 "fullchain.pem", "privkey.pem"]
+
+        req = {
+            "provider": "google",
+            "secret_id": "some-secret-id",
+            "project": "some-project-id",
+            "domains": ["*.example.com", "www.example.com"],
+            "propagation_seconds": 600,
+            "publish_mode": "copy",
+            "email": "test@example.com",
+            "target_bucket": "some-bucket",
+            "target_bucket_path": "some-path",
+        }
+        response = self.http().post("/certs", json=req)
+        self.assert200(response)
+        rsp = response.json
+        self.assertEqual(rsp["result"]["upload"]["files"], 4)
+        self.assertEqual(rsp["result"]["manifest_gcs_path"],
+                         "gs://some-bucket/some-path/manifest.json")
+        self.assertEqual(rsp["result"]["live_gcs_path"],
+                         "gs://some-bucket/some-path/live")
+
+        # uploaded once, live objects are server-side copies
+        uploaded = [i[1][0][0] for i in self.blob_calls
+                    if i[0][0] == "upload_from_filename"]
+        self.assertCountEqual(
+            uploaded, [f"some-path/{self.mocked_time}/{i}" for i in files])
+        self.assertCountEqual(
+            [c.args[2] for c in self.bucket.copy_blob.call_args_list],
+            [f"some-path/live/{i}" for i in files])
+
+        manifest = [i for i in self.blob_calls
+                    if i[1][0][0] == "some-path/manifest.json"]
+        self.assertEqual(len(manifest), 1)
+        self.assertEqual(manifest[0][0][2]["if_generation_match"], 7)
+        self.assertEqual(loads(manifest[0][0][2]["data"]), {
+            "issued_at": "1996-02-22T09:10:11",
+            "timed_path": f"some-path/{self.mocked_time}",
+            "live_path": "some-path/live",
+            "files": {i: {"generation": len(f"some-path/live/{i}")}
+                      for i in files},
+        })
+
+    def test_copy_publish_mode_unchanged_live_kept(self):
+        self._mock_cert_files_creation()
+        self.bucket.get_blob.return_value = None
+        self.bucket.copy_blob.side_effect = \
+            lambda blob, bucket, name: MagicMock(generation=1)
+
+        def _list_blobs(prefix: str, **kwargs) -> List[MagicMock]:
+            if prefix != "some-path/live/":
+                return []
+            blob = MagicMock(crc32c="AAAAAA==",
+                             md5_hash="1B2M2Y8AsgTpgAmY7PhCfg==",
+                             generation=5)
+            blob.name = "some-path/live/chain.pem"
+            return [blob]
+
+        self.bucket.list_blobs.side_effect = _list_blobs
+        response = self.http().post("/certs", json={
+            "provider": "google",
+            "secret_id": "some-secret-id",
+            "project": "some-project-id",
+            "domains": ["*.example.com"],
+            "propagation_seconds": 600,
+            "publish_mode": "copy",
+            "email": "test@example.com",
+            "target_bucket": "some-bucket",
+            "target_bucket_path": "some-path",
+        })
+        self.assert200(response)
+        copied = [c.args[2] for c in self.bucket.copy_blob.call_args_list]
+        self.assertEqual(len(copied), 3)
+        self.assertNotIn("some-path/live/chain.pem", copied)
+        [manifest] = [i for i in self.blob_calls
+                      if i[1][0][0] == "some-path/manifest.json"]
+        self.assertEqual(manifest[0][2]["if_generation_match"], 0)
+        self.assertEqual(loads(manifest[0][2]["data"])["files"][
+            "chain.pem"], {"generation": 5})
+
+    def test_unchanged_files_skipped(self):
+        self._mock_cert_files_creation()
+
+        def _list_blobs(prefix: str, **kwargs) -> List[MagicMock]:
+            if prefix != "some-path/live/":
+                return []
+            blob = MagicMock(crc32c="AAAAAA==",
+                             md5_hash="1B2M2Y8AsgTpgAmY7PhCfg==")
+            blob.name = "some-path/live/chain.pem"
+            return [blob]
+
+        self.bucket.list_blobs.side_effect = _list_blobs
+        req = {
+            "provider": "google",
+            "secret_id": "some-secret-id",
+            "project": "some-project-id",
+            "domains": ["*.example.com", "www.example.com"],
+            "propagation_seconds": 600,
+            "email": "test@example.com",
+            "target_bucket": "some-bucket",
+            "target_bucket_path": "some-path",
+        }
+        response = self.http().post("/certs", json=req)
+        self.assert200(response)
+        upload = response.json["result"]["upload"]
+        self.assertEqual(upload["files"], 8)
+        self.assertEqual(upload["uploaded"], 7)
+        self.assertEqual(upload["skipped"], 1)
+        uploaded = [i[1][0][0] for i in self.blob_calls
+                    if i[0][0] == "upload_from_filename"]
+        self.assertNotIn("some-path/live/chain.pem", uploaded)
+        self.assertIn(f"some-path/{self.mocked_time}/chain.pem",
+                      uploaded)
+
+    def test_state_store(self):
+        self._mock_cert_files_creation()
+        req = {
+            "provider": "google",
+            "secret_id": "some-secret-id",
+            "project": "some-project-id",
+            "domains": ["*.example.com", "www.example.com"],
+            "propagation_seconds": 600,
+            "email": "test@example.com",
+            "target_bucket": "some-bucket",
+            "target_bucket_path": "some-path",
+        }
+        with TemporaryDirectory() as d, \
+                patch.dict(environ, {"CERTBOT_STATE_URL": d}):
+            response = self.http().post("/certs", json=req)
+            self.assert200(response)
+            name = lineage_name(["*.example.com", "www.example.com"])
+            self.assertEqual(self.certbot_env.cert_name, name)
+            self.assertTrue(exists(join(d, f"{name}.tar.gz")))
+        self._assert_certbot_workdir_cleaned()
+
+    def test_certbot_log(self):
+        self._mock_cert_files_creation()
+
+        def run(command: List[str], **kwargs) -> Tuple[int, str]:
+            with open(join(self.certbot_env.logs_dir, "letsencrypt.log"),
+                      "w") as f:
+                f.write(
+                    "2024-05-01 10:00:00,000:INFO:certbot:Performing "
+                    "the following challenges:\n"
+                    "2024-05-01 10:00:01,000:DEBUG:certbot:Notifying user: "
+                    "Waiting 600 seconds for DNS changes to propagate\n"
+                    "2024-05-01 10:10:01,500:DEBUG:acme.client:Sending "
+                    "POST request to https://acme/cert/1:\n")
+            return 0, "ok"
+
+        self.mock_run_certbot.side_effect = run
+        req = {
+            "provider": "google",
+            "secret_id": "some-secret-id",
+            "project": "some-project-id",
+            "domains": ["*.example.com"],
+            "propagation_seconds": 600,
+            "email": "test@example.com",
+            "target_bucket": "some-bucket",
+            "target_bucket_path": "some-path",
+        }
+        with patch("service.CERTBOT_LOG_UPLOAD", True):
+            response = self.http().post("/certs", json=req)
+        self.assert200(response)
+        result = response.json["result"]
+        self.assertEqual(result["acme"]["totals"], {
+            "challenge_setup": 1.0,
+            "propagation_wait": 600.5,
+            "certificate_download": 0.0,
+        })
+        self.assertEqual(
+            result["log_gcs_path"],
+            f"gs://some-bucket/some-path/logs/{self.mocked_time}.log.gz")
+        uploaded = [i[1][0][0] for i in self.blob_calls
+                    if i[0][0] == "upload_from_filename"]
+        self.assertIn(f"some-path/logs/{self.mocked_time}.log.gz",
+                      uploaded)
+        self.assertIn("upload_log", response.json["timings"])
+
+    def test_http_accounting(self):
+        self._mock_cert_files_creation()
+
+        def run(command: List[str], env: Dict[str, str],
+                **kwargs) -> Tuple[int, str]:
+            with open(env["CERTBOT_HTTP_FILE"], "w") as f:
+                f.write(dumps([
+                    {"host": "dns.googleapis.com", "method": "POST",
+                     "status": "429", "seconds": 2.5},
+                    {"host": "dns.googleapis.com", "method": "POST",
+                     "status": "200", "seconds": 0.5},
+                ]))
+            return 0, "ok"
+
+        self.mock_run_certbot.side_effect = run
+        req = {
+            "provider": "google",
+            "secret_id": "some-secret-id",
+            "project": "some-project-id",
+            "domains": ["*.example.com"],
+            "propagation_seconds": 600,
+            "email": "test@example.com",
+            "target_bucket": "some-bucket",
+            "target_bucket_path": "some-path",
+        }
+        with patch("service.CERTBOT_HTTP_ACCOUNTING", True):
+            response = self.http().post("/certs", json=req)
+        self.assert200(response)
+        self.assertEqual(response.json["result"]["http"], {
+            "requests": 2,
+            "seconds": 3.0,
+            "hosts": {
+                "dns.googleapis.com": {
+                    "requests": 2,
+                    "seconds": 3.0,
+                    "max_seconds": 2.5,
+                    "methods": {"POST": 2},
+                    "statuses": {"200": 1, "429": 1},
+                },
+            },
+        })
+        lines: List[str] = \
+            self.http().get("/metrics").data.decode("utf-8").split("\n")
+        self.assertIn(
+            "certbot_updater_certbot_http_seconds_count"
+            '{host="dns.googleapis.com",provider="google",status="429"} 1',
+            lines)
+
+    def test_adaptive_propagation(self):
+        self._mock_cert_files_creation()
+        req = {
+            "provider": "google",
+            "secret_id": "some-secret-id",
+            "project": "some-project-id",
+            "domains": ["*.example.com", "www.example.com"],
+            "propagation_seconds": 600,
+            "propagation_mode": "adaptive",
+            "email": "test@example.com",
+            "target_bucket": "some-bucket",
+            "target_bucket_path": "some-path",
+        }
+        response = self.http().post("/certs", json=req)
+        self.assert200(response)
+        env = self.mock_run_certbot.call_args.kwargs["env"]
+        self.assertEqual(env["CERTBOT_PROPAGATION_MODE"], "adaptive")
+        self.assertEqual(env["PYTHONPATH"].split(pathsep)[0],
+                         site_directory)
+        self.assertIn("--dns-google-propagation-seconds",
+                      self.mock_run_certbot.call_args.args[0])
+
+    @staticmethod
+    def _certificate(domains: List[str], not_after: datetime) -> bytes:
+        key = generate_private_key(SECP256R1())
+        name = Name([NameAttribute(NameOID.COMMON_NAME,
+                                   domains[0] if domains else "example")])
+        builder = CertificateBuilder() \
+            .subject_name(name) \
+            .issuer_name(name) \
+            .public_key(key.public_key()) \
+            .serial_number(random_serial_number()) \
+            .not_valid_before(not_after - timedelta(days=90)) \
+            .not_valid_after(not_after)
+        if domains:
+            builder = builder.add_extension(SubjectAlternativeName(
+                [DNSName(i) for i in domains]), critical=False)
+        cert = builder.sign(key, SHA256())
+        return cert.public_bytes(Encoding.PEM)
+
+    def _blob(self, path: str) -> MagicMock:
+        blob = MagicMock()
+        blob.name = path
+        for method in ("upload_from_filename",
+                       "upload_from_string",
+                       "download_as_bytes"):
+            def _call(*args, _method=method, **kwargs):
+                self.blob_calls.append(
+                    ((_method, args, kwargs), ((path,), {})))
+                return getattr(self.blob, _method)(*args, **kwargs)
+
+            getattr(blob, method).side_effect = _call
+        return blob
 
     def _assert_certbot_workdir_cleaned(self):
         self.assertFalse(exists(self.certbot_env.secret_location),
@@ -537,6 +1088,12 @@ class EndToEndTests(BaseTestCase):
         self.assertFalse(exists(self.certbot_env.config_dir),
                          msg="Workspace must be cleaned after call")
 
+    def _certbot_process_env(self) -> Dict[str, str]:
+        return {
+            **hook_environment("fixed"),
+            "CERTBOT_RUSAGE_FILE": join(self.temp_directory, "rusage.json"),
+        }
+
     def _assert_certbot_env(self):
         self.assertEqual(len({
             self.certbot_env.secret_location,
@@ -564,12 +1121,14 @@ class EndToEndTests(BaseTestCase):
     ) -> None:
         def _interceptor(
             secret: str,
-            temp_directory: str
+            temp_directory: str,
+            *args: Any,
         ) -> CertbotEnv:
-            result: CertbotEnv = \
-                prepare_certbot_directory(secret, temp_directory)
+            result: CertbotEnv = prepare_certbot_directory(
+                secret, temp_directory, *args)
             fun(secret, temp_directory, result)
             self.certbot_env = result
+            self.temp_directory = temp_directory
             return result
 
         self.mock_prepare_dir.side_effect = _interceptor
@@ -587,15 +1146,8 @@ class EndToEndTests(BaseTestCase):
         if (expected_files or expect_log_file) and not time:
             raise ValueError("Time is optional only for no upload case")
 
-        blob_fun: MagicMock = self.mock_storage_client.return_value \
-            .get_bucket.return_value \
-            .blob
-        blob: MagicMock = blob_fun.return_value
-        call_args = [(i[0], i[1]) for i in blob_fun.call_args_list]
-        call_sources = [(i[0], i[1], i[2]) for i in blob.method_calls]
-        self.assertEqual(len(call_args), len(call_sources),
-                         msg="Blob operations call count mismatch")
-        call_pairs = list(zip_longest(call_sources, call_args))
+        call_pairs = [i for i in self.blob_calls
+                      if i[0][0] != "download_as_bytes"]
 
         expected: List[Tuple] = []
 
@@ -0,0 +1,73 @@
+# coding=utf-8
+"""
+Shared GCS clients tests
+"""
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Thread
+from unittest import TestCase
+from unittest.mock import MagicMock
+
+from requests import Session
+
+from gcs import ClientPool, CountingAdapter
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    """
+    Responds with empty body keeping connection alive
+    """
+    protocol_version = "HTTP/1.1"
+
+    # noinspection PyPep8Naming
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class ClientPoolTests(TestCase):
+    """
+    Shared GCS clients tests
+    """
+
+    def test_client_reuse(self):
+        factory = MagicMock()
+        pool = ClientPool(factory, pool_size=4, bucket_ttl=60)
+        self.assertIs(pool.client("a"), pool.client("a"))
+        pool.client("b")
+        self.assertEqual(factory.call_count, 2)
+        self.assertEqual(pool.stats()["clients_created"], 2)
+        self.assertEqual(pool.stats()["clients_reused"], 1)
+
+    def test_bucket_cache(self):
+        factory = MagicMock()
+        pool = ClientPool(factory, pool_size=4, bucket_ttl=60)
+        self.assertIs(pool.bucket("a", "bucket"),
+                      pool.bucket("a", "bucket"))
+        factory.return_value.get_bucket.assert_called_once_with("bucket")
+        self.assertEqual(pool.stats()["buckets_fetched"], 1)
+        self.assertEqual(pool.stats()["buckets_reused"], 1)
+
+    def test_bucket_cache_expiry(self):
+        factory = MagicMock()
+        pool = ClientPool(factory, pool_size=4, bucket_ttl=0)
+        pool.bucket("a", "bucket")
+        pool.bucket("a", "bucket")
+        self.assertEqual(factory.return_value.get_bucket.call_count, 2)
+
+    def test_connections_accounting(self):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), KeepAliveHandler)
+        Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        adapter = CountingAdapter(pool_maxsize=2)
+        session = Session()
+        session.mount("http://", adapter)
+        for _ in range(3):
+            session.get(f"http://127.0.0.1:{server.server_port}/")
+        self.assertEqual(adapter.connections(), (1, 3))
+        session.close()
@@ -0,0 +1,209 @@
+# coding=utf-8
+"""
+Idempotency keys tests
+"""
+from json import loads
+from time import sleep, monotonic
+from typing import Any, Dict
+from unittest.mock import patch, MagicMock
+
+from google.api_core.exceptions import NotFound
+from marshmallow import ValidationError
+
+from errors import CertbotError, CertificateLockedError
+from server import idempotency, jobs
+from tests.BaseIntegrationTest import BaseTestCase
+
+
+class IdempotencyApiTests(BaseTestCase):
+    """
+    Idempotent issuance requests tests
+    """
+    mock_dry_run_upload: MagicMock
+    mock_issue_certificate: MagicMock
+    mock_clients: MagicMock
+    objects: Dict[str, str]
+
+    request = {
+        "provider": "google",
+        "secret_id": "some-secret-id",
+        "project": "some-project-id",
+        "domains": ["*.example.com"],
+        "email": "test@example.com",
+        "target_bucket": "some-bucket",
+        "target_bucket_path": "some-path",
+    }
+
+    def setUp(self):
+        """
+        Tests init method
+        """
+        patcher_dry_run_upload = patch("server.dry_run_upload")
+        self.addCleanup(patcher_dry_run_upload.stop)
+        self.mock_dry_run_upload = patcher_dry_run_upload.start()
+
+        patcher_issue_certificate = patch("server.issue_certificate")
+        self.addCleanup(patcher_issue_certificate.stop)
+        self.mock_issue_certificate = patcher_issue_certificate.start()
+        self.mock_issue_certificate.return_value = {
+            "live_gcs_path": "gs://some-bucket/some-path/live"
+        }
+
+        patcher_find_valid_certificate = patch(
+            "server.find_valid_certificate")
+        self.addCleanup(patcher_find_valid_certificate.stop)
+        patcher_find_valid_certificate.start().return_value = None
+
+        patcher_clients = patch("idempotency.clients")
+        self.addCleanup(patcher_clients.stop)
+        self.mock_clients = patcher_clients.start()
+        self.objects = {}
+        blob = self.mock_clients.bucket.return_value.blob
+        blob.side_effect = self._blob
+
+    def test_replay(self):
+        headers = {"Idempotency-Key": "some-key"}
+        first = self.http().post("/certs", json=self.request,
+                                 headers=headers)
+        self.assert200(first)
+        self.assertNotIn("Idempotent-Replayed", first.headers)
+        second = self.http().post("/certs", json=self.request,
+                                  headers=headers)
+        self.assert200(second)
+        self.assertEqual(second.headers["Idempotent-Replayed"], "true")
+        self.assertEqual(second.json, first.json)
+        self.mock_issue_certificate.assert_called_once()
+
+    def test_key_reused(self):
+        headers = {"Idempotency-Key": "some-key"}
+        self.http().post("/certs", json=self.request, headers=headers)
+        response = self.http().post("/certs", json={
+            **self.request, "target_bucket_path": "other-path"
+        }, headers=headers)
+        self.assertStatus(response, 422)
+        self.assertEqual(response.json["error"], {
+            "type": "IdempotencyKeyReusedError",
+            "message": "Idempotency key is already used "
+                       "with another request",
+            "key": "some-key",
+        })
+        self.mock_issue_certificate.assert_called_once()
+
+    def test_client_error_replay(self):
+        self.mock_issue_certificate.side_effect = \
+            ValidationError("Domain can't be issued")
+        headers = {"Idempotency-Key": "some-key"}
+        first = self.http().post("/certs", json=self.request,
+                                 headers=headers)
+        self.assert400(first)
+        second = self.http().post("/certs", json=self.request,
+                                  headers=headers)
+        self.assert400(second)
+        self.assertEqual(second.json, first.json)
+        self.assertEqual(second.headers["Idempotent-Replayed"], "true")
+        self.mock_issue_certificate.assert_called_once()
+
+    def test_transient_errors_not_stored(self):
+        self.mock_issue_certificate.side_effect = [
+            CertbotError(["certbot"], 10, "failed"),
+            CertificateLockedError("gs://some-bucket/some-path/.locks/x",
+                                   "other-instance"),
+            {"live_gcs_path": "gs://some-bucket/some-path/live"},
+        ]
+        headers = {"Idempotency-Key": "some-key"}
+        with patch.object(idempotency, "_persist", True):
+            first = self.http().post("/certs", json=self.request,
+                                     headers=headers)
+            self.assert500(first)
+            second = self.http().post("/certs", json=self.request,
+                                      headers=headers)
+            self.assertStatus(second, 409)
+            self.assertEqual(self.objects, {})
+            third = self.http().post("/certs", json=self.request,
+                                     headers=headers)
+        for response in (second, third):
+            self.assertNotIn("Idempotent-Replayed", response.headers)
+        self.assert200(third)
+        self.assertEqual(self.mock_issue_certificate.call_count, 3)
+
+    def test_persisted(self):
+        headers = {"Idempotency-Key": "some-key"}
+        patcher_persist = patch.object(idempotency, "_persist", True)
+        self.addCleanup(patcher_persist.stop)
+        patcher_persist.start()
+        first = self.http().post("/certs", json=self.request,
+                                 headers=headers)
+        [(path, data)] = self.objects.items()
+        self.assertTrue(path.startswith("some-path/.idempotency/"))
+        self.assertEqual(loads(data)["response"], first.json)
+
+        # restarted instance
+        idempotency.clear()
+        second = self.http().post("/certs", json=self.request,
+                                  headers=headers)
+        self.assertEqual(second.json, first.json)
+        self.assertEqual(second.headers["Idempotent-Replayed"], "true")
+        self.mock_issue_certificate.assert_called_once()
+
+    def test_async(self):
+        headers = {"Idempotency-Key": "some-key"}
+        submitted = self.http().post("/certs?async=true",
+                                     json=self.request, headers=headers)
+        self.assertStatus(submitted, 202)
+        job_id: str = submitted.json["job"]["job_id"]
+        deadline: float = monotonic() + 10
+        while monotonic() < deadline:
+            response = self.http().post("/certs?async=true",
+                                        json=self.request,
+                                        headers=headers)
+            if response.status_code == 200:
+                break
+            self.assertEqual(response.json["job"]["job_id"], job_id)
+            sleep(0.01)
+        else:
+            self.fail(f"Job {job_id} is not finished in time")
+        self.assertEqual(response.json["result"], {
+            "live_gcs_path": "gs://some-bucket/some-path/live"
+        })
+        self.mock_issue_certificate.assert_called_once()
+
+    def test_async_server_error(self):
+        self.mock_issue_certificate.side_effect = [
+            CertbotError(["certbot"], 10, "failed"),
+            {"live_gcs_path": "gs://some-bucket/some-path/live"},
+        ]
+        headers = {"Idempotency-Key": "some-key"}
+        submitted = self.http().post("/certs?async=true",
+                                     json=self.request, headers=headers)
+        self.assertStatus(submitted, 202)
+        job = jobs.get(submitted.json["job"]["job_id"])
+        deadline: float = monotonic() + 10
+        while not job.finished and monotonic() < deadline:
+            sleep(0.01)
+        self.assertEqual(job.status, "failed")
+
+        # pending response of the failed job isn't replayed
+        response = self.http().post("/certs", json=self.request,
+                                    headers=headers)
+        self.assert200(response)
+        self.assertNotIn("Idempotent-Replayed", response.headers)
+        self.assertEqual(self.mock_issue_certificate.call_count, 2)
+
+    def test_not_persisted_by_default(self):
+        headers = {"Idempotency-Key": "some-key"}
+        self.http().post("/certs", json=self.request, headers=headers)
+        self.assertEqual(self.objects, {})
+        self.mock_clients.bucket.assert_not_called()
+
+    def _blob(self, path: str) -> MagicMock:
+        blob = MagicMock()
+        blob.upload_from_string.side_effect = \
+            lambda data, **_: self.objects.__setitem__(path, data)
+
+        def download() -> Any:
+            if path not in self.objects:
+                raise NotFound(path)
+            return self.objects[path].encode("utf-8")
+
+        blob.download_as_bytes.side_effect = download
+        return blob
@@ -0,0 +1,120 @@
+# coding=utf-8
+"""
+Asynchronous job API tests
+"""
+from time import sleep, monotonic
+from typing import Dict, Any
+from unittest.mock import patch, MagicMock
+
+from errors import CertbotError
+from tests.BaseIntegrationTest import BaseTestCase
+
+
+class JobsTests(BaseTestCase):
+    """
+    Asynchronous job API tests
+    """
+    mock_dry_run_upload: MagicMock
+    mock_issue_certificate: MagicMock
+    mock_find_valid_certificate: MagicMock
+
+    request = {
+        "provider": "google",
+        "secret_id": "some-secret-id",
+        "project": "some-project-id",
+        "domains": ["*.example.com"],
+        "email": "test@example.com",
+        "target_bucket": "some-bucket",
+        "target_bucket_path": "some-path",
+    }
+
+    def setUp(self):
+        """
+        Tests init method
+        """
+        patcher_dry_run_upload = patch("server.dry_run_upload")
+        self.addCleanup(patcher_dry_run_upload.stop)
+        self.mock_dry_run_upload = patcher_dry_run_upload.start()
+
+        patcher_issue_certificate = patch("server.issue_certificate")
+        self.addCleanup(patcher_issue_certificate.stop)
+        self.mock_issue_certificate = patcher_issue_certificate.start()
+
+        patcher_find_valid_certificate = patch(
+            "server.find_valid_certificate")
+        self.addCleanup(patcher_find_valid_certificate.stop)
+        self.mock_find_valid_certificate = \
+            patcher_find_valid_certificate.start()
+        self.mock_find_valid_certificate.return_value = None
+
+    def test_job_success(self):
+        self.mock_issue_certificate.return_value = {
+            "live_gcs_path": "gs://some-bucket/some-path/live"
+        }
+        response = self.http().post("/certs?async=true",
+                                    json=self.request)
+        self.assertStatus(response, 202)
+        job_id: str = response.json["job"]["job_id"]
+        self.assertEqual(response.headers["Location"],
+                         f"/jobs/{job_id}")
+
+        job = self._wait_job(job_id)
+        self.assertEqual(job["status"], "succeeded")
+        self.assertTrue(job["success"])
+        self.assertEqual(job["result"], {
+            "live_gcs_path": "gs://some-bucket/some-path/live"
+        })
+        self.assertEqual(
+            set(job["timings"].keys()),
+            {"queued", "plan", "renewal_check", "dry_run_upload",
+             "issue_certificate"})
+        self.mock_dry_run_upload.assert_called_once()
+        self.mock_issue_certificate.assert_called_once()
+
+    def test_job_failure(self):
+        self.mock_issue_certificate.side_effect = \
+            CertbotError(["certbot"], 10, "something is wrong")
+        response = self.http().post("/certs?async=true",
+                                    json=self.request)
+        self.assertStatus(response, 202)
+
+        job = self._wait_job(response.json["job"]["job_id"])
+        self.assertEqual(job["status"], "failed")
+        self.assertFalse(job["success"])
+        self.assertEqual(job["error"], {
+            "command": ["certbot"],
+            "message": "Certbot instance failed",
+            "output": ["something is wrong"],
+            "rusage": None,
+            "acme": None,
+            "http": None,
+            "timeout": 10,
+            "type": "CertbotError"
+        })
+
+    def test_invalid_request_is_not_queued(self):
+        response = self.http().post("/certs?async=true", json={})
+        self.assert400(response)
+        self.mock_issue_certificate.assert_not_called()
+
+    def test_unknown_job(self):
+        response = self.http().get("/jobs/unknown")
+        self.assert404(response)
+        self.assertEqual(response.json, {
+            "error": {
+                "job_id": "unknown",
+                "message": "Job is not found",
+                "type": "JobNotFoundError"
+            },
+            "success": False
+        })
+
+    def _wait_job(self, job_id: str) -> Dict[str, Any]:
+        deadline: float = monotonic() + 10
+        while monotonic() < deadline:
+            response = self.http().get(f"/jobs/{job_id}")
+            self.assert200(response)
+            if response.json["status"] in ("succeeded", "failed"):
+                return response.json
+            sleep(0.01)
+        self.fail(f"Job {job_id} is not finished in time")
@@ -0,0 +1,243 @@
+# coding=utf-8
+"""
+Certificate lease tests
+"""
+from json import loads
+from threading import Timer
+from time import sleep
+from unittest import TestCase
+from unittest.mock import patch, MagicMock
+
+from google.api_core.exceptions import PreconditionFailed
+
+from dto import CertbotRequest
+from errors import CertificateLockedError
+from lease import Lease
+from object_store import MemoryObjectStore, GCSObjectStore
+from service import issue_certificate, obtain_certificate, CertbotRun
+from state import lineage_name
+from tests.BaseIntegrationTest import BaseTestCase
+
+
+class LeaseTests(TestCase):
+    """
+    Lease lock tests
+    """
+
+    def setUp(self):
+        """
+        Tests init method
+        """
+        self.store = MemoryObjectStore()
+
+    def lease(self, owner: str, ttl: float = 10) -> Lease:
+        return Lease(self.store, "path/.locks/cert.json",
+                     ttl=ttl, heartbeat=0.05, owner=owner)
+
+    def test_contention(self):
+        first = self.lease("first")
+        self.assertFalse(first.acquire(wait=0))
+        with self.assertRaises(CertificateLockedError) as e:
+            self.lease("second").acquire(wait=0)
+        self.assertEqual(e.exception.owner, "first")
+        self.assertEqual(e.exception.lock_path, "path/.locks/cert.json")
+        first.release()
+        self.assertIsNone(self.store.read("path/.locks/cert.json"))
+
+    def test_wait(self):
+        first = self.lease("first")
+        first.acquire(wait=0)
+        Timer(0.2, first.release).start()
+        second = self.lease("second")
+        self.assertTrue(second.acquire(wait=5, interval=0.05))
+        data, _ = self.store.read("path/.locks/cert.json")
+        self.assertEqual(loads(data)["owner"], "second")
+        second.release()
+
+    def test_heartbeat(self):
+        first = self.lease("first", ttl=0.2)
+        first.acquire(wait=0)
+        sleep(0.5)
+        # renewed by heartbeat
+        with self.assertRaises(CertificateLockedError):
+            self.lease("second").acquire(wait=0)
+        first.release()
+
+    def test_expired_takeover(self):
+        first = self.lease("first", ttl=0.1)
+        first.heartbeat = 10
+        first.acquire(wait=0)
+        sleep(0.2)
+        second = self.lease("second")
+        self.assertFalse(second.acquire(wait=0))
+        # stale owner doesn't delete the new lease
+        first.release()
+        data, _ = self.store.read("path/.locks/cert.json")
+        self.assertEqual(loads(data)["owner"], "second")
+        second.release()
+
+    def test_ensure_held(self):
+        first = self.lease("first", ttl=0.2)
+        first.heartbeat = 10
+        first.acquire(wait=0)
+        first.ensure_held()
+        sleep(0.3)
+        # not renewed for ttl seconds, may be taken over
+        with self.assertRaises(CertificateLockedError):
+            first.ensure_held()
+        second = self.lease("second")
+        second.acquire(wait=0)
+        first.lost = True
+        with self.assertRaises(CertificateLockedError) as e:
+            first.ensure_held()
+        self.assertEqual(e.exception.owner, "second")
+        first.release()
+        second.release()
+
+
+class GCSObjectStoreTests(TestCase):
+    """
+    GCS generation preconditions tests
+    """
+
+    def test_preconditions(self):
+        bucket = MagicMock()
+        blob = bucket.blob.return_value
+        blob.generation = 7
+        store = GCSObjectStore(bucket)
+        self.assertEqual(store.create("lock", b"{}"), 7)
+        blob.upload_from_string.assert_called_with(
+            b"{}", content_type="application/json",
+            if_generation_match=0)
+
+        blob.upload_from_string.side_effect = PreconditionFailed("")
+        self.assertIsNone(store.replace("lock", b"{}", 7))
+        blob.delete.side_effect = PreconditionFailed("")
+        self.assertFalse(store.delete("lock", 7))
+        blob.delete.assert_called_with(if_generation_match=7)
+
+
+class CertificateLeaseApiTests(BaseTestCase):
+    """
+    Issuance under certificate lease tests
+    """
+    mock_obtain_certificate: MagicMock
+    mock_find_valid_certificate: MagicMock
+
+    request = {
+        "provider": "google",
+        "secret_id": "some-secret-id",
+        "project": "some-project-id",
+        "domains": ["*.example.com"],
+        "email": "test@example.com",
+        "target_bucket": "some-bucket",
+        "target_bucket_path": "some-path",
+    }
+
+    def setUp(self):
+        """
+        Tests init method
+        """
+        self.store = MemoryObjectStore()
+        for target, value in (("service.CERT_LOCK_ENABLED", True),
+                              ("service.lease_store",
+                               MagicMock(return_value=self.store)),
+                              ("server.dry_run_upload", MagicMock())):
+            patcher = patch(target, value)
+            self.addCleanup(patcher.stop)
+            patcher.start()
+
+        patcher_obtain_certificate = patch("service.obtain_certificate")
+        self.addCleanup(patcher_obtain_certificate.stop)
+        self.mock_obtain_certificate = patcher_obtain_certificate.start()
+        self.mock_obtain_certificate.return_value = {
+            "live_gcs_path": "gs://some-bucket/some-path/live"
+        }
+
+        patcher_find_valid_certificate = patch(
+            "service.find_valid_certificate")
+        self.addCleanup(patcher_find_valid_certificate.stop)
+        self.mock_find_valid_certificate = \
+            patcher_find_valid_certificate.start()
+        self.mock_find_valid_certificate.return_value = None
+
+    def test_issued_under_lease(self):
+        def obtain(_, lease):
+            self.assertFalse(lease.contended)
+            [path] = self.store._objects.keys()
+            self.assertTrue(path.startswith("some-path/.locks/cert-"))
+            return {"live_gcs_path": "gs://some-bucket/some-path/live"}
+
+        self.mock_obtain_certificate.side_effect = obtain
+        response = self.http().post("/certs", json=self.request)
+        self.assert200(response)
+        self.mock_obtain_certificate.assert_called_once()
+        self.assertEqual(self.store._objects, {})
+
+    def test_locked(self):
+        holder = Lease(self.store, self.lock_path(), ttl=10,
+                       heartbeat=10, owner="other-instance")
+        holder.acquire(wait=0)
+        self.addCleanup(holder.release)
+        response = self.http().post("/certs", json=self.request)
+        self.assertStatus(response, 409)
+        self.assertEqual(response.json["error"], {
+            "type": "CertificateLockedError",
+            "message": "Certificate is being issued by another instance",
+            "lock_path": self.lock_path(),
+            "owner": "other-instance",
+        })
+        self.mock_obtain_certificate.assert_not_called()
+
+    def test_waited_for_other_instance(self):
+        self.mock_find_valid_certificate.return_value = \
+            {"skipped": "true"}
+        holder = Lease(self.store, self.lock_path(), ttl=10,
+                       heartbeat=10, owner="other-instance")
+        holder.acquire(wait=0)
+        with patch("service.CERT_LOCK_WAIT", 5), \
+                patch("lease.sleep") as mock_sleep:
+            mock_sleep.side_effect = lambda _: holder.release()
+            result = issue_certificate(CertbotRequest(**self.request))
+        self.assertEqual(result, {"skipped": "true"})
+        self.mock_obtain_certificate.assert_not_called()
+        # published certificate is checked even without
+        # renew_before_days
+        [(req,), _] = self.mock_find_valid_certificate.call_args
+        self.assertEqual(req.renew_before_days, 0)
+
+    def test_waited_for_failed_instance(self):
+        holder = Lease(self.store, self.lock_path(), ttl=10,
+                       heartbeat=10, owner="other-instance")
+        holder.acquire(wait=0)
+        with patch("service.CERT_LOCK_WAIT", 5), \
+                patch("lease.sleep") as mock_sleep:
+            mock_sleep.side_effect = lambda _: holder.release()
+            result = issue_certificate(CertbotRequest(**self.request))
+        self.assertEqual(result, {
+            "live_gcs_path": "gs://some-bucket/some-path/live"
+        })
+        self.mock_find_valid_certificate.assert_called_once()
+        self.mock_obtain_certificate.assert_called_once()
+
+    def test_lost_lease_not_published(self):
+        lease = Lease(self.store, self.lock_path(), ttl=10,
+                      heartbeat=10, owner="this-instance")
+        lease.acquire(wait=0)
+        lease.lost = True
+        self.addCleanup(lease.release)
+        run = CertbotRun("certificates", "logs", None, None, None)
+        with patch("service.call_certbot", return_value=run), \
+                patch("service.clients"), \
+                patch("service.upload_directories_to_gcs") as upload, \
+                patch("service.publish_manifest") as publish:
+            for mode in ("upload", "copy"):
+                with self.assertRaises(CertificateLockedError):
+                    obtain_certificate(CertbotRequest(
+                        **self.request, publish_mode=mode), lease)
+        upload.assert_not_called()
+        publish.assert_not_called()
+
+    def lock_path(self) -> str:
+        return f"some-path/.locks/" \
+               f"{lineage_name(self.request['domains'])}.json"
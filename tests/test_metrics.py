@@ -0,0 +1,58 @@
+# coding=utf-8
+"""
+Prometheus metrics tests
+"""
+from unittest import TestCase
+
+from metrics import Counter, Histogram, StatsGauge
+
+
+class MetricsTests(TestCase):
+    """
+    Exposition format tests
+    """
+
+    def test_histogram(self):
+        histogram = Histogram("phase_seconds", "Phases", ["phase"],
+                              buckets=[0.1, 1])
+        histogram.observe(0.05, "plan")
+        histogram.observe(0.5, "plan")
+        histogram.observe(5, "plan")
+        histogram.observe(1, 'say "hi"\n')
+        self.assertEqual(histogram.render(), [
+            "# HELP phase_seconds Phases",
+            "# TYPE phase_seconds histogram",
+            'phase_seconds_bucket{phase="plan",le="0.1"} 1',
+            'phase_seconds_bucket{phase="plan",le="1"} 2',
+            'phase_seconds_bucket{phase="plan",le="+Inf"} 3',
+            'phase_seconds_sum{phase="plan"} 5.55',
+            'phase_seconds_count{phase="plan"} 3',
+            'phase_seconds_bucket{phase="say \\"hi\\"\\n",le="0.1"} 0',
+            'phase_seconds_bucket{phase="say \\"hi\\"\\n",le="1"} 1',
+            'phase_seconds_bucket{phase="say \\"hi\\"\\n",le="+Inf"} 1',
+            'phase_seconds_sum{phase="say \\"hi\\"\\n"} 1',
+            'phase_seconds_count{phase="say \\"hi\\"\\n"} 1',
+        ])
+
+    def test_counter(self):
+        counter = Counter("errors_total", "Errors", ["type"])
+        counter.inc("CertbotError")
+        counter.inc("CertbotError")
+        counter.inc("GCSUploadError")
+        self.assertEqual(counter.render(), [
+            "# HELP errors_total Errors",
+            "# TYPE errors_total counter",
+            'errors_total{type="CertbotError"} 2',
+            'errors_total{type="GCSUploadError"} 1',
+        ])
+
+    def test_stats_gauge(self):
+        stats = {"misses": 1, "hits": 2}
+        gauge = StatsGauge("cache", "Cache", lambda: stats)
+        stats["hits"] = 3
+        self.assertEqual(gauge.render(), [
+            "# HELP cache Cache",
+            "# TYPE cache gauge",
+            'cache{stat="hits"} 3',
+            'cache{stat="misses"} 1',
+        ])
@@ -0,0 +1,166 @@
+# coding=utf-8
+"""
+Issuance planner tests
+"""
+from typing import Any, Dict
+from unittest import TestCase
+from unittest.mock import patch, MagicMock
+
+from planner import normalize_domain, plan_domains, pack_domain_sets
+from tests.BaseIntegrationTest import BaseTestCase
+
+
+def request(domains, **kwargs) -> Dict[str, Any]:
+    """
+    Returns valid request payload for the domains
+    """
+    return {
+        "provider": "google",
+        "secret_id": "some-secret-id",
+        "project": "some-project-id",
+        "domains": domains,
+        "email": "test@example.com",
+        "target_bucket": "some-bucket",
+        "target_bucket_path": "some-path",
+        **kwargs,
+    }
+
+
+class PlannerTests(TestCase):
+    """
+    Domain names planning tests
+    """
+
+    def test_normalize(self):
+        self.assertEqual(normalize_domain(" WWW.Example.COM. "),
+                         "www.example.com")
+        self.assertEqual(normalize_domain("*.Bücher.example"),
+                         "*.xn--bcher-kva.example")
+        for name in ("", "a..example.com", "a.*.example.com"):
+            with self.assertRaises(ValueError):
+                normalize_domain(name)
+
+    def test_wildcard_coverage(self):
+        plan = plan_domains(["*.example.com", "A.example.com.",
+                             "example.com", "b.a.example.com",
+                             "a.example.com"], drop_covered=True)
+        self.assertEqual(plan.domains, ["*.example.com", "example.com",
+                                        "b.a.example.com"])
+        self.assertEqual(plan.dropped, ["a.example.com",
+                                        "a.example.com"])
+
+    def test_covered_kept_by_default(self):
+        plan = plan_domains(["*.example.com", "WWW.example.com.",
+                             "www.example.com"])
+        self.assertEqual(plan.domains, ["*.example.com",
+                                        "www.example.com"])
+        self.assertEqual(plan.dropped, ["www.example.com"])
+
+    def test_packing(self):
+        packed = pack_domain_sets([
+            ["a.example.com", "b.example.com"],
+            ["*.example.com"],
+            ["c.example.org", "d.example.org", "e.example.org"],
+            ["a.example.com"],
+        ], max_names=3, drop_covered=True)
+        self.assertEqual(packed, [
+            (["c.example.org", "d.example.org", "e.example.org"], [2]),
+            (["*.example.com"], [0, 1, 3]),
+        ])
+
+
+class PlanApiTests(BaseTestCase):
+    """
+    Planning API tests
+    """
+    mock_issue_certificate: MagicMock
+
+    def setUp(self):
+        """
+        Tests init method
+        """
+        patcher_issue_certificate = patch("server.issue_certificate")
+        self.addCleanup(patcher_issue_certificate.stop)
+        self.mock_issue_certificate = patcher_issue_certificate.start()
+
+    def test_plan(self):
+        response = self.http().post("/plan", json=[
+            request(["a.example.com", "B.example.com"], drop_covered=True),
+            request(["*.example.com"], drop_covered=True),
+            request(["a.example.com"], secret_id="other-secret",
+                    drop_covered=True),
+        ])
+        self.assert200(response)
+        self.assertEqual(response.json["result"], {
+            "orders_requested": 3,
+            "orders": 2,
+            "authorizations_requested": 4,
+            "authorizations": 2,
+            "certificates": [{
+                "provider": "google",
+                "project": "some-project-id",
+                "secret_id": "some-secret-id",
+                "email": "test@example.com",
+                "domains": ["*.example.com"],
+                "requests": [0, 1],
+            }, {
+                "provider": "google",
+                "project": "some-project-id",
+                "secret_id": "other-secret",
+                "email": "test@example.com",
+                "domains": ["a.example.com"],
+                "requests": [2],
+            }],
+            "requests": [
+                {"index": 0, "domains": ["a.example.com",
+                                         "b.example.com"],
+                 "dropped": []},
+                {"index": 1, "domains": ["*.example.com"],
+                 "dropped": []},
+                {"index": 2, "domains": ["a.example.com"],
+                 "dropped": []},
+            ],
+        })
+        self.mock_issue_certificate.assert_not_called()
+
+    def test_plan_only(self):
+        response = self.http().post("/certs", json=request(
+            ["*.example.com", "WWW.example.com", "example.com."],
+            plan_only=True, drop_covered=True))
+        self.assert200(response)
+        self.assertEqual(response.json["result"], {
+            "plan": {
+                "domains": ["*.example.com", "example.com"],
+                "dropped": ["www.example.com"],
+            }
+        })
+        self.mock_issue_certificate.assert_not_called()
+
+    def test_issuance_reports_plan(self):
+        self.mock_issue_certificate.return_value = {"live_gcs_path": "x"}
+        with patch("server.dry_run_upload"):
+            response = self.http().post("/certs", json=request(
+                ["*.example.com", "www.example.com"], drop_covered=True))
+            self.assert200(response)
+            rsp = response.json
+            unchanged = self.http().post("/certs", json=request(
+                ["*.example.com", "www.example.com"],
+                target_bucket_path="other-path"))
+            self.assert200(unchanged)
+        self.assertEqual(rsp["result"]["plan"], {
+            "domains": ["*.example.com"],
+            "dropped": ["www.example.com"],
+        })
+        self.assertEqual(
+            [c.args[0].domains
+             for c in self.mock_issue_certificate.call_args_list],
+            [["*.example.com"], ["*.example.com", "www.example.com"]])
+        self.assertNotIn("plan", unchanged.json["result"])
+
+    def test_invalid_domain(self):
+        response = self.http().post("/certs", json=request(
+            ["a..example.com"]))
+        self.assert400(response)
+        self.assertEqual(response.json["error"]["errors"], {
+            "domains": ["Domain name a..example.com is invalid"]
+        })
@@ -0,0 +1,266 @@
+# coding=utf-8
+"""
+Adaptive DNS propagation tests
+"""
+from concurrent.futures import ThreadPoolExecutor
+from os import environ, listdir
+from socket import socket, AF_INET, SOCK_DGRAM, timeout as \
+    socket_timeout
+from tempfile import TemporaryDirectory
+from threading import Thread, Event, Timer, Lock
+from time import monotonic, sleep
+from typing import Dict, List, Set
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+# noinspection PyPackageRequirements
+import dns.message
+# noinspection PyPackageRequirements
+import dns.rcode
+# noinspection PyPackageRequirements
+import dns.rrset
+# noinspection PyPackageRequirements
+from certbot.plugins.dns_common import DNSAuthenticator
+
+from certbot_hooks import install_hooks
+from propagation import parse_nameservers, wait_for_records, \
+    PropagationGroup
+
+CHALLENGE = "_acme-challenge.example.com"
+
+
+class StandInNameserver(object):
+    """
+    UDP nameserver serving TXT records from a dictionary
+    """
+
+    def __init__(self) -> None:
+        self.records: Dict[str, List[str]] = {}
+        self.queries = 0
+        self._socket = socket(AF_INET, SOCK_DGRAM)
+        self._socket.bind(("127.0.0.1", 0))
+        self._socket.settimeout(0.1)
+        self._stopped = Event()
+        self._thread = Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    @property
+    def address(self) -> str:
+        """
+        Returns host:port of the server
+        """
+        host, port = self._socket.getsockname()
+        return f"{host}:{port}"
+
+    def stop(self) -> None:
+        """
+        Stops serving
+        """
+        self._stopped.set()
+        self._thread.join()
+        self._socket.close()
+
+    def _serve(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                data, peer = self._socket.recvfrom(4096)
+            except socket_timeout:
+                continue
+            self.queries += 1
+            query = dns.message.from_wire(data)
+            response = dns.message.make_response(query)
+            name = query.question[0].name
+            values = self.records.get(name.to_text().rstrip("."))
+            if values:
+                response.answer.append(dns.rrset.from_text_list(
+                    name, 60, "IN", "TXT", [f'"{v}"' for v in values]))
+            else:
+                response.set_rcode(dns.rcode.NXDOMAIN)
+            self._socket.sendto(response.to_wire(), peer)
+
+
+class FakeAuthenticator(DNSAuthenticator):
+    """
+    DNS authenticator doing nothing but waiting for propagation
+    """
+    description = "Fake"
+
+    def __init__(self, propagation_seconds: int) -> None:
+        # noinspection PyTypeChecker
+        super().__init__(MagicMock(), "fake")
+        self.propagation_seconds = propagation_seconds
+
+    def conf(self, var: str):
+        return self.propagation_seconds
+
+    def more_info(self) -> str:
+        return ""
+
+    def _setup_credentials(self) -> None:
+        pass
+
+    def _perform(self, domain, validation_name, validation) -> None:
+        pass
+
+    def _cleanup(self, domain, validation_name, validation) -> None:
+        pass
+
+
+def challenge(value: str) -> MagicMock:
+    """
+    Returns annotated challenge stand-in
+    """
+    achall = MagicMock()
+    achall.domain = "example.com"
+    achall.validation_domain_name.return_value = CHALLENGE
+    achall.validation.return_value = value
+    return achall
+
+
+class PropagationTests(TestCase):
+    """
+    Adaptive DNS propagation tests
+    """
+
+    def setUp(self):
+        """
+        Test init method
+        """
+        self.primary = StandInNameserver()
+        self.secondary = StandInNameserver()
+        self.addCleanup(self.primary.stop)
+        self.addCleanup(self.secondary.stop)
+        self.nameservers = parse_nameservers(
+            f"{self.primary.address},{self.secondary.address}")
+
+    def test_parse_nameservers(self):
+        self.assertEqual(
+            parse_nameservers("10.0.0.1, ns.example.com:5353,"
+                              "[::1]:54,::1"),
+            [("10.0.0.1", 53), ("ns.example.com", 5353),
+             ("::1", 54), ("::1", 53)])
+
+    def test_waits_for_all_nameservers(self):
+        self.primary.records[CHALLENGE] = ["old", "token"]
+        Timer(0.5, self.secondary.records.__setitem__,
+              (CHALLENGE, ["token"])).start()
+        start = monotonic()
+        self.assertTrue(wait_for_records(
+            {CHALLENGE: {"token"}}, timeout=10, interval=0.1,
+            nameservers=self.nameservers))
+        self.assertGreaterEqual(monotonic() - start, 0.5)
+        self.assertLess(monotonic() - start, 5)
+        self.assertGreater(self.secondary.queries, 1)
+
+    def test_timeout_is_upper_bound(self):
+        self.primary.records[CHALLENGE] = ["token"]
+        start = monotonic()
+        self.assertFalse(wait_for_records(
+            {CHALLENGE: {"token"}}, timeout=0.5, interval=0.1,
+            nameservers=self.nameservers))
+        self.assertGreaterEqual(monotonic() - start, 0.5)
+        self.assertLess(monotonic() - start, 2)
+
+    def test_certbot_hook(self):
+        install_hooks()
+        self._patch_display()
+        self.primary.records[CHALLENGE] = ["a", "b"]
+        self.secondary.records[CHALLENGE] = ["a", "b"]
+        authenticator = FakeAuthenticator(propagation_seconds=60)
+        with patch.dict(environ, {
+            "CERTBOT_PROPAGATION_MODE": "adaptive",
+            "DNS_PROPAGATION_INTERVAL": "0.1",
+            "DNS_PROPAGATION_NAMESERVERS":
+                f"{self.primary.address},{self.secondary.address}",
+        }):
+            start = monotonic()
+            responses = authenticator.perform(
+                [challenge("a"), challenge("b")])
+            self.assertLess(monotonic() - start, 5)
+        self.assertEqual(len(responses), 2)
+        self.assertGreater(self.primary.queries, 0)
+
+    def test_certbot_hook_fixed_mode(self):
+        install_hooks()
+        self._patch_display()
+        authenticator = FakeAuthenticator(propagation_seconds=1)
+        with patch.dict(environ, {"CERTBOT_PROPAGATION_MODE": "fixed"}):
+            start = monotonic()
+            authenticator.perform([challenge("a")])
+            self.assertGreaterEqual(monotonic() - start, 1)
+        self.assertEqual(self.primary.queries, 0)
+
+    def test_certbot_hook_group(self):
+        install_hooks()
+        self._patch_display()
+        self.primary.records[CHALLENGE] = ["a"]
+        self.secondary.records[CHALLENGE] = ["a"]
+        authenticator = FakeAuthenticator(propagation_seconds=60)
+        with TemporaryDirectory() as d, patch.dict(environ, {
+            "CERTBOT_PROPAGATION_MODE": "adaptive",
+            "DNS_PROPAGATION_INTERVAL": "0.1",
+            "DNS_PROPAGATION_NAMESERVERS":
+                f"{self.primary.address},{self.secondary.address}",
+            **PropagationGroup(d, 1, "0").environment(),
+        }):
+            start = monotonic()
+            authenticator.perform([challenge("a")])
+            self.assertLess(monotonic() - start, 5)
+            self.assertIn("arrived-0.json", listdir(d))
+            self.assertIn("propagated", listdir(d))
+
+    def _patch_display(self):
+        patcher = patch("certbot.plugins.dns_common.display_util.notify")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class PropagationGroupTests(TestCase):
+    """
+    Shared propagation tests
+    """
+
+    def setUp(self):
+        """
+        Test init method
+        """
+        self.lock = Lock()
+        self.propagated: List[Dict[str, Set[str]]] = []
+
+    def propagate(self, records: Dict[str, Set[str]]) -> None:
+        with self.lock:
+            self.propagated.append(records)
+        sleep(0.3)
+
+    def test_single_propagation(self):
+        with TemporaryDirectory() as d:
+            members = [PropagationGroup(d, 3, str(i)) for i in range(3)]
+
+            def member(index: int) -> None:
+                group = members[index]
+                if index == 2:
+                    sleep(0.2)
+                    group.leave()
+                    return
+                group.lock_publish()
+                sleep(0.1)
+                group.release_publish()
+                group.wait({f"_acme-challenge.{index}.example.com":
+                            {str(index)}}, 10, self.propagate)
+
+            start = monotonic()
+            with ThreadPoolExecutor(max_workers=3) as e:
+                list(e.map(member, range(3)))
+            self.assertLess(monotonic() - start, 1)
+        self.assertEqual(self.propagated, [{
+            "_acme-challenge.0.example.com": {"0"},
+            "_acme-challenge.1.example.com": {"1"},
+        }])
+
+    def test_late_member(self):
+        with TemporaryDirectory() as d:
+            first = PropagationGroup(d, 2, "0")
+            first.wait({"a": {"0"}}, 0.2, self.propagate)
+            late = PropagationGroup(d, 2, "1")
+            late.wait({"b": {"1"}}, 0.2, self.propagate)
+        self.assertEqual(self.propagated, [{"a": {"0"}}, {"b": {"1"}}])
@@ -0,0 +1,114 @@
+# coding=utf-8
+"""
+Secret cache tests
+"""
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import sleep
+from typing import Dict, Any
+from unittest import TestCase
+from unittest.mock import MagicMock
+
+# noinspection PyPackageRequirements
+from google.api_core.exceptions import PermissionDenied
+
+from secret_cache import SecretCache
+
+
+class FakeSecretClient(object):
+    """
+    Secret Manager client stand-in with version numbers
+    """
+
+    def __init__(self) -> None:
+        self.versions: Dict[str, int] = {}
+        self.accesses = 0
+        self.lock = Lock()
+
+    def access_secret_version(self, request: Dict[str, str]) -> Any:
+        with self.lock:
+            self.accesses += 1
+        sleep(0.01)
+        name: str = request["name"]
+        secret: str = name.split("/")[3]
+        version: str = name.rsplit("/", 1)[-1]
+        if version == "latest":
+            version = str(self.versions[secret])
+        rsp = MagicMock()
+        rsp.name = f"{name.rsplit('/', 1)[0]}/{version}"
+        rsp.payload.data = f"{secret}-{version}".encode("utf-8")
+        return rsp
+
+    def get_secret_version(self, request: Dict[str, str]) -> Any:
+        # secretAccessor role doesn't grant versions.get
+        raise PermissionDenied(request["name"])
+
+
+class SecretCacheTests(TestCase):
+    """
+    Secret cache tests
+    """
+
+    def setUp(self):
+        """
+        Test init method
+        """
+        self.client = FakeSecretClient()
+        self.client.versions = {"a": 1, "b": 1, "c": 1}
+        self.factory = MagicMock(return_value=self.client)
+
+    def test_hit_within_ttl(self):
+        cache = SecretCache(self.factory, ttl=3600, max_size=10)
+        self.assertEqual(cache.get("p", "a"), "a-1")
+        self.assertEqual(cache.get("p", "a"), "a-1")
+        self.assertEqual(self.client.accesses, 1)
+        self.factory.assert_called_once()
+        self.assertEqual(cache.stats(), {
+            "size": 1, "hits": 1, "misses": 1,
+            "revalidations": 0, "rotations": 0,
+        })
+
+    def test_revalidation_and_rotation(self):
+        cache = SecretCache(self.factory, ttl=0, max_size=10)
+        self.assertEqual(cache.get("p", "a"), "a-1")
+        self.assertEqual(cache.get("p", "a"), "a-1")
+        self.assertEqual(self.client.accesses, 2)
+
+        self.client.versions["a"] = 2
+        self.assertEqual(cache.get("p", "a"), "a-2")
+        self.assertEqual(self.client.accesses, 3)
+        self.assertEqual(cache.stats(), {
+            "size": 1, "hits": 0, "misses": 1,
+            "revalidations": 2, "rotations": 1,
+        })
+
+    def test_lru_eviction(self):
+        cache = SecretCache(self.factory, ttl=3600, max_size=2)
+        cache.get("p", "a")
+        cache.get("p", "b")
+        cache.get("p", "a")
+        cache.get("p", "c")
+        self.assertEqual(cache.stats()["size"], 2)
+        accesses: int = self.client.accesses
+        cache.get("p", "a")
+        self.assertEqual(self.client.accesses, accesses)
+        cache.get("p", "b")
+        self.assertEqual(self.client.accesses, accesses + 1)
+
+    def test_key_locks_are_dropped(self):
+        cache = SecretCache(self.factory, ttl=3600, max_size=10)
+        cache.get("p", "a")
+        with self.assertRaises(KeyError):
+            cache.get("p", "unknown")
+        # noinspection PyProtectedMember
+        self.assertEqual(cache._key_locks, {})
+
+    def test_concurrent_fetch_is_single(self):
+        cache = SecretCache(self.factory, ttl=3600, max_size=10)
+        with ThreadPoolExecutor(max_workers=20) as e:
+            values = list(e.map(lambda _: cache.get("p", "a"),
+                                range(20)))
+        self.assertEqual(set(values), {"a-1"})
+        self.assertEqual(self.client.accesses, 1)
+        # noinspection PyProtectedMember
+        self.assertEqual(cache._key_locks, {})
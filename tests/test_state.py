@@ -0,0 +1,70 @@
+# coding=utf-8
+"""
+Certbot state persistence tests
+"""
+from os import makedirs, symlink, readlink, listdir
+from os.path import join, islink
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from state import LocalStateStore, lineage_name, restore_state, \
+    save_state
+
+
+class StateTests(TestCase):
+    """
+    Certbot state persistence tests
+    """
+
+    def test_lineage_name_is_stable(self):
+        self.assertEqual(
+            lineage_name(["www.example.com", "*.Example.com"]),
+            lineage_name(["*.example.com", "www.example.com"]))
+        self.assertNotEqual(
+            lineage_name(["*.example.com"]),
+            lineage_name(["*.example.com", "www.example.com"]))
+
+    def test_missing_state(self):
+        with TemporaryDirectory() as d:
+            config_dir = join(d, "config")
+            makedirs(config_dir)
+            store = LocalStateStore(join(d, "store"))
+            self.assertFalse(restore_state(store, "key", config_dir))
+            self.assertEqual(listdir(config_dir), [])
+
+    def test_save_and_restore(self):
+        with TemporaryDirectory() as d:
+            store = LocalStateStore(join(d, "store"))
+
+            first = join(d, "first", "config")
+            makedirs(join(first, "accounts", "acme"))
+            makedirs(join(first, "archive", "cert"))
+            makedirs(join(first, "live", "cert"))
+            makedirs(join(first, "renewal"))
+            with open(join(first, "accounts", "acme", "regr.json"),
+                      "w") as f:
+                f.write("{}")
+            with open(join(first, "archive", "cert", "cert1.pem"),
+                      "w") as f:
+                f.write("cert")
+            symlink("../../archive/cert/cert1.pem",
+                    join(first, "live", "cert", "cert.pem"))
+            with open(join(first, "renewal", "cert.conf"), "w") as f:
+                f.write(f"archive_dir = {first}/archive/cert\n")
+            save_state(store, "key", first)
+
+            second = join(d, "second", "config")
+            makedirs(second)
+            self.assertTrue(restore_state(store, "key", second))
+            self.assertCountEqual(
+                listdir(second),
+                ["accounts", "archive", "live", "renewal"])
+            cert_link = join(second, "live", "cert", "cert.pem")
+            self.assertTrue(islink(cert_link))
+            self.assertEqual(readlink(cert_link),
+                             "../../archive/cert/cert1.pem")
+            with open(cert_link) as f:
+                self.assertEqual(f.read(), "cert")
+            with open(join(second, "renewal", "cert.conf")) as f:
+                self.assertEqual(f.read(),
+                                 f"archive_dir = {second}/archive/cert\n")
@@ -0,0 +1,174 @@
+# coding=utf-8
+"""
+Tracing spans tests
+"""
+from json import loads
+from os import makedirs
+from os.path import join
+from tempfile import TemporaryDirectory
+from typing import Any, Dict, List
+from unittest import TestCase
+from unittest.mock import patch, MagicMock
+
+from service import upload_directories_to_gcs
+from tests.BaseIntegrationTest import BaseTestCase
+from tracing import JsonlExporter, OtlpExporter, Span, span, \
+    parse_trace_headers
+
+TRACE_ID = "4bf92f3577b34da6a3ce929d0e0e4736"
+
+
+class TracingTests(TestCase):
+    """
+    Spans recording and export tests
+    """
+
+    def setUp(self):
+        """
+        Tests init method
+        """
+        directory = TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.spans_path = join(directory.name, "spans.jsonl")
+        patcher_exporter = patch("tracing.exporter",
+                                 JsonlExporter(self.spans_path))
+        self.addCleanup(patcher_exporter.stop)
+        patcher_exporter.start()
+
+    def test_trace_headers(self):
+        self.assertEqual(parse_trace_headers({
+            "traceparent": f"00-{TRACE_ID}-00f067aa0ba902b7-01"
+        }), (TRACE_ID, "00f067aa0ba902b7"))
+        self.assertEqual(parse_trace_headers({
+            "X-Cloud-Trace-Context": f"{TRACE_ID.upper()}/123;o=1"
+        }), (TRACE_ID, "000000000000007b"))
+        self.assertIsNone(parse_trace_headers({"traceparent": "00-bad"}))
+        self.assertIsNone(parse_trace_headers({}))
+
+    def test_upload_spans(self):
+        source = join(self.directory, "live")
+        makedirs(source)
+        for name in ("cert.pem", "privkey.pem"):
+            with open(join(source, name), "w", encoding="utf-8") as f:
+                f.write("data")
+        bucket = MagicMock()
+        bucket.name = "some-bucket"
+        bucket.list_blobs.return_value = []
+        with span("root"):
+            upload_directories_to_gcs(source, bucket, ["live"])
+        spans = read_spans(self.spans_path)
+        root, = [s for s in spans if s["name"] == "root"]
+        directory, = [s for s in spans if s["name"] == "upload_directory"]
+        files = [s for s in spans if s["name"] == "upload_file"]
+        self.assertEqual(directory["parent_id"], root["span_id"])
+        self.assertEqual(directory["attributes"],
+                         {"files": 2, "uploaded": 2, "bytes": 8})
+        self.assertEqual(
+            sorted((s["parent_id"], s["attributes"]["path"],
+                    s["attributes"]["bytes"]) for s in files),
+            [(directory["span_id"], "live/cert.pem", 4),
+             (directory["span_id"], "live/privkey.pem", 4)])
+        self.assertEqual({s["trace_id"] for s in spans},
+                         {root["trace_id"]})
+
+    def test_error(self):
+        with self.assertRaises(ValueError):
+            with span("failing"):
+                raise ValueError()
+        failing, = read_spans(self.spans_path)
+        self.assertEqual(failing["error"], "ValueError")
+
+    def test_otlp(self):
+        exporter = OtlpExporter("http://collector:4318/", interval=60)
+        exporter.export(Span("renew_certificates", TRACE_ID,
+                             "00f067aa0ba902b7", None, 1, 3,
+                             {"provider": "google", "domain_count": 2},
+                             error="CertbotError"))
+        with patch("tracing.post") as mock_post:
+            exporter.shutdown()
+        mock_post.assert_called_once()
+        self.assertEqual(mock_post.call_args.args,
+                         ("http://collector:4318/v1/traces",))
+        [resource] = mock_post.call_args.kwargs["json"]["resourceSpans"]
+        [scope] = resource["scopeSpans"]
+        self.assertEqual(scope["spans"], [{
+            "traceId": TRACE_ID,
+            "spanId": "00f067aa0ba902b7",
+            "name": "renew_certificates",
+            "kind": 2,
+            "startTimeUnixNano": "1",
+            "endTimeUnixNano": "3",
+            "attributes": [
+                {"key": "provider", "value": {"stringValue": "google"}},
+                {"key": "domain_count", "value": {"intValue": "2"}},
+            ],
+            "status": {"code": 2, "message": "CertbotError"},
+        }])
+
+
+class TracingApiTests(BaseTestCase):
+    """
+    Request traces tests
+    """
+
+    request = {
+        "provider": "google",
+        "secret_id": "some-secret-id",
+        "project": "some-project-id",
+        "domains": ["*.example.com", "www.example.com"],
+        "email": "test@example.com",
+        "target_bucket": "some-bucket",
+        "target_bucket_path": "some-path",
+    }
+
+    def setUp(self):
+        """
+        Tests init method
+        """
+        directory = TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.spans_path = join(directory.name, "spans.jsonl")
+        for target, value in (("tracing.exporter",
+                               JsonlExporter(self.spans_path)),
+                              ("server.dry_run_upload", MagicMock()),
+                              ("server.find_valid_certificate",
+                               MagicMock(return_value=None)),
+                              ("server.issue_certificate",
+                               MagicMock(return_value={}))):
+            patcher = patch(target, value)
+            self.addCleanup(patcher.stop)
+            patcher.start()
+
+    def test_request_trace(self):
+        response = self.http().post("/certs", json=self.request, headers={
+            "traceparent": f"00-{TRACE_ID}-00f067aa0ba902b7-01"})
+        self.assert200(response)
+        spans = read_spans(self.spans_path)
+        root, = [s for s in spans if s["name"] == "renew_certificates"]
+        self.assertEqual(root["trace_id"], TRACE_ID)
+        self.assertEqual(root["parent_id"], "00f067aa0ba902b7")
+        self.assertEqual(root["attributes"],
+                         {"provider": "google", "domain_count": 2})
+        self.assertEqual(
+            sorted(s["name"] for s in spans
+                   if s["parent_id"] == root["span_id"]),
+            ["dry_run_upload", "issue_certificate", "plan",
+             "renewal_check"])
+        self.assertEqual({s["trace_id"] for s in spans}, {TRACE_ID})
+
+    def test_failed_request(self):
+        response = self.http().post("/certs", json={})
+        self.assert400(response)
+        root, = read_spans(self.spans_path)
+        self.assertEqual(root["name"], "renew_certificates")
+        self.assertEqual(root["error"], "ValidationError")
+        self.assertIsNone(root["parent_id"])
+
+
+def read_spans(path: str) -> List[Dict[str, Any]]:
+    """
+    Returns exported spans
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        return [loads(line) for line in f]
@@ -0,0 +1,214 @@
+# coding=utf-8
+"""
+Shared work queue tests
+"""
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import TemporaryDirectory
+from threading import Event, Thread
+from time import sleep
+from typing import List, Optional
+from unittest import TestCase
+from unittest.mock import patch, MagicMock
+
+from errors import CertbotError
+from object_store import LocalObjectStore
+from server import drain_queue
+from tests.BaseIntegrationTest import BaseTestCase
+from work_queue import WorkQueue, Message
+
+
+class WorkQueueTests(TestCase):
+    """
+    Queue over local filesystem tests
+    """
+
+    def setUp(self):
+        """
+        Tests init method
+        """
+        directory = TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.store = LocalObjectStore(directory.name)
+
+    def queue(self, visibility_timeout: float = 10) -> WorkQueue:
+        return WorkQueue(self.store, "queue",
+                         visibility_timeout=visibility_timeout,
+                         max_attempts=2)
+
+    def test_lease_and_ack(self):
+        producer = self.queue()
+        message_id: str = producer.enqueue({"domain": "a.example.com"})
+        first, second = self.queue(), self.queue()
+        message: Optional[Message] = first.lease()
+        self.assertEqual(message.id, message_id)
+        self.assertEqual(message.payload, {"domain": "a.example.com"})
+        self.assertEqual(message.attempts, 1)
+        self.assertIsNone(second.lease())
+        self.assertTrue(first.heartbeat(message))
+        self.assertTrue(first.ack(message))
+        self.assertEqual(producer.stats(),
+                         {"messages": 0, "dead_letters": 0})
+
+    def test_visibility_timeout(self):
+        self.queue().enqueue({})
+        first, second = self.queue(0.1), self.queue(0.1)
+        message: Message = first.lease()
+        sleep(0.2)
+        redelivered: Message = second.lease()
+        self.assertEqual(redelivered.id, message.id)
+        self.assertEqual(redelivered.attempts, 2)
+        # expired lease can't be extended or acknowledged
+        self.assertFalse(first.heartbeat(message))
+        self.assertFalse(first.ack(message))
+        self.assertTrue(second.ack(redelivered))
+
+    def test_dead_letter(self):
+        queue = self.queue()
+        message_id: str = queue.enqueue({})
+        queue.fail(queue.lease(), {"type": "CertbotError"})
+        message: Message = queue.lease()
+        self.assertEqual(message.attempts, 2)
+        queue.fail(message, {"type": "CertbotError"})
+        self.assertIsNone(queue.lease())
+        self.assertEqual(queue.dead_letters(), [message_id])
+        self.assertEqual(queue.stats(),
+                         {"messages": 0, "dead_letters": 1})
+
+    def test_expired_attempts_are_dead(self):
+        queue = self.queue(0)
+        message_id: str = queue.enqueue({})
+        queue.lease()
+        queue.lease()
+        self.assertIsNone(queue.lease())
+        self.assertEqual(queue.dead_letters(), [message_id])
+
+    def test_leased_messages_are_not_read(self):
+        producer = self.queue()
+        for n in range(10):
+            producer.enqueue({"n": n})
+        consumer = self.queue()
+        for _ in range(9):
+            consumer.lease()
+        with patch.object(self.store, "read",
+                          wraps=self.store.read) as read:
+            message: Message = consumer.lease()
+            self.assertIsNone(consumer.lease())
+        # visibility is listed, only the visible message is read
+        read.assert_called_once()
+        self.assertTrue(message.path.startswith("queue/messages/"))
+        self.assertEqual(producer.stats(),
+                         {"messages": 10, "dead_letters": 0})
+
+    def test_lease_lists_window(self):
+        producer = self.queue()
+        for n in range(5):
+            producer.enqueue({"n": n})
+        consumer = self.queue()
+        with patch("work_queue.LEASE_WINDOW", 2), \
+                patch.object(self.store, "list",
+                             wraps=self.store.list) as listed:
+            self.assertIsNotNone(consumer.lease())
+            listed.assert_called_once()
+            self.assertEqual(listed.call_args.kwargs["max_results"], 2)
+
+            # names of messages taken by other consumers are paged
+            with patch.object(consumer, "_lease_any",
+                              wraps=consumer._lease_any) as lease_any:
+                lease_any.side_effect = [None, None, None]
+                self.assertIsNone(consumer.lease())
+            self.assertEqual([len(c.args[0])
+                              for c in lease_any.call_args_list],
+                             [2, 2, 0])
+            self.assertEqual(listed.call_count, 4)
+
+    def test_concurrent_consumers(self):
+        producer = self.queue()
+        ids: List[str] = [producer.enqueue({"n": n}) for n in range(40)]
+
+        def consume(_) -> List[str]:
+            queue, consumed = self.queue(), []
+            while True:
+                message: Optional[Message] = queue.lease()
+                if message is None:
+                    return consumed
+                self.assertTrue(queue.ack(message))
+                consumed.append(message.id)
+
+        with ThreadPoolExecutor(max_workers=4) as e:
+            consumed = [i for c in e.map(consume, range(4)) for i in c]
+        self.assertEqual(sorted(consumed), ids)
+
+
+class QueueApiTests(BaseTestCase):
+    """
+    Queue API and worker loop tests
+    """
+    mock_issue_certificate: MagicMock
+
+    request = {
+        "provider": "google",
+        "secret_id": "some-secret-id",
+        "project": "some-project-id",
+        "domains": ["*.example.com"],
+        "email": "test@example.com",
+        "target_bucket": "some-bucket",
+        "target_bucket_path": "some-path",
+    }
+
+    def setUp(self):
+        """
+        Tests init method
+        """
+        directory = TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.queue = WorkQueue(LocalObjectStore(directory.name), "",
+                               visibility_timeout=10, max_attempts=2)
+        for target, value in (("server.queue", self.queue),
+                              ("server.QUEUE_RETRY_DELAY", 0),
+                              ("server.QUEUE_POLL_INTERVAL", 0.01),
+                              ("server.dry_run_upload", MagicMock()),
+                              ("server.find_valid_certificate",
+                               MagicMock(return_value=None))):
+            patcher = patch(target, value)
+            self.addCleanup(patcher.stop)
+            patcher.start()
+
+        patcher_issue_certificate = patch("server.issue_certificate")
+        self.addCleanup(patcher_issue_certificate.stop)
+        self.mock_issue_certificate = patcher_issue_certificate.start()
+
+    def test_drain(self):
+        self.mock_issue_certificate.side_effect = self._issue
+        response = self.http().post("/queue", json=[
+            self.request,
+            {**self.request, "domains": ["fail.example.com"]},
+        ])
+        self.assertStatus(response, 202)
+        self.assertEqual(len(response.json["messages"]), 2)
+        self.assertEqual(self.http().get("/queue").json["queue"],
+                         {"messages": 2, "dead_letters": 0})
+
+        stop = Event()
+        worker = Thread(target=drain_queue, args=(self.queue, stop))
+        worker.start()
+        while self.queue.stats()["messages"]:
+            sleep(0.01)
+        stop.set()
+        worker.join()
+        self.assertEqual(self.http().get("/queue").json["queue"],
+                         {"messages": 0, "dead_letters": 1})
+        # succeeded once, failed ones retried up to max attempts
+        self.assertEqual(self.mock_issue_certificate.call_count, 3)
+
+    def test_not_configured(self):
+        with patch("server.queue", None):
+            response = self.http().post("/queue", json=[self.request])
+        self.assert404(response)
+        self.assertEqual(response.json["error"]["type"],
+                         "QueueNotConfiguredError")
+
+    @staticmethod
+    def _issue(req):
+        if req.domains[0].startswith("fail"):
+            raise CertbotError(["certbot"], 10, "failed")
+        return {"live_gcs_path": "gs://some-bucket/some-path/live"}
@@ -0,0 +1,287 @@
+# coding=utf-8
+"""
+Tracing spans of the issuance pipeline exported to a JSONL file or
+an OTLP/HTTP endpoint
+"""
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from json import dumps
+from logging import exception
+from os import getenv
+from re import compile as compile_regex
+from secrets import token_hex
+from threading import Event, Lock, Thread
+from time import time_ns
+from typing import Any, Dict, Iterator, List, Mapping, Optional, Tuple
+
+from requests import post
+
+SERVICE_NAME = "certbot-updater"
+
+TRACEPARENT = compile_regex(
+    r"^[0-9a-f]{2}-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+CLOUD_TRACE_CONTEXT = compile_regex(r"^([0-9a-fA-F]{32})/(\d+)")
+
+
+@dataclass
+class Span(object):
+    """
+    Timed operation of a trace
+    """
+    name: str
+    trace_id: str
+    span_id: str
+    parent_id: Optional[str]
+    start_ns: int
+    end_ns: int = 0
+    attributes: Dict[str, Any] = field(default_factory=dict)
+    error: Optional[str] = None
+
+    def set(self, **attributes: Any) -> None:
+        """
+        Adds attributes to the span
+        """
+        self.attributes.update(attributes)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        Returns span as a JSONL record
+        """
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start_ns": self.start_ns,
+            "end_ns": self.end_ns,
+            "duration_ms": round((self.end_ns - self.start_ns) / 1e6, 3),
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+class SpanExporter(ABC):
+    """
+    Destination of finished spans
+    """
+
+    @abstractmethod
+    def export(self, span: Span) -> None:
+        """
+        Exports finished span
+        """
+
+    def shutdown(self) -> None:
+        """
+        Flushes spans which are not exported yet
+        """
+
+
+class JsonlExporter(SpanExporter):
+    """
+    Appends spans to a local file, one JSON object per line
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = Lock()
+
+    def export(self, span: Span) -> None:
+        line: str = dumps(span.to_dict(), default=str)
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+
+class OtlpExporter(SpanExporter):
+    """
+    Sends spans to an OTLP/HTTP collector in JSON encoding every
+    interval seconds from a background thread
+    """
+
+    def __init__(self, endpoint: str, interval: float) -> None:
+        self.url = endpoint.rstrip("/") + "/v1/traces"
+        self.interval = interval
+        self._lock = Lock()
+        self._spans: List[Span] = []
+        self._stop = Event()
+        self._thread: Optional[Thread] = None
+
+    def export(self, span: Span) -> None:
+        with self._lock:
+            self._spans.append(span)
+            if self._thread is None:
+                self._thread = Thread(target=self._run,
+                                      name="otlp-exporter",
+                                      daemon=True)
+                self._thread.start()
+
+    def shutdown(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    def flush(self) -> None:
+        """
+        Sends pending spans, failures are logged only
+        """
+        with self._lock:
+            spans, self._spans = self._spans, []
+        if not spans:
+            return
+        # noinspection PyBroadException
+        try:
+            post(self.url, json=otlp_payload(spans),
+                 timeout=10).raise_for_status()
+        except Exception:
+            exception(f"Unable to export {len(spans)} spans "
+                      f"to {self.url}")
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.flush()
+
+
+def otlp_value(value: Any) -> Dict[str, Any]:
+    """
+    Returns OTLP JSON encoding of attribute value
+    """
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def otlp_payload(spans: List[Span]) -> Dict[str, Any]:
+    """
+    Returns OTLP/HTTP JSON request of the spans
+    """
+    return {"resourceSpans": [{
+        "resource": {"attributes": [{
+            "key": "service.name",
+            "value": otlp_value(SERVICE_NAME),
+        }]},
+        "scopeSpans": [{
+            "scope": {"name": SERVICE_NAME},
+            "spans": [{
+                "traceId": s.trace_id,
+                "spanId": s.span_id,
+                **({"parentSpanId": s.parent_id} if s.parent_id else {}),
+                "name": s.name,
+                # server for requests, internal for their phases
+                "kind": 2 if s.parent_id is None else 1,
+                "startTimeUnixNano": str(s.start_ns),
+                "endTimeUnixNano": str(s.end_ns),
+                "attributes": [{"key": k, "value": otlp_value(v)}
+                               for k, v in s.attributes.items()],
+                "status": {"code": 2, "message": s.error}
+                if s.error else {"code": 1},
+            } for s in spans],
+        }],
+    }]}
+
+
+def span_exporter() -> Optional[SpanExporter]:
+    """
+    Returns exporter configured by TRACING_URL environment variable,
+    either http(s):// OTLP endpoint or a local JSONL file path
+    """
+    url: str = getenv("TRACING_URL", "")
+    if not url:
+        return None
+    if url.startswith("http://") or url.startswith("https://"):
+        return OtlpExporter(
+            url, float(getenv("TRACING_EXPORT_INTERVAL", "5")))
+    return JsonlExporter(url[len("file://"):]
+                         if url.startswith("file://") else url)
+
+
+exporter: Optional[SpanExporter] = span_exporter()
+
+_current: ContextVar[Optional[Span]] = \
+    ContextVar("current_span", default=None)
+_remote_parent: ContextVar[Optional[Tuple[str, str]]] = \
+    ContextVar("remote_parent", default=None)
+
+
+def current_span() -> Span:
+    """
+    Returns active span, a detached one if there is no active span
+    """
+    active: Optional[Span] = _current.get()
+    if active is None:
+        return Span("detached", "0" * 32, "0" * 16, None, time_ns())
+    return active
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Span]:
+    """
+    Records the enclosed block as a child of the active span or as a
+    new trace root. Spans are not recorded without exporter
+    """
+    if exporter is None:
+        yield current_span()
+        return
+    parent: Optional[Span] = _current.get()
+    if parent is not None:
+        trace_id, parent_id = parent.trace_id, parent.span_id
+    else:
+        trace_id, parent_id = _remote_parent.get() or (token_hex(16), None)
+    new = Span(name, trace_id, token_hex(8), parent_id, time_ns(),
+               attributes=dict(attributes))
+    token = _current.set(new)
+    try:
+        yield new
+    except BaseException as e:
+        new.error = e.__class__.__name__
+        raise
+    finally:
+        _current.reset(token)
+        new.end_ns = time_ns()
+        # noinspection PyBroadException
+        try:
+            exporter.export(new)
+        except Exception:
+            exception(f"Unable to export span {name}")
+
+
+def parse_trace_headers(
+    headers: Mapping[str, str]
+) -> Optional[Tuple[str, str]]:
+    """
+    Returns trace and parent span ids of W3C traceparent or Google
+    Cloud X-Cloud-Trace-Context header, None if both are absent or
+    malformed
+    """
+    match = TRACEPARENT.match(headers.get("traceparent", "").strip())
+    if match is not None:
+        return match.group(1), match.group(2)
+    match = CLOUD_TRACE_CONTEXT.match(
+        headers.get("X-Cloud-Trace-Context", "").strip())
+    if match is not None:
+        return match.group(1).lower(), \
+            f"{int(match.group(2)) & 0xFFFFFFFFFFFFFFFF:016x}"
+    return None
+
+
+@contextmanager
+def trace_request(
+    name: str,
+    headers: Mapping[str, str],
+    **attributes: Any,
+) -> Iterator[Span]:
+    """
+    Records root span of the request continuing the incoming trace
+    """
+    token = _remote_parent.set(parse_trace_headers(headers))
+    try:
+        with span(name, **attributes) as root:
+            yield root
+    finally:
+        _remote_parent.reset(token)
@@ -0,0 +1,250 @@
+# coding=utf-8
+"""
+Work queue shared by instances through an object store
+"""
+from dataclasses import dataclass
+from json import dumps, loads
+from logging import info
+from os import getenv, getpid
+from os.path import join, basename
+from random import shuffle
+from socket import gethostname
+from time import time, time_ns
+from typing import Any, Dict, List, Optional, Tuple
+from uuid import uuid4
+
+from gcs import clients
+from object_store import ObjectStore, GCSObjectStore, LocalObjectStore
+
+# messages leased in random order to spread instances
+LEASE_WINDOW = 32
+
+
+@dataclass
+class Message(object):
+    """
+    Leased queue message
+    """
+    id: str
+    payload: Dict[str, Any]
+    attempts: int
+    generation: int
+    path: str
+
+
+class WorkQueue(object):
+    """
+    Queue of messages kept as objects under messages/ of the prefix.
+    Objects are named by the time the message becomes visible followed
+    by its id, so listing alone finds visible messages. A leased
+    message is moved to the name visible after the visibility timeout
+    which the consumer extends by heartbeats. Messages not
+    acknowledged in time are delivered again, messages failed
+    max_attempts times are moved to dead/
+    """
+
+    def __init__(
+        self,
+        store: ObjectStore,
+        prefix: str,
+        visibility_timeout: float,
+        max_attempts: int,
+        owner: Optional[str] = None,
+    ) -> None:
+        self.store = store
+        self.prefix = prefix
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.owner = owner or f"{gethostname()}-{getpid()}-{uuid4()}"
+
+    def enqueue(self, payload: Dict[str, Any]) -> str:
+        """
+        Puts message to the queue, returns its id
+        """
+        message_id: str = f"{time_ns():020d}-{uuid4().hex}"
+        self.store.create(self._path(message_id, 0), dumps({
+            "id": message_id,
+            "payload": payload,
+            "attempts": 0,
+            "owner": None,
+            "error": None,
+        }).encode("utf-8"))
+        info(f"Message {message_id} is enqueued to {self.prefix}")
+        return message_id
+
+    def lease(self) -> Optional[Message]:
+        """
+        Returns visible message hidden for the visibility timeout or
+        None if there are no such messages. Only visible messages are
+        read, they are listed by LEASE_WINDOW names and the next ones
+        are listed only if all of them are taken by other consumers
+        """
+        end_offset: str = self._path_prefix(int(time() * 1000) + 1)
+        start_offset: Optional[str] = None
+        while True:
+            # start offset is inclusive, its name is listed again
+            limit: int = LEASE_WINDOW + (start_offset is not None)
+            window: List[str] = self.store.list(
+                join(self.prefix, "messages/"), end_offset=end_offset,
+                start_offset=start_offset, max_results=limit)
+            message: Optional[Message] = self._lease_any(
+                [p for p in window if p != start_offset])
+            if message is not None or len(window) < limit:
+                return message
+            start_offset = window[-1]
+
+    def heartbeat(self, message: Message) -> bool:
+        """
+        Extends visibility timeout of the message, returns whether it
+        is still leased by this consumer
+        """
+        return self._update(message, time() + self.visibility_timeout)
+
+    def ack(self, message: Message) -> bool:
+        """
+        Deletes processed message, returns whether it was still leased
+        by this consumer
+        """
+        return self.store.delete(message.path, message.generation)
+
+    def fail(
+        self,
+        message: Message,
+        error: Dict[str, Any],
+        delay: float = 0,
+    ) -> None:
+        """
+        Makes failed message visible after delay seconds or moves it
+        to dead letters if it has been attempted max_attempts times
+        """
+        if message.attempts >= self.max_attempts:
+            current = self.store.read(message.path)
+            if current is not None and current[1] == message.generation:
+                record: Dict[str, Any] = loads(current[0])
+                record["error"] = error
+                self._bury(message.path, record, message.generation)
+            return
+        self._update(message, time() + delay, owner=None, error=error)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns numbers of queued and dead messages
+        """
+        return {
+            "messages": len(self.store.list(
+                join(self.prefix, "messages/"))),
+            "dead_letters": len(self.dead_letters()),
+        }
+
+    def dead_letters(self) -> List[str]:
+        """
+        Returns ids of messages moved to dead letters
+        """
+        return [basename(p)[:-len(".json")]
+                for p in self.store.list(join(self.prefix, "dead/"))]
+
+    def _lease_any(self, paths: List[str]) -> Optional[Message]:
+        shuffle(paths)
+        for path in paths:
+            current = self.store.read(path)
+            if current is None:
+                # leased or acknowledged by another consumer
+                continue
+            data, generation = current
+            record: Dict[str, Any] = loads(data)
+            if record["attempts"] >= self.max_attempts:
+                self._bury(path, record, generation)
+                continue
+            record.update(attempts=record["attempts"] + 1,
+                          owner=self.owner)
+            moved: Optional[Tuple[str, int]] = self._move(
+                path, generation, record,
+                time() + self.visibility_timeout)
+            if moved is None:
+                continue
+            return Message(record["id"], record["payload"],
+                           record["attempts"], moved[1], moved[0])
+        return None
+
+    def _update(
+        self,
+        message: Message,
+        visible_at: float,
+        **changes: Any,
+    ) -> bool:
+        current = self.store.read(message.path)
+        if current is None or current[1] != message.generation:
+            return False
+        record: Dict[str, Any] = {**loads(current[0]), **changes}
+        moved: Optional[Tuple[str, int]] = self._move(
+            message.path, message.generation, record, visible_at)
+        if moved is None:
+            return False
+        message.path, message.generation = moved
+        return True
+
+    def _move(
+        self,
+        path: str,
+        generation: int,
+        record: Dict[str, Any],
+        visible_at: float,
+    ) -> Optional[Tuple[str, int]]:
+        """
+        Moves message of the generation to the name visible at the
+        time, returns its new path and generation or None if it has
+        been moved or deleted by another consumer. A copy is left if
+        the consumer stops in between, so delivery is at least once
+        """
+        target: str = self._path(record["id"], int(visible_at * 1000))
+        data: bytes = dumps(record).encode("utf-8")
+        if target == path:
+            replaced: Optional[int] = self.store.replace(
+                path, data, generation)
+            return None if replaced is None else (path, replaced)
+        created: Optional[int] = self.store.create(target, data)
+        if created is None:
+            return None
+        if not self.store.delete(path, generation):
+            self.store.delete(target, created)
+            return None
+        return target, created
+
+    def _bury(
+        self,
+        path: str,
+        record: Dict[str, Any],
+        generation: int,
+    ) -> None:
+        dead_path: str = join(self.prefix, "dead", f"{record['id']}.json")
+        self.store.create(dead_path, dumps(record).encode("utf-8"))
+        if self.store.delete(path, generation):
+            info(f"Message {record['id']} is moved to dead letters "
+                 f"after {record['attempts']} attempts")
+
+    def _path(self, message_id: str, visible_ms: int) -> str:
+        return f"{self._path_prefix(visible_ms)}-{message_id}.json"
+
+    def _path_prefix(self, visible_ms: int) -> str:
+        return join(self.prefix, "messages", f"{visible_ms:015d}")
+
+
+def work_queue() -> Optional[WorkQueue]:
+    """
+    Returns queue configured by QUEUE_URL environment variable, either
+    gs://bucket/prefix or a local directory path
+    """
+    url: str = getenv("QUEUE_URL", "")
+    if not url:
+        return None
+    visibility_timeout = float(getenv("QUEUE_VISIBILITY_TIMEOUT", "300"))
+    max_attempts = int(getenv("QUEUE_MAX_ATTEMPTS", "3"))
+    if url.startswith("gs://"):
+        bucket, _, prefix = url[len("gs://"):].partition("/")
+        store: ObjectStore = GCSObjectStore(
+            clients.client(getenv("QUEUE_PROJECT") or None).bucket(bucket))
+    else:
+        store = LocalObjectStore(url[len("file://"):]
+                                 if url.startswith("file://") else url)
+        prefix = ""
+    return WorkQueue(store, prefix, visibility_timeout, max_attempts)